@@ -1,11 +1,86 @@
+import logging
+import os
+import threading
+import time
 from urllib.parse import urlparse
 
+from werkzeug.serving import make_ssl_devcert
+
 from db import init_db
+from recurring import recurring_config, start_scheduler
 from rest import app
 
+logger = logging.getLogger(__name__)
+
+server_config = {
+    "url": "https://0.0.0.0:5000",
+    "debug": True,
+    "dev_cert_path": os.getenv("DEV_CERT_PATH", "data/dev-cert"),
+}
+
+
+def get_dev_cert(base_path: str) -> tuple[str, str]:
+    """
+    Get the self-signed TLS certificate used in development, creating it the
+    first time.
+
+    The certificate is kept on disk and reused by later starts, instead of
+    generating a new key pair on every start.
+
+    Args:
+        base_path (str): The path of the certificate files, without the
+            `.crt` and `.key` extensions.
+
+    Returns:
+        tuple[str, str]: The paths of the certificate and of its private key.
+    """
+    cert_file, key_file = f"{base_path}.crt", f"{base_path}.key"
+    if not (os.path.exists(cert_file) and os.path.exists(key_file)):
+        os.makedirs(os.path.dirname(os.path.abspath(base_path)), exist_ok=True)
+        make_ssl_devcert(base_path, host="localhost")
+    return cert_file, key_file
+
+
+def init_in_background(started_at: float) -> None:
+    """
+    Initialize the database while the server is already listening, so that
+    `/healthz` answers during startup and `/readyz` once it is done. The
+    scheduler of recurring rules starts once the database is ready.
+
+    If the initialization fails, such as when the database is still
+    unreachable after `DB_CONNECT_ATTEMPTS` attempts, the error is logged and
+    the process exits with status 1, as it did when the database was
+    initialized before serving, so that the orchestrator restarts it instead
+    of keeping a process that is alive but never ready.
+
+    Args:
+        started_at (float): The `time.perf_counter()` value at process start.
+    """
+    def run():
+        try:
+            init_db(app)
+            if recurring_config["scheduler"]:
+                start_scheduler()
+        except BaseException:
+            logger.exception("Failed to initialize, exiting")
+            logging.shutdown()
+            # `sys.exit` would only end this thread
+            os._exit(1)
+        logger.info("Ready in %.0f ms", (time.perf_counter() - started_at) * 1000)
+
+    threading.Thread(target=run, name="init_db", daemon=True).start()
+
+
 if __name__ == "__main__":
-    init_db(app)
+    started_at = time.perf_counter()
+    logging.basicConfig(level=logging.INFO)
+
+    # With the reloader, the first process only watches the files and
+    # restarts the one that serves requests
+    if not server_config["debug"] or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        init_in_background(started_at)
 
-    url = urlparse('https://0.0.0.0:5000')
+    url = urlparse(server_config["url"])
     host, port = url.hostname, url.port
-    app.run(ssl_context="adhoc", host=host, port=port, debug=True)
+    ssl_context = get_dev_cert(server_config["dev_cert_path"])
+    app.run(ssl_context=ssl_context, host=host, port=port, debug=server_config["debug"])
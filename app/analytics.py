@@ -0,0 +1,211 @@
+"""
+Spending trends and balance forecasts over the records of a user.
+
+The records are read as two integer columns, creation time and amount in
+cents, and wrapped as NumPy arrays without copying them. Every statistic is
+then computed with vectorized operations over those arrays, so no `Record`
+object is built and no Python code runs per record.
+"""
+from __future__ import annotations
+import os
+from array import array
+from datetime import date, timedelta
+from typing import Any
+
+import numpy as np
+
+analytics_config = {
+    # How many days, up to today, the analytics cover
+    "days": int(os.getenv("ANALYTICS_DAYS", 90)),
+    "moving_average_days": int(os.getenv("ANALYTICS_MOVING_AVERAGE_DAYS", 7)),
+    # How many of the last days the forecast trend is fitted on
+    "forecast_days": int(os.getenv("ANALYTICS_FORECAST_DAYS", 30)),
+}
+
+_weekdays = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+_seconds_per_day = 24 * 60 * 60
+
+
+def _to_units(cents: np.ndarray) -> list[float]:
+    return np.round(cents / 100, 2).tolist()
+
+
+def daily_sums(day_index: np.ndarray, values: np.ndarray, days: int) -> np.ndarray:
+    """
+    Sum values per day.
+
+    The values must be ordered by day, as records are ordered by creation
+    time, so each day is a contiguous slice and its sum is a difference of
+    two cumulative sums, which stays exact for integers.
+
+    Args:
+        day_index (np.ndarray): The day of each value, counted from the first
+            day of the range, in ascending order.
+        values (np.ndarray): The values.
+        days (int): How many days the range has. Values of later days are
+            ignored.
+
+    Returns:
+        np.ndarray: The sum of the values of each day, with `days` items.
+
+    Example:
+        >>> daily_sums(np.array([0, 0, 2]), np.array([100, -50, 20]), 3)
+        array([50,  0, 20])
+    """
+    totals = np.concatenate(([0], np.cumsum(values)))
+    bounds = np.searchsorted(day_index, np.arange(days + 1))
+    return totals[bounds[1:]] - totals[bounds[:-1]]
+
+
+def moving_average(values: np.ndarray, window: int) -> np.ndarray:
+    """
+    Average each value with the ones before it, over a sliding window.
+
+    The first values, which have fewer values before them than the window,
+    are averaged over the values available.
+
+    Args:
+        values (np.ndarray): The values, such as daily expenses.
+        window (int): How many values each average covers.
+
+    Returns:
+        np.ndarray: The averages, as many as values.
+
+    Example:
+        >>> moving_average(np.array([10, 20, 30, 40]), 2)
+        array([10., 15., 25., 35.])
+    """
+    totals = np.concatenate(([0], np.cumsum(values)))
+    ends = np.arange(1, len(values) + 1)
+    starts = np.maximum(ends - window, 0)
+    return (totals[ends] - totals[starts]) / (ends - starts)
+
+
+def forecast(balances: np.ndarray, today: date, days: int) -> dict[str, Any]:
+    """
+    Project the balance at the end of the month from its recent trend.
+
+    A line is fitted by least squares on the daily balances of the last
+    `days` days, and followed from today's balance until the last day of
+    the month.
+
+    Args:
+        balances (np.ndarray): The balance at the end of each day, in cents,
+            the last one being today's.
+        today (date): The last day of the balances.
+        days (int): How many of the last days the trend is fitted on.
+
+    Returns:
+        dict[str, Any]: The `date` of the end of the month, the projected
+        `balance` and the `daily_trend` of the balance, in currency units.
+
+    Example:
+        >>> forecast(np.array([10000, 9000, 8000]), date(2024, 5, 29), 30)
+        {"date": "2024-05-31", "balance": 60.0, "daily_trend": -10.0}
+    """
+    recent = balances[-days:]
+    slope = np.polyfit(np.arange(len(recent)), recent, 1)[0] if len(recent) > 1 else 0.0
+
+    next_month = date(today.year + today.month // 12, today.month % 12 + 1, 1)
+    month_end = next_month - timedelta(days=1)
+    projected = balances[-1] + slope * (month_end - today).days
+
+    return {
+        "date": month_end.isoformat(),
+        "balance": round(float(projected) / 100, 2),
+        "daily_trend": round(float(slope) / 100, 2),
+    }
+
+
+def summarize(seconds: array, cents: array, balance: int, since: date, today: date) -> dict[str, Any]:
+    """
+    Compute the analytics of a user from the columns of their records.
+
+    Args:
+        seconds (array): The creation times of the records created since
+            `since`, as `storage.epoch_seconds`, in ascending order.
+        cents (array): The amounts of the same records, in cents.
+        balance (int): The current balance of the user, in cents, including
+            every record.
+        since (date): The first day of the analytics.
+        today (date): The last day of the analytics.
+
+    Returns:
+        dict[str, Any]: The analytics, with amounts in currency units:
+        - `daily`: for each day, the `income`, the `expenses` (as positive
+          amounts), the closing `balance` and the moving average of the
+          expenses.
+        - `months`: the income, expenses, net result and number of records of
+          each calendar month.
+        - `weekdays`: the average expenses of each day of the week.
+        - `forecast`: the projected balance at the end of the month.
+
+    Example:
+        >>> summarize(seconds, cents, 505000, date(2024, 3, 2), date(2024, 5, 30))
+        {
+            "since": "2024-03-02",
+            "until": "2024-05-30",
+            "daily": {
+                "dates": ["2024-03-02", ...],
+                "income": [0.0, ...],
+                "expenses": [12.5, ...],
+                "balance": [4980.25, ...],
+                "expenses_moving_average": [12.5, ...]
+            },
+            "months": [{"month": "2024-03", "income": 3000.0, "expenses": 1250.4,
+                        "net": 1749.6, "records": 31}, ...],
+            "weekdays": [{"weekday": "monday", "average_expenses": 40.12}, ...],
+            "forecast": {"date": "2024-05-31", "balance": 5012.3, "daily_trend": -7.7}
+        }
+    """
+    days = (today - since).days + 1
+    times = np.frombuffer(seconds, dtype=np.int64)
+    amounts = np.frombuffer(cents, dtype=np.int64)
+
+    day_index = times // _seconds_per_day - (since - date(1970, 1, 1)).days
+    income = daily_sums(day_index, np.maximum(amounts, 0), days)
+    expenses = -daily_sums(day_index, np.minimum(amounts, 0), days)
+    counts = daily_sums(day_index, np.ones_like(amounts), days)
+
+    # Records dated after today count in the balance but not in the days
+    opening = balance - int(amounts.sum())
+    balances = opening + np.cumsum(income - expenses)
+
+    dates = np.arange(np.datetime64(since, "D"), np.datetime64(today, "D") + 1)
+    months = dates.astype("datetime64[M]")
+    month_starts = np.flatnonzero(np.concatenate(([True], months[1:] != months[:-1])))
+    month_income = np.add.reduceat(income, month_starts)
+    month_expenses = np.add.reduceat(expenses, month_starts)
+    month_counts = np.add.reduceat(counts, month_starts)
+
+    # 1970-01-01 was a Thursday
+    weekdays = (dates.astype(np.int64) + 3) % 7
+    weekday_days = np.bincount(weekdays, minlength=7)
+    weekday_expenses = np.bincount(weekdays, weights=expenses, minlength=7)
+    weekday_averages = np.divide(weekday_expenses, weekday_days,
+                                 out=np.zeros(7), where=weekday_days > 0)
+
+    return {
+        "since": since.isoformat(),
+        "until": today.isoformat(),
+        "daily": {
+            "dates": np.datetime_as_string(dates).tolist(),
+            "income": _to_units(income),
+            "expenses": _to_units(expenses),
+            "balance": _to_units(balances),
+            "expenses_moving_average": _to_units(
+                moving_average(expenses, analytics_config["moving_average_days"])),
+        },
+        "months": [
+            {"month": month, "income": month_in, "expenses": month_out, "net": net, "records": records}
+            for month, month_in, month_out, net, records in zip(
+                np.datetime_as_string(months[month_starts]).tolist(), _to_units(month_income),
+                _to_units(month_expenses), _to_units(month_income - month_expenses),
+                month_counts.tolist())
+        ],
+        "weekdays": [
+            {"weekday": weekday, "average_expenses": average}
+            for weekday, average in zip(_weekdays, _to_units(weekday_averages))
+        ],
+        "forecast": forecast(balances, today, analytics_config["forecast_days"]),
+    }
@@ -0,0 +1,98 @@
+"""
+Move old records to the archive.
+
+Usage:
+    python app/archive.py [--max-age-days DAYS]
+"""
+import argparse
+import os
+from datetime import date, datetime, timedelta
+
+from psycopg2 import sql
+
+from db import add_months, load_query, month_start, shard_connection, shards
+
+archive_config = {
+    "max_age_days": int(os.getenv("ARCHIVE_MAX_AGE_DAYS", 365)),
+}
+
+
+def archive_month(shard: int, month: date) -> int:
+    """
+    Move the records of a month of a shard to the archive.
+
+    The records are deleted from the records table and stored in a single
+    `record_archives` row per user, with the records of the month as a JSON
+    payload that Postgres stores compressed. Their totals are added to the
+    user's carry-forward totals, one per currency, so balances stay exact.
+    Everything happens in a single transaction, and the now empty partition
+    of the month is dropped.
+
+    Args:
+        shard (int): The index of the shard in `shards`.
+        month (date): The first day of the month.
+
+    Returns:
+        int: The number of carry-forward totals updated, one per user and
+        currency with records archived.
+    """
+    end = add_months(month, 1)
+    partition = sql.Identifier(f"records_{month:%Y_%m}")
+
+    with shard_connection(shard, statement_timeout=False) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(load_query("archive_records.sql"), (month, end, month, end))
+            totals = cursor.rowcount
+            cursor.execute(sql.SQL(load_query("drop_record_partition.sql")).format(partition=partition))
+        conn.commit()
+
+    return totals
+
+
+def archive_records(max_age_days: int) -> int:
+    """
+    Move records older than a given age to the archive, on every shard.
+
+    Only whole months are archived: a month is archived once all of it is
+    older than `max_age_days`.
+
+    Args:
+        max_age_days (int): How many days records are kept in the records
+            table.
+
+    Returns:
+        int: The number of months archived, summed over all shards.
+
+    Example:
+        >>> archive_records(365)
+        3
+    """
+    cutoff = month_start(datetime.now() - timedelta(days=max_age_days))
+    archived = 0
+
+    for shard in shards:
+        with shard_connection(shard.index) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(load_query("select_oldest_record.sql"))
+                oldest = cursor.fetchone()[0]
+            conn.rollback()
+
+        if oldest is None:
+            continue
+
+        month = month_start(oldest)
+        while month < cutoff:
+            archive_month(shard.index, month)
+            archived += 1
+            month = add_months(month, 1)
+
+    return archived
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-age-days", type=int, default=archive_config["max_age_days"])
+    args = parser.parse_args()
+
+    archived = archive_records(args.max_age_days)
+    print(f"Archived {archived} months of records")
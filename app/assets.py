@@ -0,0 +1,232 @@
+"""
+Build the static assets for production.
+
+The JavaScript modules are bundled into a single file, and every asset is
+copied to `static/dist` with a hash of its content in its name, next to
+precompressed `.gz` and `.br` variants. A manifest maps the original paths
+to the built ones, and templates refer to assets through `asset_url`, so the
+built files can be cached by browsers forever.
+
+Usage:
+    python app/assets.py
+"""
+from __future__ import annotations
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+app_dir = os.path.dirname(os.path.abspath(__file__))
+
+assets_config = {
+    "static_dir": os.path.abspath(os.path.join(app_dir, "../static")),
+    "dist_dir": "dist",
+    # Module entry points, bundled with the modules they import
+    "scripts": ["scripts/init.js"],
+    "files": ["styles.css", "images/favicon.svg"],
+    "cache_max_age": 365 * 24 * 60 * 60,
+}
+
+_import_pattern = re.compile(
+    r'^import\s+(?:\{(?P<names>[^}]*)\}\s+from\s+)?["\'](?P<path>\./[^"\']+)["\'];?\s*$', re.M)
+_export_pattern = re.compile(
+    r'^export\s+(?:async\s+)?(?:function\s*\*?|const|let|var|class)\s+(?P<name>[A-Za-z_$][\w$]*)', re.M)
+_unsupported_pattern = re.compile(r'^(?:export\s+(?:default|\{|\*)|import\s+(?:\*|\w))', re.M)
+
+
+def _module_id(path: str) -> str:
+    return "__module_" + re.sub(r"\W", "_", path)
+
+
+def bundle_modules(static_dir: str, entry: str) -> str:
+    """
+    Bundle an ES module and the modules it imports into a single module.
+
+    Each module becomes a function scope that returns its exports, in the
+    order the browser would evaluate them: imported modules first, and a
+    module that is already being evaluated (an import cycle) is not evaluated
+    again. Only the forms of `import` and `export` used by this app are
+    supported: `import { a, b } from "./x.js"`, `import "./x.js"` and
+    `export` in front of a function, class or variable declaration.
+
+    Args:
+        static_dir (str): The directory the module paths are relative to.
+        entry (str): The path of the entry module, such as
+            'scripts/init.js'.
+
+    Returns:
+        str: The source of the bundle.
+
+    Raises:
+        ValueError: If a module uses an unsupported import or export form.
+    """
+    ordered: list[str] = []
+    visiting: set[str] = set()
+    sources: dict[str, str] = {}
+
+    def visit(path: str) -> None:
+        if path in visiting or path in ordered:
+            return
+        visiting.add(path)
+
+        with open(os.path.join(static_dir, path)) as file:
+            source = file.read()
+        if _unsupported_pattern.search(source):
+            raise ValueError(f"Unsupported import or export in {path}")
+        sources[path] = source
+
+        for match in _import_pattern.finditer(source):
+            visit(os.path.normpath(os.path.join(os.path.dirname(path), match["path"])))
+        ordered.append(path)
+
+    visit(entry)
+
+    chunks = []
+    for path in ordered:
+        source = sources[path]
+        imports = []
+        for match in _import_pattern.finditer(source):
+            dependency = os.path.normpath(os.path.join(os.path.dirname(path), match["path"]))
+            if match["names"] and dependency in ordered[:ordered.index(path)]:
+                imports.append(f"const {{{match['names'].strip()}}} = {_module_id(dependency)};")
+        exports = _export_pattern.findall(source)
+
+        body = _import_pattern.sub("", source)
+        body = re.sub(r"^export\s+", "", body, flags=re.M)
+        chunks.append(
+            f"// {path}\n"
+            f"const {_module_id(path)} = (() => {{\n"
+            + "\n".join(imports) + "\n"
+            + body.strip() + "\n"
+            f"return {{ {', '.join(exports)} }};\n"
+            "})();\n"
+        )
+
+    return "\n".join(chunks)
+
+
+def _write_asset(dist_dir: str, path: str, content: bytes) -> str:
+    """
+    Write an asset with the hash of its content in its name, along with its
+    `.gz` and `.br` variants.
+
+    Args:
+        dist_dir (str): The directory to write the asset to.
+        path (str): The original path of the asset, such as 'styles.css'.
+        content (bytes): The content of the asset.
+
+    Returns:
+        str: The name of the written asset, such as 'styles.3f0c9a1b2d4e.css'.
+    """
+    import brotli
+
+    stem, extension = os.path.splitext(os.path.basename(path))
+    name = f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{extension}"
+
+    with open(os.path.join(dist_dir, name), "wb") as file:
+        file.write(content)
+    with open(os.path.join(dist_dir, name + ".gz"), "wb") as file:
+        # A fixed mtime keeps the output identical between builds
+        file.write(gzip.compress(content, compresslevel=9, mtime=0))
+    with open(os.path.join(dist_dir, name + ".br"), "wb") as file:
+        file.write(brotli.compress(content, quality=11))
+
+    return name
+
+
+def build(static_dir: str | None = None) -> dict[str, str]:
+    """
+    Build the assets into the `dist` directory of the static directory.
+
+    Previous builds are removed. The manifest is written to
+    'dist/manifest.json'.
+
+    Args:
+        static_dir (str | None, optional): The static directory, or `None` for
+            `assets_config["static_dir"]` (default: None).
+
+    Returns:
+        dict[str, str]: The manifest, which maps the original paths to the
+        built ones, relative to the static directory.
+
+    Example:
+        >>> build()
+        {
+            "scripts/init.js": "dist/init.9a1b2c3d4e5f.js",
+            "styles.css": "dist/styles.3f0c9a1b2d4e.css",
+            "images/favicon.svg": "dist/favicon.7e8f9a0b1c2d.svg"
+        }
+    """
+    static_dir = static_dir or assets_config["static_dir"]
+    dist_dir = os.path.join(static_dir, assets_config["dist_dir"])
+    shutil.rmtree(dist_dir, ignore_errors=True)
+    os.makedirs(dist_dir)
+
+    manifest = {}
+    for entry in assets_config["scripts"]:
+        content = bundle_modules(static_dir, entry).encode()
+        manifest[entry] = f"{assets_config['dist_dir']}/{_write_asset(dist_dir, entry, content)}"
+
+    for path in assets_config["files"]:
+        with open(os.path.join(static_dir, path), "rb") as file:
+            content = file.read()
+        manifest[path] = f"{assets_config['dist_dir']}/{_write_asset(dist_dir, path, content)}"
+
+    with open(os.path.join(dist_dir, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2)
+
+    return manifest
+
+
+def load_manifest(static_dir: str | None = None) -> dict[str, str]:
+    """
+    Load the manifest of the last build.
+
+    Args:
+        static_dir (str | None, optional): The static directory, or `None` for
+            `assets_config["static_dir"]` (default: None).
+
+    Returns:
+        dict[str, str]: The manifest, or an empty one if the assets were not
+        built, in which case the original files are used.
+    """
+    static_dir = static_dir or assets_config["static_dir"]
+    path = os.path.join(static_dir, assets_config["dist_dir"], "manifest.json")
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+_manifest = load_manifest()
+
+
+def asset_url(path: str) -> str:
+    """
+    Get the path of an asset to use in templates.
+
+    Args:
+        path (str): The original path of the asset, relative to the static
+            directory.
+
+    Returns:
+        str: The path of the built asset if the assets were built, otherwise
+        the original one, relative to the static directory.
+
+    Example:
+        >>> asset_url("styles.css")
+        'dist/styles.3f0c9a1b2d4e.css'
+    """
+    return _manifest.get(path, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    for original, built in build().items():
+        print(f"{original} -> {built}")
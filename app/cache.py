@@ -0,0 +1,568 @@
+from __future__ import annotations
+import hashlib
+import json
+import logging
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, BinaryIO, Iterator
+from urllib.parse import urlparse
+
+import metrics
+
+cache_config = {
+    # none, resp (Redis protocol) or shared_memory (single host)
+    "backend": os.getenv("CACHE_BACKEND", "none"),
+    "ttl": int(os.getenv("CACHE_TTL", 60)),
+    "url": os.getenv("CACHE_URL", "redis://localhost:6379/0"),
+    "timeout": float(os.getenv("CACHE_TIMEOUT", 0.1)),
+    "retry_interval": float(os.getenv("CACHE_RETRY_INTERVAL", 5)),
+    "shm_path": os.getenv("CACHE_SHM_PATH", "/dev/shm/registraai-cache"),
+    "shm_slots": int(os.getenv("CACHE_SHM_SLOTS", 4096)),
+    "shm_slot_size": int(os.getenv("CACHE_SHM_SLOT_SIZE", 8192)),
+    # Changed whenever the format of the entries changes, so processes of
+    # different versions don't read each other's entries
+    "prefix": "registraai:4:",
+}
+
+logger = logging.getLogger(__name__)
+
+
+class CacheError(Exception):
+    """
+    Raised when the cache backend fails or answers with an error.
+    """
+
+
+class CacheUnavailable(CacheError):
+    """
+    Raised instead of contacting a cache server that failed recently.
+    """
+
+
+class Cache(ABC):
+    """
+    Cache of per-user entries shared by all workers, such as the profile,
+    the balance and the first page of history of a user.
+
+    Entries are JSON values identified by a kind and a user ID, and expire
+    after `cache_config["ttl"]` seconds. Writers invalidate the entries of a
+    user after changing them; a request that read the database before the
+    write may still store the old value afterwards, so the TTL bounds how
+    long a stale entry can live. Failures of the backend are logged, counted
+    and treated as misses, so the cache never fails a request.
+
+    Subclasses implement `_get`, `_set` and `_delete` over raw keys and
+    bytes.
+
+    Methods:
+        get: Retrieve an entry of a user.
+        get_many: Retrieve several entries of a user at once.
+        set: Store an entry of a user.
+        set_many: Store several entries of a user at once.
+        delete: Invalidate entries of a user.
+    """
+
+    @staticmethod
+    def _key(kind: str, user_id: str) -> str:
+        return f"{cache_config['prefix']}{kind}:{user_id}"
+
+    @staticmethod
+    def _failed(operation: str, error: Exception) -> None:
+        metrics.cache_errors.inc(operation)
+        # The failure that made the server unavailable was already logged
+        log = logger.debug if isinstance(error, CacheUnavailable) else logger.warning
+        log("Cache %s failed: %s", operation, error)
+
+    def get(self, kind: str, user_id: str) -> Any | None:
+        """
+        Retrieve an entry of a user.
+
+        Args:
+            kind (str): The kind of entry, such as 'balance'.
+            user_id (str): The ID of the user.
+
+        Returns:
+            Any | None: The cached value, or `None` on a miss.
+
+        Example:
+            >>> get_cache().get("balance", "123")
+            50.5
+        """
+        return self.get_many(user_id, (kind,))[0]
+
+    def get_many(self, user_id: str, kinds: tuple[str, ...]) -> list[Any | None]:
+        """
+        Retrieve several entries of a user at once.
+
+        Args:
+            user_id (str): The ID of the user.
+            kinds (tuple[str, ...]): The kinds of entries.
+
+        Returns:
+            list[Any | None]: The cached values in the order of `kinds`, with
+            `None` for misses.
+        """
+        keys = [self._key(kind, user_id) for kind in kinds]
+        try:
+            values = self._get(keys)
+        except (OSError, CacheError, ValueError) as e:
+            self._failed("get", e)
+            values = [None] * len(keys)
+
+        results = []
+        for kind, value in zip(kinds, values):
+            metrics.cache_lookups.inc(kind, "miss" if value is None else "hit")
+            results.append(None if value is None else json.loads(value))
+        return results
+
+    def set(self, kind: str, user_id: str, value: Any) -> None:
+        """
+        Store an entry of a user.
+
+        Args:
+            kind (str): The kind of entry, such as 'balance'.
+            user_id (str): The ID of the user.
+            value (Any): A JSON serializable value.
+        """
+        self.set_many(user_id, {kind: value})
+
+    def set_many(self, user_id: str, values: dict[str, Any]) -> None:
+        """
+        Store several entries of a user at once.
+
+        Args:
+            user_id (str): The ID of the user.
+            values (dict[str, Any]): The JSON serializable values, by kind.
+        """
+        items = {self._key(kind, user_id): json.dumps(value).encode()
+                 for kind, value in values.items()}
+        try:
+            self._set(items, cache_config["ttl"])
+        except (OSError, CacheError, ValueError) as e:
+            self._failed("set", e)
+
+    def delete(self, user_id: str, *kinds: str) -> None:
+        """
+        Invalidate entries of a user.
+
+        Args:
+            user_id (str): The ID of the user.
+            *kinds (str): The kinds of entries to invalidate.
+
+        Example:
+            >>> get_cache().delete("123", "balance", "history")
+        """
+        try:
+            self._delete([self._key(kind, user_id) for kind in kinds])
+        except (OSError, CacheError, ValueError) as e:
+            self._failed("delete", e)
+
+    @abstractmethod
+    def _get(self, keys: list[str]) -> list[bytes | None]:
+        """
+        Retrieve raw values, `None` for the missing or expired ones.
+        """
+
+    @abstractmethod
+    def _set(self, items: dict[str, bytes], ttl: int) -> None:
+        """
+        Store raw values that expire after `ttl` seconds.
+        """
+
+    @abstractmethod
+    def _delete(self, keys: list[str]) -> None:
+        """
+        Remove raw values.
+        """
+
+
+class NullCache(Cache):
+    """
+    Cache that stores nothing, used when no backend is configured.
+    """
+
+    def get_many(self, user_id: str, kinds: tuple[str, ...]) -> list[Any | None]:
+        return [None] * len(kinds)
+
+    def set_many(self, user_id: str, values: dict[str, Any]) -> None:
+        pass
+
+    def delete(self, user_id: str, *kinds: str) -> None:
+        pass
+
+    def _get(self, keys: list[str]) -> list[bytes | None]:
+        return [None] * len(keys)
+
+    def _set(self, items: dict[str, bytes], ttl: int) -> None:
+        pass
+
+    def _delete(self, keys: list[str]) -> None:
+        pass
+
+
+def _encode_command(command: tuple[str | bytes, ...]) -> bytes:
+    parts = [b"*%d\r\n" % len(command)]
+    for arg in command:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+def _read_reply(reader: BinaryIO) -> Any:
+    """
+    Read a RESP2 reply.
+
+    Error replies are returned as `CacheError` objects rather than raised, so
+    the replies that follow them in a pipeline are still read.
+    """
+    line = reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed by the cache server")
+
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload
+    if kind == b"-":
+        return CacheError(payload.decode(errors="replace"))
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError("Connection closed by the cache server")
+        return data[:-2]
+    if kind == b"*":
+        length = int(payload)
+        return None if length < 0 else [_read_reply(reader) for _ in range(length)]
+    # The rest of the stream cannot be parsed, so the connection is dropped
+    raise ConnectionError(f"Unexpected reply from the cache server: {line!r}")
+
+
+class RespCache(Cache):
+    """
+    Cache kept in a server that speaks the Redis protocol (RESP), such as
+    Redis, Valkey or KeyDB, shared by the workers of every host.
+
+    Each thread keeps its own connection. Several entries are read with a
+    single `MGET` and written with one pipeline of `SET` commands. After a
+    failure the server is not contacted for `retry_interval` seconds, so an
+    unavailable cache costs one timeout per interval instead of one per
+    request.
+
+    Attributes:
+        address (tuple[str, int]): The host and port of the server.
+        database (int): The database number selected on connect.
+        timeout (float): The connect and read timeout, in seconds.
+        retry_interval (float): How long to skip the server after a failure.
+    """
+
+    def __init__(self, url: str, timeout: float, retry_interval: float) -> None:
+        """
+        Initialize a RespCache object.
+
+        Args:
+            url (str): The server URL, such as 'redis://:password@host:6379/0'.
+            timeout (float): The connect and read timeout, in seconds.
+            retry_interval (float): How long to skip the server after a
+                failure, in seconds.
+
+        Raises:
+            ValueError: If the URL is not a `redis://` URL.
+        """
+        parsed = urlparse(url)
+        if parsed.scheme != "redis":
+            raise ValueError(f"Unsupported cache URL: {url}")
+
+        self.address = (parsed.hostname or "localhost", parsed.port or 6379)
+        self.database = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self._username = parsed.username
+        self._password = parsed.password
+        self._local = threading.local()
+        self._unavailable_until = 0.0
+
+    def _connect(self) -> tuple[socket.socket, BinaryIO]:
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = (sock, sock.makefile("rb"))
+
+        setup = []
+        if self._password is not None:
+            setup.append(("AUTH", self._username, self._password) if self._username
+                         else ("AUTH", self._password))
+        if self.database:
+            setup.append(("SELECT", str(self.database)))
+        if setup:
+            try:
+                self._send(connection, setup)
+            except BaseException as e:
+                sock.close()
+                if isinstance(e, CacheError):
+                    # Such as a wrong password, which every retry would get
+                    raise ConnectionError(f"Cache server setup failed: {e}") from e
+                raise
+        return connection
+
+    @staticmethod
+    def _send(connection: tuple[socket.socket, BinaryIO], commands: list[tuple]) -> list[Any]:
+        sock, reader = connection
+        sock.sendall(b"".join(_encode_command(command) for command in commands))
+        replies = [_read_reply(reader) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, CacheError):
+                raise reply
+        return replies
+
+    def execute(self, *commands: tuple[str | bytes, ...]) -> list[Any]:
+        """
+        Send commands to the server in a single round trip.
+
+        Args:
+            *commands (tuple[str | bytes, ...]): The commands, such as
+                `("GET", "key")`.
+
+        Returns:
+            list[Any]: The reply of each command.
+
+        Raises:
+            CacheError: If the server answers with an error.
+            CacheUnavailable: If the server failed less than
+                `retry_interval` seconds ago.
+            OSError: If the connection fails.
+        """
+        if time.monotonic() < self._unavailable_until:
+            raise CacheUnavailable("Cache server unavailable")
+
+        connection = getattr(self._local, "connection", None)
+        try:
+            if connection is None:
+                connection = self._local.connection = self._connect()
+            return self._send(connection, list(commands))
+        except CacheError:
+            # An error reply leaves the connection usable
+            raise
+        except (OSError, ValueError):
+            self._disconnect(connection)
+            self._unavailable_until = time.monotonic() + self.retry_interval
+            raise
+
+    def _disconnect(self, connection: tuple[socket.socket, BinaryIO] | None) -> None:
+        self._local.connection = None
+        if connection is not None:
+            connection[0].close()
+
+    def _get(self, keys: list[str]) -> list[bytes | None]:
+        values, = self.execute(("MGET", *keys))
+        return values
+
+    def _set(self, items: dict[str, bytes], ttl: int) -> None:
+        self.execute(*[("SET", key, value, "EX", str(ttl)) for key, value in items.items()])
+
+    def _delete(self, keys: list[str]) -> None:
+        self.execute(("DEL", *keys))
+
+
+class SharedMemoryCache(Cache):
+    """
+    Cache kept in a memory-mapped file, shared by the worker processes of a
+    single host.
+
+    The file is a fixed table of `slots` slots of `slot_size` bytes, so its
+    size never grows. A key goes to the slot given by its hash, replacing
+    whatever was there, and values that do not fit in a slot are not cached.
+    Each slot holds the hash of its key, an expiration time and the value,
+    and is locked with `fcntl.lockf` across processes (POSIX only).
+
+    Attributes:
+        path (str): The path of the file, preferably on a tmpfs such as
+            `/dev/shm`.
+        slots (int): The number of slots.
+        slot_size (int): The size of each slot, in bytes.
+    """
+
+    _magic = b"RGCACHE1"
+    # Magic, number of slots and slot size
+    _file_header = struct.Struct("<8sII")
+    # Key hash, expiration time (Unix seconds) and value length
+    _slot_header = struct.Struct("<16sdI")
+
+    def __init__(self, path: str, slots: int, slot_size: int) -> None:
+        """
+        Initialize a SharedMemoryCache object, creating the file if needed.
+
+        Args:
+            path (str): The path of the file.
+            slots (int): The number of slots.
+            slot_size (int): The size of each slot, in bytes.
+
+        Raises:
+            ValueError: If the slots are too small to hold any value.
+        """
+        import fcntl
+
+        if slot_size <= self._slot_header.size:
+            raise ValueError(f"Cache slot size must be larger than {self._slot_header.size}")
+
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self._fcntl = fcntl
+        self._lock = threading.Lock()
+
+        size = self._file_header.size + slots * slot_size
+        header = self._file_header.pack(self._magic, slots, slot_size)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                if os.pread(fd, len(header), 0) != header:
+                    # A new file, or one laid out with other settings. It is
+                    # cleared rather than shrunk, since other processes may
+                    # still map it.
+                    if os.fstat(fd).st_size < size:
+                        os.ftruncate(fd, size)
+                    chunk = bytes(1 << 20)
+                    for offset in range(len(header), size, len(chunk)):
+                        os.pwrite(fd, chunk[:size - offset], offset)
+                    os.pwrite(fd, header, 0)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(fd, size)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def _slot(self, key: str) -> tuple[bytes, int]:
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        index = int.from_bytes(digest[:8], "little") % self.slots
+        return digest, self._file_header.size + index * self.slot_size
+
+    @contextmanager
+    def _locked(self, offset: int, shared: bool = False) -> Iterator[None]:
+        # Record locks are held per process, so threads also need a lock
+        fcntl = self._fcntl
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX, self.slot_size, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slot_size, offset)
+
+    def _get(self, keys: list[str]) -> list[bytes | None]:
+        capacity = self.slot_size - self._slot_header.size
+        now = time.time()
+
+        values = []
+        for key in keys:
+            digest, offset = self._slot(key)
+            value = None
+            with self._locked(offset, shared=True):
+                stored, expires_at, length = self._slot_header.unpack_from(self._map, offset)
+                if stored == digest and expires_at > now and length <= capacity:
+                    start = offset + self._slot_header.size
+                    value = self._map[start:start + length]
+            values.append(value)
+        return values
+
+    def _set(self, items: dict[str, bytes], ttl: int) -> None:
+        capacity = self.slot_size - self._slot_header.size
+        expires_at = time.time() + ttl
+
+        for key, value in items.items():
+            if len(value) > capacity:
+                continue
+            digest, offset = self._slot(key)
+            with self._locked(offset):
+                self._slot_header.pack_into(self._map, offset, digest, expires_at, len(value))
+                start = offset + self._slot_header.size
+                self._map[start:start + len(value)] = value
+
+    def _delete(self, keys: list[str]) -> None:
+        empty = bytes(self._slot_header.size)
+        for key in keys:
+            digest, offset = self._slot(key)
+            with self._locked(offset):
+                # Leave the slot alone if another key replaced this one
+                if self._map[offset:offset + len(digest)] == digest:
+                    self._map[offset:offset + len(empty)] = empty
+
+
+_cache: Cache | None = None
+
+
+def get_cache() -> Cache:
+    """
+    Get the shared cache used by the models.
+
+    The backend is selected by `cache_config["backend"]` the first time this
+    function is called, unless one was set with `set_cache`. Connections and
+    mappings are opened then, so worker processes forked after the import
+    get their own.
+
+    Returns:
+        Cache: The shared cache.
+
+    Raises:
+        ValueError: If the configured backend is unknown.
+    """
+    global _cache
+    if _cache is None:
+        backends = {
+            "none": NullCache,
+            "resp": lambda: RespCache(cache_config["url"], cache_config["timeout"],
+                                      cache_config["retry_interval"]),
+            "shared_memory": lambda: SharedMemoryCache(cache_config["shm_path"],
+                                                       cache_config["shm_slots"],
+                                                       cache_config["shm_slot_size"]),
+        }
+        backend = cache_config["backend"]
+        if backend not in backends:
+            raise ValueError(f"Unknown cache backend: {backend}")
+        _cache = backends[backend]()
+    return _cache
+
+
+def set_cache(cache: Cache) -> None:
+    """
+    Set the shared cache used by the models.
+
+    Args:
+        cache (Cache): The cache to use.
+
+    Example:
+        >>> set_cache(SharedMemoryCache("/dev/shm/test-cache", 64, 4096))
+    """
+    global _cache
+    _cache = cache
+
+
+def hit_ratio() -> float:
+    """
+    Get the ratio of cache lookups that were hits since the process started.
+
+    Returns:
+        float: The hit ratio, from 0 to 1, or 0 before any lookup.
+    """
+    hits = misses = 0.0
+    for (_, result), count in metrics.cache_lookups.values().items():
+        if result == "hit":
+            hits += count
+        else:
+            misses += count
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+metrics.register(metrics.Gauge(
+    "cache_hit_ratio", "Ratio of shared cache lookups that were hits", hit_ratio))
@@ -0,0 +1,464 @@
+"""
+Label records with categories, from rules defined by each user.
+
+A rule maps a keyword, matched as a whole word, or a regular expression to a
+category. All the rules of a user are compiled into a single regular
+expression, so a description is labeled with one search. The keywords share
+one alternative, shaped as a trie, so the search tries them all at once at
+each position instead of one after the other, and its cost barely grows with
+the number of keywords. The rule that matches first in the description
+wins. At the same position, the longest keyword wins, then the regular
+expressions, oldest first.
+
+New records are labeled when they are created. When the rules of a user
+change, their existing records are labeled again by `relabel`, one month at a
+time, several months in parallel, in batches that only write the labels that
+changed.
+
+Usage:
+    python app/categories.py relabel USER_ID
+"""
+from __future__ import annotations
+import argparse
+import functools
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time
+from typing import Iterable, Iterator
+
+import metrics
+from cache import get_cache
+from db import add_months, month_start, sqlite_database
+from storage import get_storage
+
+try:
+    import re._parser as sre_parse
+except ImportError:  # Python 3.10
+    import sre_parse  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+categories_config = {
+    "max_rules": int(os.getenv("CATEGORY_MAX_RULES", 200)),
+    "max_pattern_length": 200,
+    "max_category_length": 64,
+    # Longer descriptions are rejected, and only this many characters of the
+    # descriptions stored before are searched by the rules
+    "max_description_length": int(os.getenv("RECORD_MAX_DESCRIPTION_LENGTH", 200)),
+    "relabel_batch_size": int(os.getenv("CATEGORY_RELABEL_BATCH_SIZE", 5000)),
+    # Months of records relabeled at the same time, each on its own connection
+    "relabel_workers": int(os.getenv("CATEGORY_RELABEL_WORKERS", 4)),
+}
+
+kinds = ("keyword", "regex")
+
+# A rule as compiled: (category, kind, pattern)
+Rule = tuple[str, str, str]
+
+_repeats = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None)}
+# What a quantifier can repeat: a character, a character class or any character
+_single_characters = {sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.IN, sre_parse.ANY}
+_backtracking = {sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS, sre_parse.ASSERT, sre_parse.ASSERT_NOT}
+
+
+class InvalidRule(ValueError):
+    """
+    Raised when a category rule can't be compiled with the other rules of
+    its user.
+
+    Attributes:
+        field (str): The field of the rule that is invalid.
+    """
+
+    def __init__(self, field: str, reason: str) -> None:
+        super().__init__(reason)
+        self.field = field
+
+
+def _trie_pattern(words: Iterable[str]) -> str:
+    """
+    Build a regular expression matching any of some words, shaped as a trie,
+    such as 'ub(?:er(?:\\ eats)?|ike)' for 'uber', 'uber eats' and 'ubike'.
+
+    Optional continuations are greedy, so the longest word matches first,
+    and shorter ones are tried when the rest of the expression fails.
+
+    Args:
+        words (Iterable[str]): The words, which must not be empty.
+
+    Returns:
+        str: The regular expression.
+    """
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def render(node: dict) -> str:
+        branches = [re.escape(char) + render(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        alternatives = branches[0] if len(branches) == 1 and "" not in node else f"(?:{'|'.join(branches)})"
+        return alternatives + "?" if "" in node else alternatives
+
+    return render(trie)
+
+
+def _nodes(pattern) -> Iterator[tuple]:
+    """
+    Walk a parsed regular expression.
+
+    Args:
+        pattern: The items of a pattern parsed by `sre_parse`.
+
+    Yields:
+        tuple: The `(opcode, argument)` of each item, nested ones included.
+    """
+    for op, av in pattern:
+        yield op, av
+        if op is sre_parse.SUBPATTERN:
+            yield from _nodes(av[-1])
+        elif op is sre_parse.BRANCH:
+            for branch in av[1]:
+                yield from _nodes(branch)
+        elif op in _repeats:
+            yield from _nodes(av[2])
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            yield from _nodes(av[1])
+        elif op is getattr(sre_parse, "ATOMIC_GROUP", None):
+            yield from _nodes(av)
+
+
+def validate_rule(category: str, kind: str, pattern: str) -> None:
+    """
+    Check that a rule can be compiled with the other rules of its user.
+
+    Regular expressions can't have capturing groups, which would shift the
+    groups that tell which rule matched, and can't match an empty
+    description, which would label every record.
+
+    The backtracking engine of `re` takes exponential time on patterns such
+    as `(?:a+)+$`, so regular expressions are limited to a subset that it
+    searches in quadratic time at worst: a single quantifier, applied to a
+    character, a character class or `.`, and no backreferences, lookarounds
+    or conditionals. Along with the length of descriptions, this bounds the
+    time to label a record.
+
+    Args:
+        category (str): The category the rule labels records with.
+        kind (str): `"keyword"` or `"regex"`.
+        pattern (str): The keyword or the regular expression.
+
+    Raises:
+        InvalidRule: If the rule is not valid, with the field and the reason.
+
+    Example:
+        >>> validate_rule("food", "regex", r"(uber|ifood)")
+        InvalidRule: Regular expressions can't have capturing groups, use (?:...)
+    """
+    if not category.strip() or len(category) > categories_config["max_category_length"]:
+        raise InvalidRule("category",
+            f"The category must have 1 to {categories_config['max_category_length']} characters")
+    if kind not in kinds:
+        raise InvalidRule("kind", f"The kind must be one of {', '.join(kinds)}. Got: {kind}")
+    if not pattern.strip() or len(pattern) > categories_config["max_pattern_length"]:
+        raise InvalidRule("pattern",
+            f"The pattern must have 1 to {categories_config['max_pattern_length']} characters")
+
+    if kind == "keyword":
+        return
+
+    try:
+        compiled = re.compile(f"(?:{pattern})", re.IGNORECASE)
+    except re.error as e:
+        raise InvalidRule("pattern", f"Invalid regular expression: {e}") from None
+    if compiled.groups:
+        raise InvalidRule("pattern", "Regular expressions can't have capturing groups, use (?:...)")
+
+    nodes = list(_nodes(sre_parse.parse(pattern, re.IGNORECASE)))
+    if any(op in _backtracking for op, _ in nodes):
+        raise InvalidRule("pattern",
+            "Regular expressions can't have backreferences, lookarounds or conditionals")
+    repeated = [av[2] for op, av in nodes if op in _repeats]
+    if len(repeated) > 1:
+        raise InvalidRule("pattern", "Regular expressions can have at most one quantifier")
+    if any(len(body) != 1 or body[0][0] not in _single_characters for body in repeated):
+        raise InvalidRule("pattern",
+            "Only a character, a character class or . can be repeated, such as \\d+ or .*")
+    if compiled.search(""):
+        raise InvalidRule("pattern", "The pattern matches an empty description")
+
+
+class Classifier:
+    """
+    The rules of a user, compiled into a single regular expression.
+
+    The first alternative, in the first group, matches the keywords, and the
+    matched keyword gives the rule. Each regular expression is another
+    alternative in its own group, so the index of the group that matched
+    gives the rule.
+
+    Attributes:
+        keywords (dict[str, str]): The category of each keyword, in lower
+            case, from its oldest rule.
+        categories (list[str]): The category of each regular expression, in
+            rule order.
+    """
+
+    def __init__(self, rules: Iterable[Rule]) -> None:
+        """
+        Initialize a Classifier object.
+
+        Args:
+            rules (Iterable[Rule]): The `(category, kind, pattern)` of each
+                rule, oldest first. Regular expressions that are not valid
+                as checked by `validate_rule`, such as the ones stored
+                before it limited them, are skipped.
+        """
+        self.keywords: dict[str, str] = {}
+        self.categories: list[str] = []
+        alternatives = []
+        for category, kind, pattern in rules:
+            if kind == "keyword":
+                self.keywords.setdefault(pattern.lower(), category)
+            else:
+                try:
+                    validate_rule(category, kind, pattern)
+                except InvalidRule as e:
+                    logger.warning("Skipping the category rule %r: %s", pattern, e)
+                    continue
+                self.categories.append(category)
+                alternatives.append(f"({pattern})")
+
+        # A group that never matches keeps the group numbers when there are no keywords
+        keywords = rf"(?<!\w)({_trie_pattern(self.keywords)})(?!\w)" if self.keywords else "((?!))"
+        self._pattern = re.compile("|".join([keywords, *alternatives]), re.IGNORECASE) \
+            if self.keywords or alternatives else None
+
+    def classify(self, description: str | None) -> str | None:
+        """
+        Get the category of a description.
+
+        Args:
+            description (str | None): The description of a record.
+
+        Returns:
+            str | None: The category of the first matching rule, or `None` if
+            no rule matches.
+
+        Example:
+            >>> Classifier([("transport", "keyword", "uber")]).classify("Uber to work")
+            'transport'
+        """
+        if self._pattern is None or not description:
+            return None
+        match = self._pattern.search(description[:categories_config["max_description_length"]])
+        if match is None:
+            return None
+        if match.lastindex == 1:
+            keyword = match.group(1).lower()
+            # Case-insensitive matching folds a few characters that lower()
+            # doesn't, such as the Kelvin sign
+            return self.keywords.get(keyword) or next(
+                category for word, category in self.keywords.items()
+                if re.fullmatch(re.escape(word), keyword, re.IGNORECASE))
+        return self.categories[match.lastindex - 2] # type: ignore
+
+    def classify_many(self, descriptions: Iterable[str | None]) -> list[str | None]:
+        """
+        Get the categories of many descriptions.
+
+        Descriptions repeat a lot, such as the same shop every week, so each
+        distinct description is only searched once.
+
+        Args:
+            descriptions (Iterable[str | None]): The descriptions.
+
+        Returns:
+            list[str | None]: The category of each description.
+        """
+        labels: dict[str | None, str | None] = {}
+        result = []
+        for description in descriptions:
+            if description in labels:
+                label = labels[description]
+            else:
+                label = labels[description] = self.classify(description)
+            result.append(label)
+        return result
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_rules(rules: tuple[Rule, ...]) -> Classifier:
+    """
+    Compile rules, reusing the classifiers compiled before for the same
+    rules, so a record is labeled without compiling anything.
+
+    Args:
+        rules (tuple[Rule, ...]): The `(category, kind, pattern)` of each
+            rule, oldest first.
+
+    Returns:
+        Classifier: The compiled rules.
+    """
+    return Classifier(rules)
+
+
+def classify_records(records: list[tuple], rules: Iterable[tuple[str, str, str, str]]) -> list[tuple]:
+    """
+    Label records of many users at once, such as a batch of records of
+    recurring rules.
+
+    Args:
+        records (list[tuple]): The `(user_id, amount, description,
+            created_at, currency)` records.
+        rules (Iterable[tuple[str, str, str, str]]): The `(user_id, category,
+            kind, pattern)` of the rules of the users, oldest first.
+
+    Returns:
+        list[tuple]: The records, each with its category appended.
+    """
+    rules_by_user: dict[str, list[Rule]] = {}
+    for user_id, category, kind, pattern in rules:
+        rules_by_user.setdefault(user_id, []).append((category, kind, pattern))
+
+    classifiers = {user_id: compile_rules(tuple(user_rules)) for user_id, user_rules in rules_by_user.items()}
+    no_rules = compile_rules(())
+    return [(*record, classifiers.get(record[0], no_rules).classify(record[2])) for record in records]
+
+
+def _relabel_range(user_id: str, classifier: Classifier, since: datetime, until: datetime) -> int:
+    """
+    Label again the records of a user created in a date range.
+
+    The records are read in batches of `categories_config["relabel_batch_size"]`,
+    in order of creation, and each batch writes, in one statement, the labels
+    that changed.
+
+    Args:
+        user_id (str): The ID of the user.
+        classifier (Classifier): The rules of the user.
+        since (datetime): The start of the range.
+        until (datetime): The end of the range, excluded.
+
+    Returns:
+        int: The number of records whose category changed.
+    """
+    storage = get_storage()
+    batch_size = categories_config["relabel_batch_size"]
+    after = (since, 0)
+    changed = 0
+
+    while True:
+        rows = storage.get_record_labels(user_id, since, until, after, batch_size)
+        if not rows:
+            return changed
+
+        labels = classifier.classify_many(description for _, _, description, _ in rows)
+        updates = [(id, label) for (id, _, _, category), label in zip(rows, labels) if label != category]
+        if updates:
+            storage.update_record_categories(user_id, since, until, updates)
+            changed += len(updates)
+
+        if len(rows) < batch_size:
+            return changed
+        after = (rows[-1][1], rows[-1][0])
+
+
+def relabel(user_id: str) -> int:
+    """
+    Label again all the records of a user with their current rules.
+
+    The records are split by month, which with Postgres are the partitions
+    of the records table, and `categories_config["relabel_workers"]` months
+    are processed at the same time. With SQLite, which has a single writer,
+    they are processed one after the other. The cached history of the user is
+    invalidated.
+
+    Args:
+        user_id (str): The ID of the user.
+
+    Returns:
+        int: The number of records whose category changed.
+
+    Example:
+        >>> relabel("123")
+        18250
+    """
+    storage = get_storage()
+    classifier = compile_rules(tuple(
+        (category, kind, pattern) for _, _, category, kind, pattern, _ in storage.get_category_rules(user_id)))
+
+    first, last = storage.get_record_range(user_id)
+    if first is None or last is None:
+        return 0
+
+    ranges = []
+    month = month_start(first)
+    while month <= last.date():
+        ranges.append((datetime.combine(month, time()), datetime.combine(add_months(month, 1), time())))
+        month = add_months(month, 1)
+
+    workers = 1 if sqlite_database is not None else categories_config["relabel_workers"]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="relabel") as executor:
+        changed = sum(executor.map(lambda bounds: _relabel_range(user_id, classifier, *bounds), ranges))
+
+    get_cache().delete(user_id, "history")
+    metrics.relabeled_records.inc(amount=changed)
+    return changed
+
+
+_relabel_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="relabel_job")
+_relabel_lock = threading.Lock()
+# Users being relabeled, and whether their rules changed again meanwhile
+_relabeling: dict[str, bool] = {}
+
+
+def _relabel_job(user_id: str) -> None:
+    while True:
+        try:
+            changed = relabel(user_id)
+            logger.info("Relabeled %d records of user %s", changed, user_id)
+        except Exception:
+            logger.exception("Failed to relabel the records of user %s", user_id)
+
+        with _relabel_lock:
+            if not _relabeling[user_id]:
+                del _relabeling[user_id]
+                return
+            _relabeling[user_id] = False
+
+
+def request_relabel(user_id: str) -> None:
+    """
+    Label again the records of a user in the background.
+
+    Requests for a user that is already being relabeled are merged: the
+    records are labeled once more when the current run ends, with the rules
+    as they are then.
+
+    Args:
+        user_id (str): The ID of the user.
+    """
+    with _relabel_lock:
+        if user_id in _relabeling:
+            _relabeling[user_id] = True
+            return
+        _relabeling[user_id] = False
+    _relabel_executor.submit(_relabel_job, user_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    relabel_parser = subparsers.add_parser("relabel", help="Label again the records of a user")
+    relabel_parser.add_argument("user_id")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    print(f"Relabeled {relabel(args.user_id)} records")
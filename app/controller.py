@@ -1,4 +1,12 @@
-from models import Record, User
+from datetime import date, datetime, timedelta
+from typing import Any
+
+from cache import get_cache
+from categories import request_relabel
+from db import after_commit, unit_of_work
+from fx import day_of, fx_config, sum_totals
+from models import CategoryRule, Money, Record, RecurringRule, User
+from storage import epoch_seconds
 
 def get_user(user_id: str) -> User:
     """
@@ -29,12 +37,14 @@ def get_user(user_id: str) -> User:
     return user
 
 
-def get_or_create_user(google_id: str, name: str, email: str, picture: str) -> User | None:
+def upsert_user(google_id: str, name: str, email: str, picture: str) -> User:
     """
-    Get or create a user in the system.
+    Create a user in the system, or update their profile.
 
-    This function attempts to retrieve a user with the provided Google ID from
-    the system. If the user doesn't exist, a new user is created and returned.
+    This function is called on every login. It creates the user with the
+    provided Google ID on their first login, and updates their name, email
+    and picture when they changed in their Google account, with a single
+    database statement that writes nothing when the profile is unchanged.
 
     Args:
         google_id (str): The Google ID of the user.
@@ -43,31 +53,32 @@ def get_or_create_user(google_id: str, name: str, email: str, picture: str) -> U
         picture (str): The URL of the user's profile picture.
 
     Returns:
-        User | None: A `User` object representing the user, either retrieved or newly
-        created.
+        User: A `User` object representing the user, with the given profile.
 
     Example:
-        >>> get_or_create_user("123456789", "John Doe", "john@example.com",
-                               "http://example.com/john.jpg")
+        >>> upsert_user("123456789", "John Doe", "john@example.com",
+                        "http://example.com/john.jpg")
         <User object at 0x...>
     """
-    try:
-        user = get_user(google_id)
-    except Exception:
-        user = User.create(google_id, name, email, picture)
-
-    return user
+    return User.upsert(google_id, name, email, picture)
 
 
-def get_records(user_id: str) -> list[Record]:
+def get_records(user_id: str, since: datetime | None = None, until: datetime | None = None) -> list[Record]:
     """
     Retrieve all records for a user.
 
     This function fetches all records that belong to the user with the
-    specified user ID from the database using the `Record` model.
+    specified user ID from the database using the `Record` model, optionally
+    only the ones created in a date range. Archived records are only read
+    when `since` is older than the archived period, so recent history never
+    touches the archive.
 
     Args:
         user_id (str): The ID of the user to get the records.
+        since (datetime | None, optional): Only get records created at or
+            after this datetime (default: None).
+        until (datetime | None, optional): Only get records created before
+            this datetime (default: None).
 
     Returns:
         list[Record] | None: A list of `Record` objects if records are found,
@@ -83,26 +94,70 @@ def get_records(user_id: str) -> list[Record]:
         >>> get_records("nonexistent_id")
         Exception: User id not found: nonexistent_id
     """
-    user = get_user(user_id)
-    records = user.get_records()
+    with unit_of_work():
+        user = get_user(user_id)
+        records = user.get_records(since, until)
+
+        if since is not None:
+            carry_forward = Record.get_carry_forward(user_id)
+            archived_until = max((until for _, _, until in carry_forward), default=None)
+            if archived_until is not None and since < archived_until:
+                archive_end = min(until, archived_until) if until else archived_until
+                records = Record.get_archived(user_id, since, archive_end) + records
+
     return records
 
 
-def get_balance(user_id: str) -> float:
+def get_carry_forward(user_id: str, currency: str = fx_config["base_currency"]) -> Money:
+    """
+    Get the total of the archived records of a user in a currency.
+
+    The total of each currency is converted at the rate of the day its
+    records are archived until.
+
+    Args:
+        user_id (str): The ID of the user.
+        currency (str, optional): The currency of the total (default: the
+            base currency).
+
+    Returns:
+        Money: The sum of the amounts of all archived records of the user, or
+        `0` if nothing was archived.
+
+    Raises:
+        fx.UnknownCurrency: If a currency has no exchange rates.
+
+    Example:
+        >>> get_carry_forward("123")
+        Money(152075)
+    """
+    totals = [(code, day_of(epoch_seconds(archived_until)), total.cents)
+              for code, total, archived_until in Record.get_carry_forward(user_id)]
+    return Money(sum_totals(totals, currency))
+
+
+def get_balance(user_id: str, currency: str = fx_config["base_currency"]) -> Money:
     """
     Calculate the total balance of a user.
 
     This function calculates the total balance by summing up the amounts of all
-    registered gains and expenses for the user with the specified user ID.
+    registered gains and expenses for the user with the specified user ID,
+    including the carry-forward total of the archived records. The sum is
+    computed exactly, in cents, by the database, and amounts in other
+    currencies than `currency` are converted at the rate of their day. The
+    balance in each currency asked for is kept in the shared cache until the
+    user registers a new record.
 
     Args:
         user_id (str): The ID of the user to get the balance.
+        currency (str, optional): The currency of the balance (default: the
+            base currency).
 
     Returns:
-        float | None: The total balance after all registered gains and expenses,
-                      or `None` if the user is not found.
+        Money: The total balance after all registered gains and expenses.
 
     Raises:
+        fx.UnknownCurrency: If a currency has no exchange rates.
         Exception: If the user_id is not found, raises an Exception.
 
     Example:
@@ -110,31 +165,172 @@ def get_balance(user_id: str) -> float:
         return 50.50.
 
         >>> get_balance("123")
-        50.50
+        Money(5050)
 
         >>> get_balance("nonexistent_id")
         Exception: User id not found: nonexistent_id
     """
-    user = get_user(user_id)
+    cache = get_cache()
+    balances = cache.get("balance", user_id) or {}
+    if currency in balances:
+        return Money(balances[currency])
+
+    balance = User.get_balance(user_id, currency)
+    if balance is None:
+        raise Exception(f"User id not found: {user_id}")
+
+    cache.set("balance", user_id, {**balances, currency: balance.cents})
+    return balance
+
+
+def get_analytics(user_id: str, currency: str = fx_config["base_currency"]) -> dict[str, Any]:
+    """
+    Compute the spending trends and balance forecast of a user.
+
+    The creation times and amounts of the user's records of the last
+    `analytics_config["days"]` days are read in bulk, with their balance, in
+    one unit of work, converted to `currency` and summarized with NumPy by
+    `analytics.summarize`. The result is kept in the shared cache for the
+    rest of the day, until the user registers a new record or asks for
+    another currency.
+
+    Args:
+        user_id (str): The ID of the user.
+        currency (str, optional): The currency of the amounts (default: the
+            base currency).
+
+    Returns:
+        dict[str, Any]: The analytics, as returned by `analytics.summarize`,
+        with their `currency`.
+
+    Raises:
+        fx.UnknownCurrency: If a currency has no exchange rates.
+        Exception: If the user_id is not found, raises an Exception.
+
+    Example:
+        >>> get_analytics("123")
+        {
+            "currency": "BRL",
+            "since": "2024-03-02",
+            "until": "2024-05-30",
+            "daily": {...},
+            "months": [...],
+            "weekdays": [...],
+            "forecast": {"date": "2024-05-31", "balance": 5012.3, "daily_trend": -7.7}
+        }
+    """
+    # NumPy is only imported by the processes that serve analytics
+    import analytics
+
+    today = date.today()
+    since = today - timedelta(days=analytics.analytics_config["days"] - 1)
+
+    cache = get_cache()
+    cached = cache.get("analytics", user_id)
+    if cached is not None and cached["since"] == since.isoformat() \
+            and cached["until"] == today.isoformat() and cached.get("currency") == currency:
+        return cached
 
-    user_records = user.get_records()
-    balance = sum([float(rec.amount) for rec in user_records])
+    with unit_of_work():
+        balance = User.get_balance(user_id, currency)
+        if balance is None:
+            raise Exception(f"User id not found: {user_id}")
+        seconds, cents = Record.get_columns(user_id, datetime.combine(since, datetime.min.time()), currency)
 
-    return round(balance, 2)
+    result = {"currency": currency, **analytics.summarize(seconds, cents, balance.cents, since, today)}
+    cache.set("analytics", user_id, result)
+    return result
 
 
-def register_gain(user_id: str, amount: float, description: str) -> Record:
+def get_bootstrap(user_id: str, history_size: int) -> dict[str, Any] | None:
+    """
+    Gather the data needed to render the page of a logged in user.
+
+    The user profile, the balance and the latest records are read with a
+    single database query, so the page can be rendered with the data inline
+    instead of being fetched by the browser afterwards.
+
+    Args:
+        user_id (str): The ID of the user.
+        history_size (int): How many of the latest records to include.
+
+    Returns:
+        dict[str, Any] | None: The `user` (as in `/user_data`), the `balance`
+        and the `history` (as in `/history`, from oldest to newest), in the
+        base `currency`, or `None` if the user is not found.
+
+    Example:
+        >>> get_bootstrap("123", 50)
+        {
+            "user": {"id": "123", "username": "John Doe", ...},
+            "currency": "BRL",
+            "balance": 50.5,
+            "history": [{"id": 1, "amount": 100.5, "converted_amount": 100.5, ...}, ...]
+        }
+    """
+    result = User.get_bootstrap(user_id, history_size)
+    if result is None:
+        return None
+
+    user, balance, records = result
+    history, _ = convert_history(records, fx_config["base_currency"])
+    return {
+        "user": user.to_dict(),
+        "currency": fx_config["base_currency"],
+        "balance": balance.to_float(),
+        "history": history,
+    }
+
+
+def convert_history(records: list[Record], currency: str) -> tuple[list[dict[str, Any]], Money]:
+    """
+    Convert records to dictionaries for a history in a currency.
+
+    Each record keeps its `amount` and `currency`, and gets its
+    `converted_amount` in `currency`, at the rate of its day. The amounts of
+    all records are converted at once, see `Record.convert`.
+
+    Args:
+        records (list[Record]): The records.
+        currency (str): The currency of the history.
+
+    Returns:
+        tuple[list[dict[str, Any]], Money]: The dictionaries of the records,
+        and the sum of their converted amounts.
+
+    Raises:
+        fx.UnknownCurrency: If a currency has no exchange rates.
+
+    Example:
+        >>> convert_history(records, "USD")
+        ([{"id": 1, "amount": 100.5, "currency": "BRL", "converted_amount": 19.62, ...}, ...],
+         Money(1962))
+    """
+    amounts = Record.convert(records, currency)
+    history = []
+    for rec, amount in zip(records, amounts):
+        item = rec.to_dict()
+        item["converted_amount"] = amount.to_float()
+        history.append(item)
+    return history, Money.sum(amounts)
+
+
+def register_gain(user_id: str, amount: Money, description: str,
+                  currency: str = fx_config["base_currency"]) -> Record:
     """
     Register a money gain.
 
     This function registers a money gain by creating a new record with the
     specified amount and description for the user with the specified user ID.
-    The amount is stored as a positive value.
+    The amount is stored as a positive value. The user lookup and the insert
+    run in one unit of work.
 
     Args:
         user_id (str): The ID of the user registering the gain.
-        amount (float): The amount of the gain.
+        amount (Money): The amount of the gain.
         description (str): A description of the gain.
+        currency (str, optional): The currency of the amount (default: the
+            base currency).
 
     Returns:
         Record | None: A `Record` object representing the newly created gain.
@@ -143,31 +339,35 @@ def register_gain(user_id: str, amount: float, description: str) -> Record:
         Exception: If the user_id is not found, raises an Exception.
 
     Example:
-        >>> register_gain("123", 150.00, "Freelance work")
+        >>> register_gain("123", Money(15000), "Freelance work")
         <Record object at 0x...>
 
-        >>> register_gain("nonexistent_id", 150.00, "Freelance work")
+        >>> register_gain("nonexistent_id", Money(15000), "Freelance work")
         Exception: User id not found: nonexistent_id
     """
-    user = get_user(user_id)
-
-    record = user.gain(amount, description)
+    with unit_of_work():
+        user = get_user(user_id)
+        record = user.gain(amount, description, currency)
 
     return record
 
 
-def register_expense(user_id: str, amount: float, description: str) -> Record:
+def register_expense(user_id: str, amount: Money, description: str,
+                     currency: str = fx_config["base_currency"]) -> Record:
     """
     Register a money expense.
 
     This function registers a money expense by creating a new record with the
     specified amount and description for the user with the specified user ID.
-    The amount is stored as a negative value.
+    The amount is stored as a negative value. The user lookup and the insert
+    run in one unit of work.
 
     Args:
         user_id (str): The ID of the user registering the expense.
-        amount (float): The amount of the expense.
+        amount (Money): The amount of the expense.
         description (str): A description of the expense.
+        currency (str, optional): The currency of the amount (default: the
+            base currency).
 
     Returns:
         Record | None: A `Record` object representing the newly created
@@ -177,14 +377,207 @@ def register_expense(user_id: str, amount: float, description: str) -> Record:
         Exception: If the user_id is not found, raises an Exception.
 
     Example:
-        >>> register_expense("123", 75.00, "Grocery shopping")
+        >>> register_expense("123", Money(7500), "Grocery shopping")
         <Record object at 0x...>
 
-        >>> register_expense("nonexistent_id", 75.00, "Grocery shopping")
+        >>> register_expense("nonexistent_id", Money(7500), "Grocery shopping")
         Exception: User id not found: nonexistent_id
     """
-    user = get_user(user_id)
-
-    record = user.expense(amount, description)
+    with unit_of_work():
+        user = get_user(user_id)
+        record = user.expense(amount, description, currency)
 
     return record
+
+
+def create_recurring_rule(user_id: str, amount: Money, description: str, schedule: str,
+                          currency: str = fx_config["base_currency"]) -> RecurringRule:
+    """
+    Create a recurring rule, which registers a record on every occurrence of
+    a cron-like schedule.
+
+    Args:
+        user_id (str): The ID of the user creating the rule.
+        amount (Money): The amount of each record, positive for gains and
+            negative for expenses.
+        description (str): The description of each record.
+        schedule (str): The schedule, such as '0 9 5 * *' (09:00 on the 5th
+            of every month).
+        currency (str, optional): The currency of the amount (default: the
+            base currency).
+
+    Returns:
+        RecurringRule: The created rule.
+
+    Raises:
+        ValueError: If the schedule is not valid.
+        Exception: If the user_id is not found, raises an Exception.
+
+    Example:
+        >>> create_recurring_rule("123", Money(-150000), "Rent", "0 9 5 * *")
+        <RecurringRule object at 0x...>
+    """
+    with unit_of_work():
+        get_user(user_id)
+        rule = RecurringRule.create(user_id, amount, description, schedule, currency)
+
+    return rule
+
+
+def get_recurring_rules(user_id: str) -> list[RecurringRule]:
+    """
+    Get the recurring rules of a user.
+
+    Args:
+        user_id (str): The ID of the user.
+
+    Returns:
+        list[RecurringRule]: The rules of the user, oldest first.
+
+    Example:
+        >>> get_recurring_rules("123")
+        [<RecurringRule object at 0x...>, ...]
+    """
+    return RecurringRule.get_all(user_id)
+
+
+def delete_recurring_rule(user_id: str, rule_id: int) -> bool:
+    """
+    Delete a recurring rule of a user. Records it already registered are
+    kept.
+
+    Args:
+        user_id (str): The ID of the user.
+        rule_id (int): The ID of the rule.
+
+    Returns:
+        bool: `True` if the rule was deleted, `False` if the user has no such
+        rule.
+
+    Example:
+        >>> delete_recurring_rule("123", 1)
+        True
+    """
+    return RecurringRule.delete(user_id, rule_id)
+
+
+def create_category_rule(user_id: str, category: str, kind: str, pattern: str) -> CategoryRule:
+    """
+    Create a category rule, and label the records of the user again with it.
+
+    New records are labeled with the rule right away. Existing records are
+    labeled again in the background once the rule is committed, see
+    `categories.relabel`.
+
+    Args:
+        user_id (str): The ID of the user creating the rule.
+        category (str): The category the rule labels records with.
+        kind (str): `"keyword"`, matched as a whole word, or `"regex"`.
+        pattern (str): The keyword or the regular expression.
+
+    Returns:
+        CategoryRule: The created rule.
+
+    Raises:
+        ValueError: If the rule is not valid, or the user has too many rules.
+        Exception: If the user_id is not found, raises an Exception.
+
+    Example:
+        >>> create_category_rule("123", "transport", "keyword", "uber")
+        <CategoryRule object at 0x...>
+    """
+    with unit_of_work():
+        get_user(user_id)
+        rule = CategoryRule.create(user_id, category, kind, pattern)
+        after_commit(lambda: request_relabel(user_id))
+
+    return rule
+
+
+def get_category_rules(user_id: str) -> list[CategoryRule]:
+    """
+    Get the category rules of a user.
+
+    Args:
+        user_id (str): The ID of the user.
+
+    Returns:
+        list[CategoryRule]: The rules of the user, oldest first, which is
+        their order of priority.
+
+    Example:
+        >>> get_category_rules("123")
+        [<CategoryRule object at 0x...>, ...]
+    """
+    return CategoryRule.get_all(user_id)
+
+
+def delete_category_rule(user_id: str, rule_id: int) -> bool:
+    """
+    Delete a category rule of a user, and label the records of the user
+    again without it, in the background.
+
+    Args:
+        user_id (str): The ID of the user.
+        rule_id (int): The ID of the rule.
+
+    Returns:
+        bool: `True` if the rule was deleted, `False` if the user has no such
+        rule.
+
+    Example:
+        >>> delete_category_rule("123", 1)
+        True
+    """
+    with unit_of_work():
+        deleted = CategoryRule.delete(user_id, rule_id)
+        if deleted:
+            after_commit(lambda: request_relabel(user_id))
+
+    return deleted
+
+
+def get_category_totals(user_id: str, since: datetime | None = None, until: datetime | None = None,
+                        currency: str = fx_config["base_currency"]) -> list[dict[str, Any]]:
+    """
+    Get the income, expenses, net result and number of records of each
+    category of a user, over the records that were not archived.
+
+    Args:
+        user_id (str): The ID of the user.
+        since (datetime | None, optional): Only count records created at or
+            after this datetime, or `None` for the start of the current month
+            (default: None).
+        until (datetime | None, optional): Only count records created before
+            this datetime, or `None` for no limit (default: None).
+        currency (str, optional): The currency of the totals (default: the
+            base currency).
+
+    Returns:
+        list[dict[str, Any]]: The totals of each category, in units of
+        `currency`, with the uncategorized records last under a `None`
+        category.
+
+    Raises:
+        fx.UnknownCurrency: If a currency has no exchange rates.
+
+    Example:
+        >>> get_category_totals("123")
+        [
+            {"category": "food", "income": 0.0, "expenses": 842.5, "net": -842.5, "records": 31},
+            {"category": None, "income": 5000.0, "expenses": 12.0, "net": 4988.0, "records": 3}
+        ]
+    """
+    since = since or datetime.combine(date.today().replace(day=1), datetime.min.time())
+    until = until or datetime.max
+
+    return [
+        {
+            "category": category,
+            "income": income.to_float(),
+            "expenses": expenses.to_float(),
+            "net": (income - expenses).to_float(),
+            "records": records,
+        }
+        for category, income, expenses, records in Record.get_category_totals(user_id, since, until, currency)
+    ]
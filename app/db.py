@@ -1,13 +1,35 @@
+import itertools
+import json
+import logging
+import random
 import time
 import os
+import threading
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from datetime import date, datetime
+from typing import Callable, Iterator
 
-from flask import g
 import psycopg2
-from psycopg2 import pool
+from psycopg2 import errors, extensions, pool, sql
 from dotenv import load_dotenv
 
+import metrics
+import tracing
+from sqlite_db import SqliteDatabase
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+engine_config = {
+    "engine": os.getenv("DB_ENGINE", "postgres"),
+    "sqlite_path": os.getenv("SQLITE_PATH", "registraai.db"),
+}
+
 db_config = {
     "minconn": 1,
     "maxconn": 10,
@@ -17,46 +39,565 @@ db_config = {
     "host": os.getenv("POSTGRES_HOST")
 }
 
+replica_config = {
+    "primary_dsn": os.getenv("POSTGRES_DSN"),
+    "replica_dsns": [dsn.strip() for dsn in os.getenv("POSTGRES_REPLICA_DSNS", "").split(",") if dsn.strip()],
+    "max_lag": float(os.getenv("REPLICA_MAX_LAG", 5)),
+    "lag_check_interval": float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", 1)),
+    "retry_interval": float(os.getenv("REPLICA_RETRY_INTERVAL", 10)),
+    "sticky_seconds": float(os.getenv("REPLICA_STICKY_SECONDS", 5)),
+    "max_sticky_users": 100000,
+}
+
+pool_config = {
+    "max_wait": float(os.getenv("POOL_MAX_WAIT", 5)),
+    "max_lifetime": float(os.getenv("POOL_MAX_LIFETIME", 30 * 60)),
+    "ping_interval": float(os.getenv("POOL_PING_INTERVAL", 30)),
+    "statement_timeout_ms": int(os.getenv("STATEMENT_TIMEOUT_MS", 5000)),
+    "read_retries": 1,
+    "connect_attempts": int(os.getenv("DB_CONNECT_ATTEMPTS", 8)),
+    "backoff_base": float(os.getenv("DB_BACKOFF_BASE", 0.1)),
+    "backoff_max": float(os.getenv("DB_BACKOFF_MAX", 5)),
+}
+
+partition_config = {
+    "months_ahead": int(os.getenv("RECORD_PARTITIONS_AHEAD", 3)),
+}
+
+shard_config = {
+    "dsns": [dsn.strip() for dsn in os.getenv("POSTGRES_SHARD_DSNS", "").split(",") if dsn.strip()],
+    "directory_refresh_interval": float(os.getenv("SHARD_DIRECTORY_REFRESH_INTERVAL", 5)),
+}
+
+# Queries that never write and can be served by a read replica
+read_only_queries = {
+    "get_records.sql",
+    "get_records_between.sql",
+    "get_archived_records.sql",
+    "get_category_rules.sql",
+    "get_recurring_rules.sql",
+    "select_balance.sql",
+    "select_bootstrap.sql",
+    "select_carry_forward.sql",
+    "select_category_totals.sql",
+    "select_record_columns.sql",
+    "select_user_by_id.sql",
+}
+
+_pool_lock = threading.Lock()
+
+# Set once `init_db` finished
+_ready = threading.Event()
+
+# The unit of work of the current request, if any
+_current_unit_of_work: ContextVar["UnitOfWork | None"] = ContextVar("unit_of_work", default=None)
+
+sqlite_database = SqliteDatabase(engine_config["sqlite_path"]) \
+    if engine_config["engine"] == "sqlite" else None
+
+
+class PoolTimeout(pool.PoolError):
+    """
+    Raised when no connection of a pool becomes available within
+    `pool_config["max_wait"]` seconds.
+    """
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of connections to a Postgres server.
+
+    Unlike psycopg2's pools, which fail immediately when all connections are
+    in use, a checkout waits up to `pool_config["max_wait"]` seconds for a
+    connection to be returned. Idle connections are reused most recent first.
+    Connections older than `pool_config["max_lifetime"]` seconds are
+    replaced, and connections idle for longer than
+    `pool_config["ping_interval"]` seconds are checked with a cheap query
+    before being handed out, so a connection dropped by the server or a
+    proxy is replaced instead of failing a request. Every connection runs
+    with a `statement_timeout` of `pool_config["statement_timeout_ms"]`.
+
+    Attributes:
+        minconn (int): How many connections are opened upfront.
+        maxconn (int): The maximum number of open connections.
+        waiting (int): How many threads are waiting for a connection.
+
+    Methods:
+        getconn: Check out a connection.
+        putconn: Return a connection to the pool.
+        closeall: Close the idle connections.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, dsn: str | None = None, **kwargs) -> None:
+        """
+        Initialize a ConnectionPool object and open `minconn` connections.
+
+        Args:
+            minconn (int): How many connections are opened upfront.
+            maxconn (int): The maximum number of open connections.
+            dsn (str | None, optional): The connection string of the server
+                (default: None).
+            **kwargs: Connection parameters, used instead of or on top of
+                `dsn`.
+
+        Raises:
+            psycopg2.OperationalError: If the server can't be reached.
+        """
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.waiting = 0
+        self._dsn = dsn
+        self._kwargs = kwargs
+        self._idle: deque[tuple[extensions.connection, float]] = deque()
+        self._created_at: dict[int, float] = {}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self) -> extensions.connection:
+        options = f"-c statement_timeout={pool_config['statement_timeout_ms']}"
+        conn = psycopg2.connect(self._dsn, options=options, **self._kwargs)
+        with self._lock:
+            self._created_at[id(conn)] = time.monotonic()
+        return conn
+
+    def _close(self, conn: extensions.connection) -> None:
+        with self._lock:
+            self._created_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_expired(self, conn: extensions.connection) -> bool:
+        created_at = self._created_at.get(id(conn), float("-inf"))
+        return time.monotonic() - created_at > pool_config["max_lifetime"]
+
+    def _is_usable(self, conn: extensions.connection, returned_at: float) -> bool:
+        if conn.closed or self._is_expired(conn):
+            return False
+        if time.monotonic() - returned_at < pool_config["ping_interval"]:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(load_query("ping.sql"))
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self) -> extensions.connection:
+        """
+        Check out a connection, waiting for one to be returned if all
+        `maxconn` connections are in use.
+
+        The time spent waiting is recorded in the `db_pool_wait_seconds`
+        metric.
+
+        Returns:
+            connection: A psycopg2 connection, to be returned with `putconn`.
+
+        Raises:
+            PoolTimeout: If no connection became available in time.
+            psycopg2.OperationalError: If a new connection can't be opened.
+        """
+        start = time.perf_counter()
+        with self._lock:
+            self.waiting += 1
+        try:
+            acquired = self._slots.acquire(timeout=pool_config["max_wait"])
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        metrics.db_pool_wait.observe(time.perf_counter() - start)
+
+        if not acquired:
+            raise PoolTimeout(f"No connection available after {pool_config['max_wait']} seconds")
+
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn, returned_at = self._idle.pop()
+                if self._is_usable(conn, returned_at):
+                    return conn
+                self._close(conn)
+            return self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn: extensions.connection, close: bool = False) -> None:
+        """
+        Return a connection to the pool.
+
+        An open transaction is rolled back. Broken and expired connections
+        are closed instead of being kept.
+
+        Args:
+            conn (connection): A connection checked out with `getconn`.
+            close (bool, optional): Close the connection instead of keeping
+                it (default: False).
+        """
+        try:
+            if not close and not conn.closed:
+                status = conn.info.transaction_status
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    close = True
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+        except psycopg2.Error:
+            close = True
+
+        try:
+            if close or conn.closed or self._is_expired(conn):
+                self._close(conn)
+            else:
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def closeall(self) -> None:
+        """
+        Close the idle connections.
+        """
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self._close(conn)
+
 
-def load_query(name: str) -> str:
+class Replica:
+    """
+    A read replica with its own connection pool and health state.
+
+    The pool is created on first use. A replica is skipped while it is marked
+    as down after a connection error, or while its replication lag is above
+    `replica_config["max_lag"]`.
+
+    Attributes:
+        dsn (str): The connection string of the replica.
+        connection_pool (ConnectionPool | None): The pool of connections to
+            the replica, if already created.
+        down_until (float): Monotonic time until which the replica is skipped.
+        lag (float): The last measured replication lag, in seconds.
+        lag_checked_at (float): Monotonic time of the last lag measurement.
+    """
+
+    def __init__(self, dsn: str) -> None:
+        """
+        Initialize a Replica object.
+
+        Args:
+            dsn (str): The connection string of the replica.
+        """
+        self.dsn = dsn
+        self.connection_pool: ConnectionPool | None = None
+        self.down_until = 0.0
+        self.lag = 0.0
+        self.lag_checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get_pool(self) -> ConnectionPool:
+        """
+        Get the connection pool of the replica, creating it if needed.
+
+        Returns:
+            ConnectionPool: The pool of connections to the replica.
+
+        Raises:
+            psycopg2.OperationalError: If the replica can't be reached.
+        """
+        with self._lock:
+            if self.connection_pool is None:
+                self.connection_pool = ConnectionPool(
+                    db_config["minconn"], db_config["maxconn"], self.dsn)
+            return self.connection_pool
+
+    def is_available(self) -> bool:
+        """
+        Check whether the replica can serve reads.
+
+        The replication lag is measured at most once every
+        `replica_config["lag_check_interval"]` seconds.
+
+        Returns:
+            bool: `True` if the replica is up and not lagging behind.
+        """
+        now = time.monotonic()
+        if now < self.down_until:
+            return False
+
+        if now - self.lag_checked_at >= replica_config["lag_check_interval"]:
+            self.lag_checked_at = now
+            try:
+                result = _execute(self.get_pool(), load_query("select_replica_lag.sql"))
+                self.lag = float(result[0][0]) # type: ignore
+            except PoolTimeout:
+                # Busy, not down: skip it for this query only
+                self.lag_checked_at = 0.0
+                return False
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, pool.PoolError):
+                self.mark_down()
+                return False
+
+        return self.lag <= replica_config["max_lag"]
+
+    def mark_down(self) -> None:
+        """
+        Skip the replica for `replica_config["retry_interval"]` seconds.
+        """
+        self.down_until = time.monotonic() + replica_config["retry_interval"]
+
+
+class Shard:
+    """
+    A database holding a subset of the users and their records.
+
+    Each shard has its own connection pool to its primary and, optionally,
+    read replicas. Without sharding there is a single shard.
+
+    Attributes:
+        index (int): The position of the shard in `shards`.
+        dsn (str | None): The connection string of the primary, or `None` to
+            use the connection parameters in `db_config`.
+        connection_pool (ConnectionPool | None): The pool of connections to
+            the primary, if already created.
+        replicas (list[Replica]): The read replicas of the shard.
+    """
+
+    def __init__(self, index: int, dsn: str | None, replica_dsns: list[str]) -> None:
+        """
+        Initialize a Shard object.
+
+        Args:
+            index (int): The position of the shard in `shards`.
+            dsn (str | None): The connection string of the primary, or `None`
+                to use the connection parameters in `db_config`.
+            replica_dsns (list[str]): The connection strings of the replicas.
+        """
+        self.index = index
+        self.dsn = dsn
+        self.connection_pool: ConnectionPool | None = None
+        self.replicas = [Replica(replica_dsn) for replica_dsn in replica_dsns]
+        self._replica_counter = itertools.count()
+
+    def get_pool(self) -> ConnectionPool:
+        """
+        Get the connection pool of the primary, creating it if needed.
+
+        Returns:
+            ConnectionPool: The pool of connections to the primary.
+
+        Raises:
+            psycopg2.OperationalError: If the primary can't be reached.
+        """
+        with _pool_lock:
+            if self.connection_pool is None:
+                if self.dsn:
+                    self.connection_pool = ConnectionPool(
+                        db_config["minconn"], db_config["maxconn"], self.dsn)
+                else:
+                    self.connection_pool = ConnectionPool(**db_config)
+            return self.connection_pool
+
+    def execute_on_replica(self, query: str, values: tuple) -> tuple[bool, None|list[tuple]]:
+        """
+        Try to execute a read-only query on one of the available replicas.
+
+        Replicas are tried in round-robin order. A replica that fails with a
+        connection error is marked as down and the next one is tried. A
+        replica whose pool has no free connection within
+        `pool_config["max_wait"]` seconds is only skipped, since it is busy
+        rather than down, and marking it down would move its load to the
+        primary. A query cancelled by the statement timeout is not retried.
+
+        Args:
+            query (str): The SQL statement to execute.
+            values (tuple): The parameter values for the query.
+
+        Returns:
+            tuple[bool, None|list[tuple]]: Whether a replica executed the
+            query, and its result.
+        """
+        start = next(self._replica_counter)
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            if not replica.is_available():
+                continue
+
+            try:
+                return True, _execute(replica.get_pool(), query, values)
+            except errors.QueryCanceled:
+                raise
+            except PoolTimeout:
+                continue
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, pool.PoolError):
+                replica.mark_down()
+
+        return False, None
+
+
+if shard_config["dsns"]:
+    shards = [Shard(i, dsn, []) for i, dsn in enumerate(shard_config["dsns"])]
+else:
+    shards = [Shard(0, replica_config["primary_dsn"], replica_config["replica_dsns"])]
+
+# Users moved away from their hashed shard, kept in the `user_shards` table of
+# the first shard
+_directory: dict[str, int] = {}
+_directory_loaded_at = float("-inf")
+_directory_lock = threading.Lock()
+
+# Monotonic time of the last write of each user, for read-your-writes within
+# this process. Requests carry the time of their user's last write in the
+# session too (see `UnitOfWork.primary_reads`), for the other processes.
+_last_writes: OrderedDict[str, float] = OrderedDict()
+_last_writes_lock = threading.Lock()
+
+
+def load_query(name: str, dialect: str | None = None) -> str:
     """
     Load an SQL query from a file.
 
     This function reads an SQL query from a file in the 'sql' directory based on the given name.
+    Queries for other databases than Postgres are read from a subdirectory
+    named after the dialect, such as 'sql/sqlite'.
 
     Args:
         name (str): The name of the SQL query file (without the file extension).
+        dialect (str | None, optional): The SQL dialect of the query, or `None`
+            for Postgres (default: None).
 
     Returns:
         str: The contents of the SQL query as a string.
     """
     current_dir = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(current_dir, "sql", name)
+    file_path = os.path.join(current_dir, "sql", *filter(None, [dialect]), name)
 
     with open(file_path, 'r') as file:
         query = file.read()
     return query
 
 
-def execute_query(query:str, values:tuple = ()) -> None|list[tuple]:
+def hash_shard(user_id: str) -> int:
     """
-    Execute an SQL query with optional parameters.
+    Get the shard a user is assigned to by hashing their ID.
+
+    Args:
+        user_id (str): The ID of the user.
+
+    Returns:
+        int: The index of the shard in `shards`.
+    """
+    return zlib.crc32(user_id.encode()) % len(shards)
+
+
+def refresh_directory(force: bool = False) -> None:
+    """
+    Reload the users moved away from their hashed shard.
 
-    This function executes the given SQL query with optional parameter values.
+    The directory is reloaded at most once every
+    `shard_config["directory_refresh_interval"]` seconds, unless `force` is
+    set.
 
     Args:
-        query (str): The SQL query to execute.
+        force (bool, optional): Reload even if the directory is recent
+            (default: False).
+    """
+    global _directory, _directory_loaded_at
+    if len(shards) == 1:
+        return
+
+    now = time.monotonic()
+    if not force and now - _directory_loaded_at < shard_config["directory_refresh_interval"]:
+        return
+
+    with _directory_lock:
+        if not force and now - _directory_loaded_at < shard_config["directory_refresh_interval"]:
+            return
+
+        result = _execute(shards[0].get_pool(), load_query("select_user_shards.sql"))
+        _directory = {user_id: shard for user_id, shard in result or []}
+        _directory_loaded_at = time.monotonic()
+
+
+def reload_user_shard(user_id: str) -> bool:
+    """
+    Reload the directory when a user was not found in their shard, in case
+    another process moved them since it was loaded.
+
+    Args:
+        user_id (str): The ID of the user.
+
+    Returns:
+        bool: `True` if the shard of the user changed, and the query should
+        be retried.
+    """
+    if len(shards) == 1:
+        return False
+
+    shard = shard_for(user_id)
+    refresh_directory(force=True)
+    return shard_for(user_id) != shard
+
+
+def shard_for(user_id: str | None) -> int:
+    """
+    Get the shard that holds a user's data.
+
+    Users are assigned to a shard by hashing their ID, unless they were moved
+    to another shard by the rebalancing tool. Queries that aren't about a
+    user go to the first shard.
+
+    Args:
+        user_id (str | None): The ID of the user.
+
+    Returns:
+        int: The index of the shard in `shards`.
+
+    Example:
+        >>> shard_for("123")
+        1
+    """
+    if user_id is None or len(shards) == 1:
+        return 0
+
+    refresh_directory()
+    shard = _directory.get(user_id)
+    if shard is None:
+        shard = hash_shard(user_id)
+    return shard
+
+
+def _execute(connection_pool: ConnectionPool, query: str, values: tuple = ()) -> None|list[tuple]:
+    """
+    Execute an SQL statement on a connection from the given pool.
+
+    Connections that fail with a connection error are closed instead of being
+    returned to the pool. Queries cancelled by the statement timeout keep
+    their connection.
+
+    Args:
+        connection_pool (ConnectionPool): The pool to get the connection
+            from.
+        query (str): The SQL statement to execute.
         values (tuple, optional): The parameter values for the query (default: ()).
 
     Returns:
         None|list[tuple]: The result of the query, either a list of tuples or
         None.
     """
-    conn = g.connection_pool.getconn()
+    conn = connection_pool.getconn()
     cursor = conn.cursor()
     result = None
-
-    query = load_query(query)
+    broken = False
 
     try:
         if values:
@@ -66,72 +607,861 @@ def execute_query(query:str, values:tuple = ()) -> None|list[tuple]:
         conn.commit()
         if cursor.description:
             result = cursor.fetchall()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        broken = not isinstance(e, errors.QueryCanceled)
+        raise
     finally:
-        cursor.close()
-        g.connection_pool.putconn(conn)
+        if not conn.closed:
+            cursor.close()
+        connection_pool.putconn(conn, close=broken)
 
     return result
 
 
+def _is_sticky(user_id: str | None) -> bool:
+    """
+    Check whether the reads of a user must go to the primary.
+
+    Reads are pinned to the primary for `replica_config["sticky_seconds"]`
+    after the user's last write, so that users always see their own writes
+    even if the replicas are slightly behind.
+
+    Args:
+        user_id (str | None): The ID of the user the query is for.
+
+    Returns:
+        bool: `True` if the reads of the user must go to the primary.
+    """
+    if user_id is None:
+        return False
+
+    with _last_writes_lock:
+        last_write = _last_writes.get(user_id)
+    return last_write is not None and \
+        time.monotonic() - last_write < replica_config["sticky_seconds"]
+
+
+def _record_write(user_id: str) -> None:
+    """
+    Record that a user just wrote to the primary.
+
+    Args:
+        user_id (str): The ID of the user that wrote.
+    """
+    with _last_writes_lock:
+        _last_writes[user_id] = time.monotonic()
+        _last_writes.move_to_end(user_id)
+        while len(_last_writes) > replica_config["max_sticky_users"]:
+            _last_writes.popitem(last=False)
+
+
+def execute_query(query:str, values:tuple = (), user_id: str | None = None,
+                  shard: int | None = None) -> None|list[tuple]:
+    """
+    Execute an SQL query with optional parameters.
+
+    This function executes the given SQL query with optional parameter values
+    on the shard that holds the data of `user_id`. Queries listed in
+    `read_only_queries` are routed to a read replica of the shard when one is
+    configured and available, and fall back to the primary when all replicas
+    are down or lagging. Any other query goes to the primary. Read-only
+    queries that fail because their connection broke are retried up to
+    `pool_config["read_retries"]` times on a fresh connection.
+
+    With the SQLite engine, the SQLite version of the query is executed on
+    the embedded database instead, and there are no shards or replicas.
+
+    Inside a unit of work (see `unit_of_work`), the query runs on the
+    connection pinned by the unit of work and is committed with it.
+
+    The latency, returned rows and errors of each query file are recorded in
+    the `db_query_*` metrics, and the query is a span of the request trace.
+
+    Args:
+        query (str): The SQL query to execute.
+        values (tuple, optional): The parameter values for the query (default: ()).
+        user_id (str | None, optional): The ID of the user the query reads or
+            writes. It selects the shard, and writes of a user make their next
+            reads go to the primary for a while, so they can read their own
+            writes (default: None).
+        shard (int | None, optional): Execute on this shard instead of the
+            one selected by `user_id` (default: None).
+
+    Returns:
+        None|list[tuple]: The result of the query, either a list of tuples or
+        None.
+    """
+    name = query
+    start = time.perf_counter()
+    try:
+        with tracing.span(f"db {name}", **{"db.query": name}) as span:
+            result = _route_query(name, values, user_id, shard)
+            if span is not None:
+                span.attributes["db.rows"] = len(result) if result else 0
+    except Exception as e:
+        metrics.db_query_errors.inc(name, type(e).__name__)
+        raise
+
+    metrics.db_query_duration.observe(time.perf_counter() - start, name)
+    if result:
+        metrics.db_query_rows.inc(name, amount=len(result))
+    return result
+
+
+def _route_query(name: str, values: tuple, user_id: str | None,
+                 shard: int | None) -> None|list[tuple]:
+    """
+    Execute a query file on the database selected for it.
+
+    See `execute_query` for how the database is selected.
+
+    Args:
+        name (str): The name of the SQL query file.
+        values (tuple): The parameter values for the query.
+        user_id (str | None): The ID of the user the query reads or writes.
+        shard (int | None): Execute on this shard instead of the one selected
+            by `user_id`.
+
+    Returns:
+        None|list[tuple]: The result of the query, either a list of tuples or
+        None.
+    """
+    read_only = name in read_only_queries
+    unit = _current_unit_of_work.get()
+    if sqlite_database is not None:
+        query = load_query(name, "sqlite")
+        # Reads that come before the first write keep using the reader
+        # connection, so read-only requests never take the write lock
+        if unit is not None and not (read_only and not unit.has_connection(None)):
+            return unit.execute(None, query, values, read_only, user_id)
+        return sqlite_database.execute(query, values, read_only)
+
+    query = load_query(name)
+    if shard is None:
+        shard = shard_for(user_id)
+    target = shards[shard]
+
+    if read_only and target.replicas and not _is_sticky(user_id) and \
+            (unit is None or not (unit.primary_reads or unit.has_connection(shard))):
+        executed, result = target.execute_on_replica(query, values)
+        if executed:
+            return result
+
+    if unit is not None:
+        return unit.execute(shard, query, values, read_only, user_id)
+
+    retries = pool_config["read_retries"] if read_only else 0
+    for attempt in range(retries + 1):
+        try:
+            result = _execute(target.get_pool(), query, values)
+            break
+        except errors.QueryCanceled:
+            raise
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if attempt == retries:
+                raise
+            logger.warning("Retrying %s after a broken connection: %s", name, e)
+
+    if not read_only and user_id is not None:
+        _record_write(user_id)
+    return result
+
+
+def execute_on_all_shards(query: str, values: tuple = ()) -> list[tuple]:
+    """
+    Execute an SQL query on the primary of every shard in parallel.
+
+    This is meant for admin queries that need data from all users, such as
+    reports and maintenance statements.
+
+    Args:
+        query (str): The SQL query to execute.
+        values (tuple, optional): The parameter values for the query (default: ()).
+
+    Returns:
+        list[tuple]: The rows returned by all shards, in shard order.
+
+    Example:
+        >>> execute_on_all_shards("shard_stats.sql")
+        [(10, 1520), (12, 1730)]
+    """
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        results = executor.map(
+            lambda shard: execute_query(query, values, shard=shard.index), shards)
+        return [row for result in results for row in result or []]
+
+
+@contextmanager
+def shard_connection(shard: int, statement_timeout: bool = True) -> Iterator:
+    """
+    Borrow a connection to the primary of a shard.
+
+    The connection is not committed automatically, which allows running
+    several statements in one transaction.
+
+    Args:
+        shard (int): The index of the shard in `shards`.
+        statement_timeout (bool, optional): Whether the statements of the
+            first transaction are subject to the pool's statement timeout.
+            Maintenance jobs that move a lot of rows disable it
+            (default: True).
+
+    Yields:
+        connection: A psycopg2 connection to the primary of the shard.
+    """
+    connection_pool = shards[shard].get_pool()
+    conn = connection_pool.getconn()
+    try:
+        if not statement_timeout:
+            with conn.cursor() as cursor:
+                cursor.execute(load_query("disable_statement_timeout.sql"))
+        yield conn
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        connection_pool.putconn(conn, close=bool(conn.closed))
+
+
+class UnitOfWork:
+    """
+    The queries of a request, executed in one transaction per database.
+
+    The first query that needs a database checks out a connection, which
+    every later query on that database reuses until the unit of work is
+    committed or rolled back, so a request borrows at most one connection
+    per shard and commits once. Read-only queries that run before that still
+    go to a read replica when one is available, or to the reader connection
+    with SQLite. Queries are not retried on a broken connection, since the
+    transaction is lost with it; the pool tests idle connections before
+    lending them instead.
+
+    Writes to several shards are committed one shard after the other, so
+    they are not atomic across shards.
+
+    Attributes:
+        primary_reads (bool): Whether read-only queries skip the replicas,
+            such as for a user that wrote recently through another process.
+
+    Methods:
+        has_connection: Check whether a database is pinned.
+        has_writes: Check whether a query wrote data of a user.
+        execute: Execute a query on the pinned connection of a database.
+        after_commit: Run a function once the changes are committed.
+        after_rollback: Run a function once the changes are rolled back.
+        commit: Commit and release the connections.
+        rollback: Roll back and release the connections.
+    """
+
+    def __init__(self, primary_reads: bool = False) -> None:
+        """
+        Initialize an empty UnitOfWork object.
+
+        Args:
+            primary_reads (bool, optional): Whether read-only queries skip the
+                replicas (default: False).
+        """
+        self.primary_reads = primary_reads
+        self._stack = ExitStack()
+        # Pinned connections, by shard (`None` for SQLite)
+        self._connections: dict[int | None, object] = {}
+        self._written_users: set[str] = set()
+        self._after_commit: list[Callable[[], None]] = []
+        self._after_rollback: list[Callable[[], None]] = []
+
+    def has_connection(self, shard: int | None) -> bool:
+        """
+        Check whether a connection to a database is pinned.
+
+        Args:
+            shard (int | None): The index of the shard, or `None` for SQLite.
+
+        Returns:
+            bool: `True` if a query already ran on the database.
+        """
+        return shard in self._connections
+
+    def has_writes(self) -> bool:
+        """
+        Check whether a query of the unit of work wrote data of a user.
+
+        Returns:
+            bool: `True` if a query that is not read-only ran for a user.
+        """
+        return bool(self._written_users)
+
+    def execute(self, shard: int | None, query: str, values: tuple, read_only: bool,
+                user_id: str | None) -> None|list[tuple]:
+        """
+        Execute an SQL statement on the pinned connection of a database,
+        checking one out first if needed.
+
+        Args:
+            shard (int | None): The index of the shard, or `None` for SQLite.
+            query (str): The SQL statement to execute.
+            values (tuple): The parameter values for the query.
+            read_only (bool): Whether the query never writes.
+            user_id (str | None): The ID of the user the query is for.
+
+        Returns:
+            None|list[tuple]: The result of the query, either a list of
+            tuples or None.
+        """
+        conn = self._connections.get(shard)
+        if conn is None:
+            if sqlite_database is not None:
+                conn = self._stack.enter_context(sqlite_database.transaction())
+            else:
+                conn = self._stack.enter_context(shard_connection(shard))
+            self._connections[shard] = conn
+
+        if sqlite_database is not None:
+            result = sqlite_database.execute(query, values, connection=conn)
+        else:
+            with conn.cursor() as cursor:
+                if values:
+                    cursor.execute(query, values)
+                else:
+                    cursor.execute(query)
+                result = cursor.fetchall() if cursor.description else None
+
+        if not read_only and user_id is not None:
+            self._written_users.add(user_id)
+        return result
+
+    def after_commit(self, function: Callable[[], None]) -> None:
+        """
+        Run a function once the changes of the unit of work are committed.
+
+        Args:
+            function (Callable[[], None]): The function to run.
+        """
+        self._after_commit.append(function)
+
+    def after_rollback(self, function: Callable[[], None]) -> None:
+        """
+        Run a function once the changes of the unit of work are rolled back.
+
+        Args:
+            function (Callable[[], None]): The function to run.
+        """
+        self._after_rollback.append(function)
+
+    def commit(self) -> None:
+        """
+        Commit the changes and release the connections.
+
+        If a commit fails, the connections are rolled back and released, and
+        the error is raised.
+        """
+        _current_unit_of_work.set(None)
+        with tracing.span("db commit", connections=len(self._connections)):
+            try:
+                for conn in self._connections.values():
+                    conn.commit()
+            except BaseException as e:
+                # The connections roll back when they see the error
+                self._stack.__exit__(type(e), e, e.__traceback__)
+                for function in self._after_rollback:
+                    function()
+                raise
+            self._stack.close()
+
+        for user_id in self._written_users:
+            _record_write(user_id)
+        for function in self._after_commit:
+            function()
+
+    def rollback(self) -> None:
+        """
+        Roll back the changes and release the connections.
+        """
+        _current_unit_of_work.set(None)
+        for conn in self._connections.values():
+            try:
+                conn.rollback()
+            except Exception as e:
+                logger.warning("Rollback failed: %s", e)
+        self._stack.close()
+
+        for function in self._after_rollback:
+            function()
+
+
+def begin(primary_reads: bool = False) -> UnitOfWork:
+    """
+    Start a unit of work for the current request.
+
+    Until it is committed or rolled back, `execute_query` runs the queries of
+    the request in it.
+
+    Args:
+        primary_reads (bool, optional): Whether read-only queries skip the
+            replicas, such as when the user wrote in the last
+            `replica_config["sticky_seconds"]` seconds (default: False).
+
+    Returns:
+        UnitOfWork: The unit of work.
+
+    Example:
+        >>> unit = begin()
+        >>> execute_query("insert_record.sql", values, user_id="123")
+        >>> unit.commit()
+    """
+    unit = UnitOfWork(primary_reads)
+    _current_unit_of_work.set(unit)
+    return unit
+
+
+def current_unit_of_work() -> UnitOfWork | None:
+    """
+    Get the unit of work of the current request.
+
+    Returns:
+        UnitOfWork | None: The unit of work, or `None` outside of one.
+    """
+    return _current_unit_of_work.get()
+
+
+@contextmanager
+def unit_of_work() -> Iterator[UnitOfWork]:
+    """
+    Run the queries of a block in a unit of work.
+
+    The unit of work is committed when the block ends, or rolled back if it
+    raises. Inside another unit of work, such as the one of a request, the
+    block joins it instead, and the outer unit of work commits.
+
+    Yields:
+        UnitOfWork: The unit of work.
+
+    Example:
+        >>> with unit_of_work():
+        >>>     user = User.get("123")
+        >>>     user.gain(100.0, "Salary payment")
+    """
+    unit = _current_unit_of_work.get()
+    if unit is not None:
+        yield unit
+        return
+
+    unit = begin()
+    try:
+        yield unit
+    except BaseException:
+        unit.rollback()
+        raise
+    unit.commit()
+
+
+def after_commit(function: Callable[[], None]) -> None:
+    """
+    Run a function once the changes of the current unit of work are
+    committed, or right away outside of a unit of work.
+
+    Args:
+        function (Callable[[], None]): The function to run.
+    """
+    unit = _current_unit_of_work.get()
+    if unit is None:
+        function()
+    else:
+        unit.after_commit(function)
+
+
+def pool_waiting() -> int:
+    """
+    Get how many queries are waiting for a database connection.
+
+    This is the number of threads of this process waiting in the connection
+    pools of the primaries and replicas of all shards.
+
+    Returns:
+        int: The number of queries waiting for a connection.
+    """
+    pools = [shard.connection_pool for shard in shards] + \
+        [replica.connection_pool for shard in shards for replica in shard.replicas]
+    return sum(connection_pool.waiting for connection_pool in pools if connection_pool is not None)
+
+
+metrics.register(metrics.Gauge(
+    "db_pool_waiting", "Queries waiting for a database connection", pool_waiting))
+
+
 def init_db(app):
     """
     Initialize the database.
 
     This function initializes the database by creating the connection pool and
-    creating tables.
+    creating tables when the schema is not current. Once it returns,
+    `is_ready` is `True`.
 
     Args:
         app: The Flask application object.
     """
     with app.app_context():
         init_pool()
-        create_tables()
+        ensure_schema()
+        if sqlite_database is None:
+            for shard in shards:
+                create_record_partitions(shard.index)
+
+    _ready.set()
+
+
+def is_ready() -> bool:
+    """
+    Check whether the database is initialized.
+
+    Returns:
+        bool: `True` once `init_db` finished, so the schema is current and
+        the pools of the primaries have open connections.
+    """
+    return _ready.is_set()
 
 
 def init_pool():
     """
     Initialize the connection pool.
 
-    This function initializes the connection pool for database connections.
+    This function initializes the connection pools for database connections
+    to the primary of each shard. The pools are shared by the whole process,
+    so they are only created once. Connections to replicas are created on
+    first use.
+
+    While the database can't be reached, the connection is retried up to
+    `pool_config["connect_attempts"]` times with exponential backoff and full
+    jitter, so that many app processes starting together don't retry in
+    lockstep.
 
     Raises:
         RuntimeError: If the connection to the database fails after multiple
         attempts.
     """
-    if 'connection_pool' not in g:
-        max_attempts = 3
-        attempts = 0
-        connection_pool = None
+    if sqlite_database is not None:
+        return
 
-        while attempts < max_attempts:
+    for shard in shards:
+        if shard.connection_pool is not None:
+            continue
+
+        max_attempts = pool_config["connect_attempts"]
+
+        for attempt in range(1, max_attempts + 1):
             try:
-                connection_pool = pool.SimpleConnectionPool(**db_config)
+                shard.get_pool()
                 break
             except psycopg2.OperationalError as e:
-                attempts += 1
-                wait_time = attempts  # Increase the wait time with each attempt
-                print("\n"*2)
-                print(f"{str(e) = }")
-                print("\n"*2)
-                print(f"Attempt {attempts}/{max_attempts}: Database not ready, waiting {wait_time} seconds...")
+                if attempt == max_attempts:
+                    raise RuntimeError("Failed to connect to the database after multiple attempts.") from e
+
+                backoff = min(pool_config["backoff_max"], pool_config["backoff_base"] * 2 ** attempt)
+                wait_time = random.uniform(0, backoff)
+                logger.warning("Attempt %d/%d: Database not ready, waiting %.2f seconds: %s",
+                               attempt, max_attempts, wait_time, e)
                 time.sleep(wait_time)
 
-        if connection_pool is None:
-            raise RuntimeError("Failed to connect to the database after multiple attempts.")
 
-        g.connection_pool = connection_pool
+def schema_version() -> int:
+    """
+    Get the version of the schema defined by the code.
+
+    The version is a hash of the table definitions in 'create_tables.sql', so
+    any change to them changes the version.
+
+    Returns:
+        int: The schema version, a positive 31-bit integer.
+    """
+    dialect = "sqlite" if sqlite_database is not None else None
+    return zlib.crc32(load_query("create_tables.sql", dialect).encode()) & 0x7fffffff
+
+
+def ensure_schema() -> None:
+    """
+    Create the database tables on every shard where the schema is not
+    current.
+
+    Each database stores the version of the schema it was created with: in a
+    comment on the users table with Postgres, and in `user_version` with
+    SQLite. When it matches `schema_version`, the DDL is skipped, which makes
+    restarts faster and avoids taking locks on the tables. Otherwise the
+    tables are created, with Postgres the records table is partitioned if it
+    was created before partitioning, float amounts are converted to integer
+    cents, records get their category and currency columns, and recurring
+    rules get their currency column.
+    """
+    version = schema_version()
 
+    for shard in shards:
+        result = execute_query("select_schema_version.sql", shard=shard.index)
+        if result and str(result[0][0]) == str(version):
+            continue
+
+        logger.info("Updating the schema of shard %d to version %d", shard.index, version)
+        execute_query("create_tables.sql", shard=shard.index)
+
+        if sqlite_database is not None:
+            # PRAGMA statements don't take parameters
+            query = load_query("set_schema_version.sql", "sqlite").format(version=version)
+            migrate_amounts_to_cents(shard.index)
+            migrate_records_categories(shard.index)
+            migrate_records_currencies(shard.index)
+            migrate_recurring_rules_currencies(shard.index)
+            sqlite_database.execute(query)
+        else:
+            migrate_records_to_partitions(shard.index)
+            migrate_amounts_to_cents(shard.index)
+            migrate_records_categories(shard.index)
+            migrate_records_currencies(shard.index)
+            migrate_recurring_rules_currencies(shard.index)
+            execute_query("set_schema_version.sql", (str(version),), shard=shard.index)
+
+
+def month_start(value: date) -> date:
+    """
+    Get the first day of the month of a date.
+
+    Args:
+        value (date): The date.
+
+    Returns:
+        date: The first day of the month.
+    """
+    return date(value.year, value.month, 1)
+
+
+def add_months(value: date, months: int) -> date:
+    """
+    Get the first day of the month a number of months after a date.
+
+    Args:
+        value (date): The date.
+        months (int): How many months to add.
+
+    Returns:
+        date: The first day of the resulting month.
 
-def create_tables():
+    Example:
+        >>> add_months(date(2024, 11, 15), 3)
+        datetime.date(2025, 2, 1)
     """
-    Create database tables.
+    month = value.month - 1 + months
+    return date(value.year + month // 12, month % 12 + 1, 1)
 
-    This function creates the necessary tables in the database.
 
-    Note:
-        The SQL query for creating tables must be defined in a file named
-        'create_table_records.sql' and placed in the 'sql' directory.
+def _create_record_partition(conn, month: date) -> None:
+    """
+    Create the partition of the records table for a month, if needed.
+
+    If records of that month were stored in the default partition because
+    their partition didn't exist yet, they are moved into the new partition.
+
+    Args:
+        conn: A psycopg2 connection to the primary of a shard.
+        month (date): The first day of the month.
+    """
+    partition = sql.Identifier(f"records_{month:%Y_%m}")
+    bounds = (month, add_months(month, 1))
+
+    with conn.cursor() as cursor:
+        try:
+            query = sql.SQL(load_query("create_record_partition.sql")).format(partition=partition)
+            cursor.execute(query, bounds)
+            conn.commit()
+        except errors.CheckViolation:
+            conn.rollback()
+            query = sql.SQL(load_query("split_record_partition.sql")).format(partition=partition)
+            cursor.execute(query, bounds * 3)
+            conn.commit()
+
+
+def migrate_records_to_partitions(shard: int) -> None:
+    """
+    Convert the records table of a shard to a partitioned table, if needed.
+
+    Databases created before records were partitioned have a plain records
+    table. It is renamed, a table partitioned by month of `created_at` is
+    created in its place with one partition for each month with records, the
+    records are copied over and the old table is dropped, all in a single
+    transaction. Record IDs are kept.
+
+    Args:
+        shard (int): The index of the shard in `shards`.
+    """
+    with shard_connection(shard, statement_timeout=False) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(load_query("select_records_kind.sql"))
+            if cursor.fetchone()[0] != "r":
+                conn.rollback()
+                return
+
+            cursor.execute(load_query("migrate_records_partitioned.sql"))
+            cursor.execute(load_query("create_records_default_partition.sql"))
+
+            cursor.execute(load_query("select_unpartitioned_records_range.sql"))
+            first, last = cursor.fetchone()
+            if first is not None:
+                month = month_start(first)
+                while month <= last.date():
+                    query = sql.SQL(load_query("create_record_partition.sql")).format(
+                        partition=sql.Identifier(f"records_{month:%Y_%m}"))
+                    cursor.execute(query, (month, add_months(month, 1)))
+                    month = add_months(month, 1)
+
+            cursor.execute(load_query("copy_unpartitioned_records.sql"))
+        conn.commit()
+
+
+def get_table_columns(shard: int, tables: tuple[str, ...]) -> dict[str, set[str]]:
+    """
+    Get the columns of some tables of a shard.
+
+    Migrations check the columns of each table they change, since
+    'create_tables.sql' runs before them and creates the tables a database
+    didn't have yet with their current columns.
+
+    Args:
+        shard (int): The index of the shard in `shards`.
+        tables (tuple[str, ...]): The names of the tables.
+
+    Returns:
+        dict[str, set[str]]: The names of the columns of each table, empty
+        for tables that don't exist.
+    """
+    values = (json.dumps(tables),) if sqlite_database is not None else (list(tables),)
+    columns: dict[str, set[str]] = {table: set() for table in tables}
+    for table, column in execute_query("select_table_columns.sql", values, shard=shard) or []:
+        columns[table].add(column)
+    return columns
+
+
+def run_migrations(shard: int, names: list[str]) -> None:
+    """
+    Run migration scripts on a shard, in a single transaction.
+
+    Args:
+        shard (int): The index of the shard in `shards`.
+        names (list[str]): The names of the SQL files of the scripts, in the
+            order they run.
+    """
+    if sqlite_database is not None:
+        # Joined into one script, so `executescript` runs them in one transaction
+        sqlite_database.execute("\n;\n".join(load_query(name, "sqlite") for name in names))
+        return
+
+    with shard_connection(shard, statement_timeout=False) as conn:
+        with conn.cursor() as cursor:
+            for name in names:
+                cursor.execute(load_query(name))
+        conn.commit()
+
+
+def migrate_amounts_to_cents(shard: int) -> None:
+    """
+    Convert the amounts of a shard from floats to integer cents, if needed.
+
+    Databases created before amounts were stored in cents have a float
+    `amount` column in the records and float `total` columns in the archives
+    and carry-forward totals. Each of them is replaced by an `amount_cents`
+    or `total_cents` integer column, each value rounded to the nearest cent,
+    and the amounts inside the archived payloads are converted too, all in a
+    single transaction. Tables created after that, such as the archives of a
+    database created before records were archived, are left as they are.
+
+    Args:
+        shard (int): The index of the shard in `shards`.
+    """
+    columns = get_table_columns(shard, ("records", "record_archives", "record_carry_forward"))
+    scripts = [script for table, column, script in (
+        ("records", "amount", "migrate_records_to_cents.sql"),
+        ("record_archives", "total", "migrate_record_archives_to_cents.sql"),
+        ("record_carry_forward", "total", "migrate_record_carry_forward_to_cents.sql"),
+    ) if column in columns[table]]
+    if not scripts:
+        return
+
+    logger.info("Converting the amounts of shard %d to cents", shard)
+    run_migrations(shard, scripts)
+
+
+def migrate_records_categories(shard: int) -> None:
+    """
+    Add the category column to the records of a shard, if needed.
+
+    Databases created before records had categories get the column, empty,
+    so their records are uncategorized until the rules of their users label
+    them.
+
+    Args:
+        shard (int): The index of the shard in `shards`.
+    """
+    result = execute_query("select_records_category_column.sql", shard=shard)
+    if result and result[0][0]:
+        return
+
+    logger.info("Adding the category column to the records of shard %d", shard)
+    execute_query("add_records_category_column.sql", shard=shard)
+
+
+def migrate_records_currencies(shard: int) -> None:
+    """
+    Add the currency column to the records of a shard, if needed.
+
+    Databases created before records had currencies get the column, with
+    every existing record in BRL, the only currency then. The carry-forward
+    totals get the column too, and become one per user and currency, unless
+    they were created after that with the column, all in a single
+    transaction.
+
+    Args:
+        shard (int): The index of the shard in `shards`.
+    """
+    columns = get_table_columns(shard, ("records", "record_carry_forward"))
+    scripts = [script for table, script in (
+        ("records", "add_records_currency_column.sql"),
+        ("record_carry_forward", "migrate_record_carry_forward_currencies.sql"),
+    ) if "currency" not in columns[table]]
+    if not scripts:
+        return
+
+    logger.info("Adding the currency column to the records of shard %d", shard)
+    run_migrations(shard, scripts)
+
+
+def migrate_recurring_rules_currencies(shard: int) -> None:
+    """
+    Add the currency column to the recurring rules of a shard, if needed.
+
+    Databases created before recurring rules had currencies get the column,
+    with every existing rule in BRL, the currency of the records they
+    registered until then.
+
+    Args:
+        shard (int): The index of the shard in `shards`.
+    """
+    result = execute_query("select_recurring_rules_currency_column.sql", shard=shard)
+    if result and result[0][0]:
+        return
+
+    logger.info("Adding the currency column to the recurring rules of shard %d", shard)
+    execute_query("add_recurring_rules_currency_column.sql", shard=shard)
+
+
+def create_record_partitions(shard: int) -> None:
+    """
+    Create the partitions of the records table for the coming months.
+
+    The current month and the next `partition_config["months_ahead"]` months
+    get their own partition. Records outside of them go to the default
+    partition.
+
+    Args:
+        shard (int): The index of the shard in `shards`.
     """
-    query = "create_tables.sql"
+    execute_query("create_records_default_partition.sql", shard=shard)
 
-    execute_query(query)
+    current = month_start(datetime.now())
+    with shard_connection(shard) as conn:
+        for months in range(partition_config["months_ahead"] + 1):
+            _create_record_partition(conn, add_months(current, months))
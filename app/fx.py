@@ -0,0 +1,364 @@
+"""
+Exchange rates between the currencies of records, and the conversion of
+amounts between them.
+
+Records are registered in a currency, BRL unless told otherwise. The rates of
+the other currencies are read from local CSV files, one per currency, named
+after its ISO 4217 code, such as 'data/fx/USD.csv':
+
+    date,rate
+    2024-05-02,5.1234
+    2024-05-03,5.0988
+
+where `rate` is the value of one unit of the currency in BRL on that day.
+Days without a rate, such as weekends, use the last rate before them, and
+days before the first rate use the first one.
+
+The rates of each currency are kept in memory as two NumPy arrays, days and
+rates, sorted by day, so the rates of any number of days are found with one
+vectorized binary search per currency. Amounts are converted at the rate of
+the day of their record, in bulk: the database sums them by currency and
+day, and every sum of a query is converted at once.
+
+NumPy is only imported when amounts in other currencies are converted, so
+the processes of a deployment with a single currency never load it.
+"""
+from __future__ import annotations
+import csv
+import logging
+import os
+import re
+import threading
+import time
+from array import array
+from typing import TYPE_CHECKING, Iterable
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+fx_config = {
+    # The currency of the records registered before records had one, in
+    # which the rates are given
+    "base_currency": "BRL",
+    "rates_dir": os.getenv("FX_RATES_DIR", "data/fx"),
+    # How often the rate files are checked for changes, in seconds
+    "reload_interval": float(os.getenv("FX_RELOAD_INTERVAL", 300)),
+}
+
+_code_pattern = re.compile(r"[A-Z]{3}")
+_seconds_per_day = 24 * 60 * 60
+
+# (currency, day, cents), with days counted from 1970-01-01
+Total = tuple[str, int, int]
+
+
+class UnknownCurrency(ValueError):
+    """
+    Raised when a currency is neither the base currency nor one with rates.
+    """
+
+
+def _read_rates(path: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Read the rates of a currency from a CSV file.
+
+    Args:
+        path (str): The path of the file, with `date,rate` rows and an
+            optional header.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The days, counted from 1970-01-01, in
+        ascending order, and the rate of each day. When a day has several
+        rates, the last one in the file is kept.
+
+    Raises:
+        ValueError: If the file has no rates, or a date or rate is invalid.
+    """
+    import numpy as np
+
+    with open(path, newline="") as file:
+        rows = [row for row in csv.reader(file) if row and not row[0].startswith("#")]
+    if rows and rows[0][0].strip().lower() == "date":
+        rows = rows[1:]
+    if not rows:
+        raise ValueError("No rates")
+
+    try:
+        days = np.array([row[0].strip() for row in rows], dtype="datetime64[D]").astype(np.int64)
+        rates = np.array([row[1] for row in rows], dtype=np.float64)
+    except (IndexError, ValueError) as e:
+        raise ValueError(f"Invalid row: {e}") from None
+    if not np.all(np.isfinite(rates) & (rates > 0)):
+        raise ValueError("Rates must be positive numbers")
+
+    order = np.argsort(days, kind="stable")
+    days, rates = days[order], rates[order]
+    last = np.append(days[1:] != days[:-1], True)
+    return days[last], rates[last]
+
+
+class RateTable:
+    """
+    The rates of currencies by day, indexed for vectorized lookups.
+
+    Attributes:
+        base (str): The currency the rates are given in.
+        currencies (frozenset[str]): The currencies amounts can be converted
+            between, the base one included.
+
+    Static Methods:
+        load: Read the rates of every currency from a directory.
+
+    Methods:
+        rates_on: Get the rates of a currency on many days at once.
+        convert: Convert amounts in many currencies to one currency.
+    """
+
+    def __init__(self, base: str, rates: dict[str, tuple[np.ndarray, np.ndarray]]) -> None:
+        """
+        Initialize a RateTable object.
+
+        Args:
+            base (str): The currency the rates are given in.
+            rates (dict[str, tuple[np.ndarray, np.ndarray]]): The days, in
+                ascending order, and rates of each other currency.
+        """
+        self.base = base
+        self.currencies = frozenset(rates) | {base}
+        self._rates = rates
+
+    @staticmethod
+    def load(directory: str, base: str) -> RateTable:
+        """
+        Read the rates of every currency from a directory.
+
+        Files that are not named after a currency code are ignored, and
+        invalid files are skipped with a warning, so one bad file does not
+        make every other currency unknown.
+
+        Args:
+            directory (str): The directory with one `<CODE>.csv` file per
+                currency. A missing directory has no rates.
+            base (str): The currency the rates are given in.
+
+        Returns:
+            RateTable: The rates.
+        """
+        rates = {}
+        names = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+        for name in names:
+            code, extension = os.path.splitext(name)
+            if extension != ".csv" or not _code_pattern.fullmatch(code) or code == base:
+                continue
+            try:
+                rates[code] = _read_rates(os.path.join(directory, name))
+            except (OSError, ValueError) as e:
+                logger.warning("Skipping the exchange rates in %s: %s", name, e)
+        return RateTable(base, rates)
+
+    def rates_on(self, currency: str, days: np.ndarray) -> np.ndarray:
+        """
+        Get the value of one unit of a currency in the base currency on many
+        days at once.
+
+        Args:
+            currency (str): The currency.
+            days (np.ndarray): The days, counted from 1970-01-01, in any
+                order.
+
+        Returns:
+            np.ndarray: The rate of each day.
+
+        Raises:
+            UnknownCurrency: If the currency has no rates.
+
+        Example:
+            >>> get_rates().rates_on("USD", np.array([19845, 19846]))
+            array([5.1234, 5.0988])
+        """
+        import numpy as np
+
+        if currency == self.base:
+            return np.ones(len(days))
+        if currency not in self._rates:
+            raise UnknownCurrency(f"No exchange rates for currency: {currency}")
+
+        rate_days, rates = self._rates[currency]
+        index = np.searchsorted(rate_days, days, side="right") - 1
+        return rates[np.maximum(index, 0)]
+
+    def convert(self, cents: Iterable[int] | np.ndarray, currencies: Iterable[str] | np.ndarray,
+                days: Iterable[int] | np.ndarray, to: str) -> np.ndarray:
+        """
+        Convert amounts in many currencies to one currency, each at the rate
+        of its day.
+
+        The rates are looked up once per distinct currency, for all of its
+        amounts at once, so the cost does not depend on Python code per
+        amount.
+
+        Args:
+            cents (Iterable[int] | np.ndarray): The amounts, in cents.
+            currencies (Iterable[str] | np.ndarray): The currency of each
+                amount.
+            days (Iterable[int] | np.ndarray): The day of each amount,
+                counted from 1970-01-01.
+            to (str): The currency to convert to.
+
+        Returns:
+            np.ndarray: The converted amounts, in cents of `to`, as floats,
+            unchanged for amounts already in `to`.
+
+        Raises:
+            UnknownCurrency: If a currency has no rates.
+
+        Example:
+            >>> get_rates().convert([10000, 5000], ["USD", "BRL"], [19845, 19845], "BRL")
+            array([51234.,  5000.])
+        """
+        import numpy as np
+
+        cents = np.asarray(cents, dtype=np.float64)
+        currencies = np.asarray(currencies)
+        days = np.asarray(days, dtype=np.int64)
+
+        factors = np.ones(len(cents))
+        for currency in np.unique(currencies).tolist():
+            if currency == to:
+                continue
+            mask = currencies == currency
+            factors[mask] = self.rates_on(currency, days[mask]) / self.rates_on(to, days[mask])
+        return cents * factors
+
+
+_table: RateTable | None = None
+_signature: tuple = ()
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def _files_signature(directory: str) -> tuple:
+    try:
+        with os.scandir(directory) as entries:
+            return tuple(sorted((entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                                for entry in entries if entry.name.endswith(".csv")))
+    except OSError:
+        return ()
+
+
+def get_rates() -> RateTable:
+    """
+    Get the exchange rates, loading them the first time.
+
+    The files are checked every `fx_config["reload_interval"]` seconds, and
+    read again only when one of them changed, so new rates are picked up
+    without a restart.
+
+    Returns:
+        RateTable: The rates.
+    """
+    global _table, _signature, _checked_at
+
+    now = time.monotonic()
+    if _table is not None and now - _checked_at < fx_config["reload_interval"]:
+        return _table
+
+    with _lock:
+        if _table is None or now - _checked_at >= fx_config["reload_interval"]:
+            signature = _files_signature(fx_config["rates_dir"])
+            if _table is None or signature != _signature:
+                _table = RateTable.load(fx_config["rates_dir"], fx_config["base_currency"])
+                _signature = signature
+                logger.info("Loaded exchange rates for %s", ", ".join(sorted(_table.currencies)))
+            _checked_at = now
+    return _table
+
+
+def is_known(currency: str) -> bool:
+    """
+    Check whether amounts can be registered in, or converted to, a currency.
+
+    Args:
+        currency (str): The ISO 4217 code of the currency, such as 'USD'.
+
+    Returns:
+        bool: `True` for the base currency and the currencies with rates.
+    """
+    return currency == fx_config["base_currency"] or currency in get_rates().currencies
+
+
+def day_of(seconds: int) -> int:
+    """
+    Get the day of a time, counted from 1970-01-01, as the days of totals.
+
+    Args:
+        seconds (int): The time, as `storage.epoch_seconds`.
+
+    Returns:
+        int: The day.
+    """
+    return seconds // _seconds_per_day
+
+
+def sum_totals(totals: list[Total], to: str) -> int:
+    """
+    Sum amounts in many currencies in one currency.
+
+    Totals in `to` are summed exactly. The others are converted at the rate
+    of their day, all at once, and their sum is rounded to the nearest cent.
+
+    Args:
+        totals (list[Total]): The `(currency, day, cents)` totals, such as
+            the sums of the records of a user by currency and day.
+        to (str): The currency of the sum.
+
+    Returns:
+        int: The sum, in cents of `to`.
+
+    Raises:
+        UnknownCurrency: If a currency has no rates.
+
+    Example:
+        >>> sum_totals([("BRL", 0, 150000), ("USD", 19845, 10000)], "BRL")
+        201234
+    """
+    exact = sum(cents for currency, _, cents in totals if currency == to)
+    foreign = [total for total in totals if total[0] != to]
+    if not foreign:
+        return exact
+
+    currencies, days, cents = zip(*foreign)
+    return exact + round(float(get_rates().convert(cents, currencies, days, to).sum()))
+
+
+def convert_columns(seconds: array, cents: array, currencies: list[str], to: str) -> array | np.ndarray:
+    """
+    Convert a column of amounts in many currencies to one currency, each at
+    the rate of the day of its record.
+
+    Args:
+        seconds (array): The creation time of each record, as
+            `storage.epoch_seconds`, in an `array('q')`.
+        cents (array): The amount of each record, in cents, in an
+            `array('q')`.
+        currencies (list[str]): The currency of each record.
+        to (str): The currency to convert to.
+
+    Returns:
+        array | np.ndarray: The amounts in cents of `to`, rounded to the
+        nearest cent, as 64-bit integers: `cents` itself when every amount is
+        already in `to`, otherwise a NumPy array.
+
+    Raises:
+        UnknownCurrency: If a currency has no rates.
+    """
+    if currencies.count(to) == len(currencies):
+        return cents
+
+    import numpy as np
+
+    days = np.frombuffer(seconds, dtype=np.int64) // _seconds_per_day
+    converted = get_rates().convert(np.frombuffer(cents, dtype=np.int64), currencies, days, to)
+    return np.rint(converted).astype(np.int64)
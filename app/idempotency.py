@@ -0,0 +1,216 @@
+from __future__ import annotations
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from db import after_commit, execute_on_all_shards, execute_query
+
+idempotency_config = {
+    "ttl": int(os.getenv("IDEMPOTENCY_KEY_TTL", 24 * 60 * 60)),
+    "cache_size": int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 10000)),
+    "purge_interval": int(os.getenv("IDEMPOTENCY_PURGE_INTERVAL", 60 * 60)),
+    "max_key_length": 255,
+}
+
+
+class StoredResponse:
+    """
+    Represents the response stored for an idempotency key.
+
+    Attributes:
+        request_hash (str): A hash of the request body that used the key.
+        status_code (int | None): The status code of the stored response, or
+            `None` while the original request is still being processed.
+        body (str | None): The JSON body of the stored response, or `None`
+            while the original request is still being processed.
+    """
+
+    def __init__(self, request_hash: str, status_code: int | None, body: str | None) -> None:
+        """
+        Initialize a StoredResponse object.
+
+        Args:
+            request_hash (str): A hash of the request body that used the key.
+            status_code (int | None): The status code of the stored response.
+            body (str | None): The JSON body of the stored response.
+        """
+        self.request_hash = request_hash
+        self.status_code = status_code
+        self.body = body
+
+    @property
+    def in_progress(self) -> bool:
+        """
+        Whether the original request is still being processed.
+
+        Returns:
+            bool: `True` if no response was stored for the key yet.
+        """
+        return self.status_code is None
+
+
+class IdempotencyStore:
+    """
+    Bounded store of responses indexed by `(user_id, idempotency key)`.
+
+    Keys are persisted in the `idempotency_keys` table so that retries are
+    deduplicated across processes and restarts, and completed responses are
+    kept in an in-memory LRU cache so that a retry hitting the same process is
+    answered without any database round trip. Entries expire after `ttl`
+    seconds both in memory and in the database.
+
+    Methods:
+        claim: Claim a key or get the response stored for it.
+        complete: Store the response of a claimed key.
+        release: Release a claimed key without storing a response.
+    """
+
+    def __init__(self, ttl: int, cache_size: int, purge_interval: int) -> None:
+        """
+        Initialize an IdempotencyStore object.
+
+        Args:
+            ttl (int): How many seconds a key is kept.
+            cache_size (int): The maximum number of responses kept in memory.
+            purge_interval (int): Minimum number of seconds between two purges
+                of expired keys from the database.
+        """
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.purge_interval = purge_interval
+        self._cache: OrderedDict[tuple[str, str], tuple[float, StoredResponse]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+
+    def _get_cached(self, cache_key: tuple[str, str]) -> StoredResponse | None:
+        with self._lock:
+            entry = self._cache.get(cache_key)
+            if entry is None:
+                return None
+
+            expires_at, stored = entry
+            if expires_at < time.monotonic():
+                del self._cache[cache_key]
+                return None
+
+            self._cache.move_to_end(cache_key)
+            return stored
+
+    def _set_cached(self, cache_key: tuple[str, str], stored: StoredResponse) -> None:
+        with self._lock:
+            self._cache[cache_key] = (time.monotonic() + self.ttl, stored)
+            self._cache.move_to_end(cache_key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _purge_expired(self, now: datetime) -> None:
+        if time.monotonic() - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = time.monotonic()
+
+        query = "delete_expired_idempotency_keys.sql"
+        execute_on_all_shards(query, (now - timedelta(seconds=self.ttl),))
+
+    def claim(self, user_id: str, key: str, request_hash: str) -> StoredResponse | None:
+        """
+        Claim an idempotency key or get the response stored for it.
+
+        The key is claimed with a single statement that also returns the
+        stored response when the key was already used, so a first request
+        costs one round trip and a retry answered from memory costs none.
+
+        When another request claims the same key concurrently, the insert
+        waits for its transaction and the key is read again in a new
+        statement, so only one of them is ever processed.
+
+        Args:
+            user_id (str): The ID of the user sending the request.
+            key (str): The value of the `Idempotency-Key` header.
+            request_hash (str): A hash of the request body.
+
+        Returns:
+            StoredResponse | None: `None` if the key was claimed by this
+            request, otherwise the response stored for the key (which may
+            still be in progress).
+
+        Example:
+            >>> store.claim("123", "3f0c...", "9a1b...")
+            None
+
+            (On a retry)
+            >>> store.claim("123", "3f0c...", "9a1b...")
+            <StoredResponse object at 0x...>
+        """
+        cached = self._get_cached((user_id, key))
+        if cached is not None:
+            return cached
+
+        now = datetime.now()
+        self._purge_expired(now)
+
+        query = "claim_idempotency_key.sql"
+        expires_before = now - timedelta(seconds=self.ttl)
+        values = (user_id, key, request_hash, now, expires_before, user_id, key)
+        result = execute_query(query, values, user_id=user_id)
+
+        if not result:
+            # A concurrent request inserted the key and committed while this
+            # insert waited for it, so the conflict did not update the row and
+            # the select, which uses the snapshot of the statement, did not see
+            # it. A new statement sees the committed row.
+            result = execute_query("select_idempotency_key.sql", (user_id, key), user_id=user_id)
+            if not result:
+                # The key was released or purged in the meantime: report it as
+                # in progress, so the client retries instead of registering the
+                # request twice
+                return StoredResponse(request_hash, None, None)
+
+        claimed, stored_hash, status_code, body = result[0]
+        if claimed:
+            return None
+
+        stored = StoredResponse(stored_hash, status_code, body)
+        if not stored.in_progress:
+            self._set_cached((user_id, key), stored)
+        return stored
+
+    def complete(self, user_id: str, key: str, request_hash: str, status_code: int, body: str) -> None:
+        """
+        Store the response of a claimed idempotency key.
+
+        Args:
+            user_id (str): The ID of the user that sent the request.
+            key (str): The value of the `Idempotency-Key` header.
+            request_hash (str): A hash of the request body.
+            status_code (int): The status code of the response.
+            body (str): The JSON body of the response.
+        """
+        query = "complete_idempotency_key.sql"
+        values = (status_code, body, user_id, key)
+        execute_query(query, values, user_id=user_id)
+        # Only replay the response from memory once it is committed
+        stored = StoredResponse(request_hash, status_code, body)
+        after_commit(lambda: self._set_cached((user_id, key), stored))
+
+    def release(self, user_id: str, key: str) -> None:
+        """
+        Release a claimed idempotency key without storing a response.
+
+        This is used when the request fails, so that the client can retry it
+        with the same key.
+
+        Args:
+            user_id (str): The ID of the user that sent the request.
+            key (str): The value of the `Idempotency-Key` header.
+        """
+        query = "release_idempotency_key.sql"
+        execute_query(query, (user_id, key), user_id=user_id)
+
+
+idempotency_store = IdempotencyStore(
+    ttl=idempotency_config["ttl"],
+    cache_size=idempotency_config["cache_size"],
+    purge_interval=idempotency_config["purge_interval"],
+)
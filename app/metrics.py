@@ -0,0 +1,265 @@
+from __future__ import annotations
+import bisect
+import threading
+from typing import Callable
+
+# Upper bounds of the latency buckets, in seconds
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    """
+    Format the labels of a sample in the Prometheus text format.
+
+    Args:
+        names (tuple[str, ...]): The label names.
+        values (tuple[str, ...]): The label values.
+        extra (str, optional): An already formatted label to append, such as
+            `le="0.5"` (default: "").
+
+    Returns:
+        str: The formatted labels, such as `{query="get_records.sql"}`, or an
+        empty string if there are none.
+    """
+    labels = [
+        '{}="{}"'.format(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    """
+    A counter that only goes up, with optional labels.
+
+    Attributes:
+        name (str): The name of the metric.
+        help (str): The description of the metric.
+        label_names (tuple[str, ...]): The names of the labels.
+    """
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> None:
+        """
+        Initialize a Counter object.
+
+        Args:
+            name (str): The name of the metric.
+            help (str): The description of the metric.
+            label_names (tuple[str, ...], optional): The names of the labels
+                (default: ()).
+        """
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        """
+        Increment the counter.
+
+        Args:
+            *labels (str): The label values, in the order of `label_names`.
+            amount (float, optional): How much to add (default: 1).
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def values(self) -> dict[tuple[str, ...], float]:
+        """
+        Get the current value for each set of label values.
+
+        Returns:
+            dict[tuple[str, ...], float]: A copy of the values, by label
+            values.
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> list[str]:
+        """
+        Render the counter in the Prometheus text format.
+
+        Returns:
+            list[str]: The lines of the metric.
+        """
+        with self._lock:
+            values = list(self._values.items())
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    """
+    A value read when the metrics are rendered.
+
+    Attributes:
+        name (str): The name of the metric.
+        help (str): The description of the metric.
+        function (Callable[[], float]): The function that returns the value.
+    """
+
+    def __init__(self, name: str, help: str, function: Callable[[], float]) -> None:
+        """
+        Initialize a Gauge object.
+
+        Args:
+            name (str): The name of the metric.
+            help (str): The description of the metric.
+            function (Callable[[], float]): The function that returns the
+                value.
+        """
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def render(self) -> list[str]:
+        """
+        Render the gauge in the Prometheus text format.
+
+        Returns:
+            list[str]: The lines of the metric.
+        """
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.function()}",
+        ]
+
+
+class Histogram:
+    """
+    A histogram of observed values, with optional labels.
+
+    Observations only increment the count of one bucket, so recording a value
+    is a binary search and a few additions under a lock. The cumulative counts
+    expected by Prometheus are computed when the metrics are rendered.
+
+    Attributes:
+        name (str): The name of the metric.
+        help (str): The description of the metric.
+        label_names (tuple[str, ...]): The names of the labels.
+        buckets (tuple[float, ...]): The upper bounds of the buckets, sorted.
+    """
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = latency_buckets) -> None:
+        """
+        Initialize a Histogram object.
+
+        Args:
+            name (str): The name of the metric.
+            help (str): The description of the metric.
+            label_names (tuple[str, ...], optional): The names of the labels
+                (default: ()).
+            buckets (tuple[float, ...], optional): The upper bounds of the
+                buckets, sorted (default: `latency_buckets`).
+        """
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        # Per label values: the count of each bucket plus +Inf, and the sum
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        """
+        Record an observed value.
+
+        Args:
+            value (float): The observed value.
+            *labels (str): The label values, in the order of `label_names`.
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    def render(self) -> list[str]:
+        """
+        Render the histogram in the Prometheus text format.
+
+        Returns:
+            list[str]: The lines of the metric.
+        """
+        with self._lock:
+            values = [(labels, list(counts), total[0])
+                      for labels, (counts, total) in self._values.items()]
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.label_names, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            sample_labels = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{sample_labels} {total}")
+            lines.append(f"{self.name}_count{sample_labels} {cumulative}")
+        return lines
+
+
+registry: list[Counter | Gauge | Histogram] = []
+
+
+def register(metric):
+    """
+    Add a metric to the ones exposed by `render`.
+
+    Args:
+        metric (Counter | Gauge | Histogram): The metric to add.
+
+    Returns:
+        Counter | Gauge | Histogram: The same metric.
+
+    Example:
+        >>> requests_total = register(Counter("requests_total", "Requests"))
+    """
+    registry.append(metric)
+    return metric
+
+
+def render() -> str:
+    """
+    Render all registered metrics in the Prometheus text format.
+
+    Returns:
+        str: The metrics, ready to be served at `/metrics`.
+    """
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+db_query_duration = register(Histogram(
+    "db_query_duration_seconds", "Time spent executing each SQL file", ("query",)))
+db_query_rows = register(Counter(
+    "db_query_rows_total", "Rows returned by each SQL file", ("query",)))
+db_query_errors = register(Counter(
+    "db_query_errors_total", "Errors raised by each SQL file", ("query", "error")))
+db_pool_wait = register(Histogram(
+    "db_pool_wait_seconds", "Time spent waiting for a connection from the pool"))
+
+cache_lookups = register(Counter(
+    "cache_lookups_total", "Shared cache lookups by kind of entry and result", ("kind", "result")))
+cache_errors = register(Counter(
+    "cache_errors_total", "Shared cache operations that failed", ("operation",)))
+
+recurring_records = register(Counter(
+    "recurring_records_total", "Records created from recurring rules"))
+relabeled_records = register(Counter(
+    "relabeled_records_total", "Records whose category changed when relabeled"))
+
+http_request_duration = register(Histogram(
+    "http_request_duration_seconds", "Time spent handling each endpoint",
+    ("endpoint", "method", "status")))
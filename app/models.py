@@ -1,11 +1,183 @@
 from __future__ import annotations
+from array import array
 from datetime import datetime
-from typing import Any
-from db import execute_query
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from typing import Any, Iterable
+from cache import get_cache
+from categories import Classifier, categories_config, compile_rules, validate_rule
+from db import current_unit_of_work
+from fx import convert_columns, day_of, fx_config, get_rates, sum_totals
+from recurring import parse_schedule
+from storage import epoch_seconds, get_storage
+from tracing import span
 
 from flask_login import UserMixin
 
 
+def _invalidate(user_id: str, *kinds: str) -> None:
+    """
+    Invalidate cached entries of a user that a write is changing.
+
+    The entries are deleted right away, so later reads of the same request
+    see the write, and again when the unit of work of the request ends, in
+    case another request cached the old values before the commit or this
+    one cached values that are rolled back.
+
+    Args:
+        user_id (str): The ID of the user.
+        *kinds (str): The kinds of cache entries to invalidate.
+    """
+    def delete():
+        get_cache().delete(user_id, *kinds)
+
+    delete()
+    unit = current_unit_of_work()
+    if unit is not None:
+        unit.after_commit(delete)
+        unit.after_rollback(delete)
+
+
+class Money:
+    """
+    An exact amount of money, as an integer number of cents.
+
+    Amounts are stored as cents in the database, in `BIGINT` columns, so sums
+    are exact and balances never drift the way float sums do. Floats only
+    appear at the edges: when parsing an amount sent by a client and when
+    writing JSON responses.
+
+    Attributes:
+        cents (int): The amount in cents, negative for expenses.
+
+    Static Methods:
+        parse: Parse an amount given in currency units.
+        sum: Sum amounts over a compact array of cents.
+
+    Methods:
+        to_float: Convert the amount to currency units, for JSON.
+    """
+
+    __slots__ = ("cents",)
+
+    # The range of a BIGINT column
+    max_cents = 2 ** 63 - 1
+
+    def __init__(self, cents: int) -> None:
+        """
+        Initialize a Money object.
+
+        Args:
+            cents (int): The amount in cents.
+        """
+        self.cents = int(cents)
+
+    @staticmethod
+    def parse(amount: int | float | str | Decimal) -> Money:
+        """
+        Parse an amount given in currency units, rounding it to the nearest
+        cent, with halves rounded away from zero.
+
+        Floats are converted through their shortest decimal representation,
+        so `0.1` is 10 cents and not 0.1000000000000000055... units.
+
+        Args:
+            amount (int | float | str | Decimal): The amount, such as 100.5.
+
+        Returns:
+            Money: The amount.
+
+        Raises:
+            ValueError: If the amount is not a finite number or does not fit
+                in a `BIGINT` column once converted to cents.
+
+        Example:
+            >>> Money.parse(100.505)
+            Money(10051)
+        """
+        try:
+            value = Decimal(str(amount))
+        except InvalidOperation:
+            raise ValueError(f"Not a number: {amount!r}") from None
+        if not value.is_finite() or abs(value) * 100 > Money.max_cents:
+            raise ValueError(f"Amount out of range: {amount!r}")
+
+        cents = int((value * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+        if abs(cents) > Money.max_cents:
+            raise ValueError(f"Amount out of range: {amount!r}")
+        return Money(cents)
+
+    @staticmethod
+    def sum(amounts: Iterable[Money] | array) -> Money:
+        """
+        Sum amounts exactly.
+
+        The cents are gathered into a compact `array('q')` of 64-bit integers,
+        or used as is if already one, and summed with integer arithmetic.
+        Storages keep the amounts of a user in such arrays, so their sums
+        don't create an object per amount.
+
+        Args:
+            amounts (Iterable[Money] | array): The amounts, or an `array('q')`
+                of cents.
+
+        Returns:
+            Money: The sum of the amounts.
+
+        Example:
+            >>> Money.sum([Money(10050), Money(-5000)])
+            Money(5050)
+        """
+        if not isinstance(amounts, array):
+            amounts = array("q", [amount.cents for amount in amounts])
+        return Money(sum(amounts))
+
+    def to_float(self) -> float:
+        """
+        Convert the amount to currency units, for JSON responses.
+
+        Returns:
+            float: The amount in currency units, such as 100.5.
+        """
+        return self.cents / 100
+
+    def __add__(self, other: Money) -> Money:
+        if not isinstance(other, Money):
+            return NotImplemented
+        return Money(self.cents + other.cents)
+
+    def __sub__(self, other: Money) -> Money:
+        if not isinstance(other, Money):
+            return NotImplemented
+        return Money(self.cents - other.cents)
+
+    def __neg__(self) -> Money:
+        return Money(-self.cents)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Money):
+            return NotImplemented
+        return self.cents == other.cents
+
+    def __lt__(self, other: Money) -> bool:
+        if not isinstance(other, Money):
+            return NotImplemented
+        return self.cents < other.cents
+
+    def __hash__(self) -> int:
+        return hash(self.cents)
+
+    def __bool__(self) -> bool:
+        return self.cents != 0
+
+    def __str__(self) -> str:
+        sign = "-" if self.cents < 0 else ""
+        units, cents = divmod(abs(self.cents), 100)
+        return f"{sign}{units}.{cents:02d}"
+
+    def __repr__(self) -> str:
+        return f"Money({self.cents})"
+
+
 class User(UserMixin):
     def __init__(self, id: str, name: str, email: str, profile_pic: str):
         """
@@ -28,8 +200,9 @@ class User(UserMixin):
         """
         Retrieve a user by their user ID.
 
-        This method retrieves a user from the database using their user ID. It
-        returns a `User` object if the user is found, otherwise `None`.
+        This method retrieves a user from the shared cache, or from the
+        database on a miss, using their user ID. It returns a `User` object if
+        the user is found, otherwise `None`.
 
         Args:
             user_id (str): The ID of the user to be retrieved.
@@ -45,27 +218,116 @@ class User(UserMixin):
             >>> User.get("nonexistent_id")
             None
         """
-        query = "select_user_by_id.sql"
-        values = (user_id,)
-        results = execute_query(query, values)
+        cache = get_cache()
+        user_data = cache.get("user", user_id)
+        if user_data is None:
+            user_data = get_storage().get_user(user_id)
+            if user_data is None:
+                return None
+            cache.set("user", user_id, list(user_data))
 
-        if not results:
-            return None
-
-        user_data = results[0]
         user = User(
             id=user_data[0], name=user_data[1], email=user_data[2],
             profile_pic=user_data[3]
         )
         return user
 
+    @staticmethod
+    def get_bootstrap(user_id: str, history_size: int) -> tuple[User, Money, list[Record]] | None:
+        """
+        Retrieve a user with their balance and latest records.
+
+        Everything is read with a single cache lookup, or on a miss with a
+        single database query whose results are then cached, so that a page
+        can be rendered with all of the user's data in one round trip.
+
+        Args:
+            user_id (str): The ID of the user to be retrieved.
+            history_size (int): How many of the latest records to retrieve.
+
+        Returns:
+            tuple[User, Money, list[Record]] | None: The user, their balance
+            in the base currency including archived records, and their latest
+            records from oldest to newest, or `None` if the user is not found.
+
+        Example:
+            >>> User.get_bootstrap("123", 50)
+            (<User object at 0x...>, Money(5050), [<Record object at 0x...>, ...])
+        """
+        base = fx_config["base_currency"]
+        cache = get_cache()
+        user_data, balances, page = cache.get_many(user_id, ("user", "balance", "history"))
+
+        if user_data is not None and balances is not None and base in balances \
+                and page is not None and page["size"] == history_size:
+            balance = balances[base]
+            rows = [(id, user_id, amount, description, datetime.fromisoformat(created_at), category, currency)
+                    for id, amount, description, created_at, category, currency in page["rows"]]
+        else:
+            result = get_storage().get_bootstrap(user_id, history_size, base)
+            if result is None:
+                return None
+
+            user_data, totals, rows = result
+            balance = sum_totals(totals, base)
+            cache.set_many(user_id, {
+                "user": list(user_data),
+                "balance": {base: balance},
+                "history": {
+                    "size": history_size,
+                    "rows": [[id, amount, description, created_at.isoformat(), category, currency]
+                             for id, _, amount, description, created_at, category, currency in rows],
+                },
+            })
+
+        user = User(
+            id=user_data[0], name=user_data[1], email=user_data[2],
+            profile_pic=user_data[3]
+        )
+        records = [Record(id, user_id, Money(amount), description, created_at, category, currency)
+                   for id, _, amount, description, created_at, category, currency in rows]
+        return user, Money(balance), records
+
+    @staticmethod
+    def get_balance(user_id: str, currency: str = fx_config["base_currency"]) -> Money | None:
+        """
+        Retrieve the balance of a user in a currency.
+
+        The amounts of the records and the carry-forward totals of the
+        archived records are summed by the storage, in the database, by
+        currency and day, so no record is loaded to compute it. Amounts in
+        other currencies are then converted at the rate of their day, all at
+        once, by `fx.sum_totals`.
+
+        Args:
+            user_id (str): The ID of the user.
+            currency (str, optional): The currency of the balance (default:
+                the base currency).
+
+        Returns:
+            Money | None: The balance of the user, or `None` if the user is
+            not found.
+
+        Raises:
+            fx.UnknownCurrency: If a currency has no exchange rates.
+
+        Example:
+            >>> User.get_balance("123")
+            Money(5050)
+
+            >>> User.get_balance("123", "USD")
+            Money(985)
+        """
+        totals = get_storage().get_balance(user_id, currency)
+        return None if totals is None else Money(sum_totals(totals, currency))
+
     @staticmethod
     def create(id: str, name: str, email: str, profile_pic: str) -> User:
         """
         Create a new user in the database.
 
         This method inserts a new user into the database with the provided
-        details.
+        details, and invalidates any cached profile of the user.
 
         Args:
             id (str): The unique identifier for the user.
@@ -77,9 +339,35 @@ class User(UserMixin):
             >>> User.create("123", "John Doe", "john@example.com", "http://example.com/john.jpg")
             <User object at 0x...>
         """
-        query = "insert_user.sql"
-        values = (id, name, email, profile_pic)
-        execute_query(query, values)
+        get_storage().insert_user(id, name, email, profile_pic)
+        _invalidate(id, "user")
+        return User(id, name, email, profile_pic)
+
+    @staticmethod
+    def upsert(id: str, name: str, email: str, profile_pic: str) -> User:
+        """
+        Create a user in the database, or update their profile if it changed.
+
+        This is done with a single statement, which does not write anything
+        when the stored profile is already the same, so it is safe to run on
+        every login, including concurrent first logins of the same user. The
+        cached profile of the user is invalidated when it changed.
+
+        Args:
+            id (str): The unique identifier for the user.
+            name (str): The name of the user.
+            email (str): The email address of the user.
+            profile_pic (str): The URL of the user's profile picture.
+
+        Returns:
+            User: The user, with the given profile.
+
+        Example:
+            >>> User.upsert("123", "John Doe", "john@example.com", "http://example.com/john.jpg")
+            <User object at 0x...>
+        """
+        if get_storage().upsert_user(id, name, email, profile_pic):
+            _invalidate(id, "user")
         return User(id, name, email, profile_pic)
 
     def to_dict(self) -> dict[str, Any]:
@@ -108,7 +396,7 @@ class User(UserMixin):
             "profile_pic": self.profile_pic,
         }
 
-    def gain(self, amount: float, description: str) -> Record:
+    def gain(self, amount: Money, description: str, currency: str = fx_config["base_currency"]) -> Record:
         """
         Create a new gain record for the user.
 
@@ -117,9 +405,11 @@ class User(UserMixin):
         stored as a positive value.
 
         Args:
-            amount (float): The amount of the gain. This value will be stored
+            amount (Money): The amount of the gain. This value will be stored
                 as a positive number.
             description (str): A description of the gain.
+            currency (str, optional): The currency of the amount (default: the
+                base currency).
 
         Returns:
             Record | None: A `Record` object if the gain record is successfully
@@ -127,17 +417,17 @@ class User(UserMixin):
 
         Example:
             >>> user = User("123", "John Doe", "john@example.com", "http://example.com/john.jpg")
-            >>> user.gain(100.0, "Salary payment")
+            >>> user.gain(Money(10000), "Salary payment")
             <Record object at 0x...>
 
             (In case of some error)
-            >>> user.gain(100.0, "Salary payment")
+            >>> user.gain(Money(10000), "Salary payment")
             None
         """
-        record = Record.create(self.id, amount, description)
+        record = Record.create(self.id, amount, description, currency)
         return record
 
-    def expense(self, amount: float, description: str) -> Record:
+    def expense(self, amount: Money, description: str, currency: str = fx_config["base_currency"]) -> Record:
         """
         Create a new expense record for the user.
 
@@ -146,9 +436,11 @@ class User(UserMixin):
         amount is stored as a negative value.
 
         Args:
-            amount (float): The amount of the expense. This value will be
+            amount (Money): The amount of the expense. This value will be
                 stored as a negative number.
             description (str): A description of the expense.
+            currency (str, optional): The currency of the amount (default: the
+                base currency).
 
         Returns:
             Record | None: A `Record` object if the expense record is
@@ -156,19 +448,25 @@ class User(UserMixin):
 
         Example:
             >>> user = User("123", "John Doe", "john@example.com", "http://example.com/john.jpg")
-            >>> user.expense(50.0, "Grocery shopping")
+            >>> user.expense(Money(5000), "Grocery shopping")
             <Record object at 0x...>
         """
-        negative_amount = amount * -1
-        record = Record.create(self.id, negative_amount, description)
+        negative_amount = -amount
+        record = Record.create(self.id, negative_amount, description, currency)
         return record
 
-    def get_records(self) -> list[Record]:
+    def get_records(self, since: datetime | None = None, until: datetime | None = None) -> list[Record]:
         """
         Retrieve all records for the user.
 
         This method retrieves all records from the database associated with the
-        current user.
+        current user, optionally only the ones created in a date range.
+
+        Args:
+            since (datetime | None, optional): Only get records created at or
+                after this datetime (default: None).
+            until (datetime | None, optional): Only get records created before
+                this datetime (default: None).
 
         Returns:
             list[Record]: A list of `Record` objects associated with the user.
@@ -182,7 +480,7 @@ class User(UserMixin):
             >>> user.get_records()
             []
         """
-        records = Record.get_all(self.id)
+        records = Record.get_all(self.id, since, until)
         return records
 
 class Record:
@@ -190,102 +488,133 @@ class Record:
     Represents a financial record.
 
     This class models a financial record, of gain or expense of money, with
-    attributes including amount, description, and the creation time.
+    attributes including amount, currency, description, category and the
+    creation time.
 
     Attributes:
         id (int): The ID of the record in the database.
         user_id (str): The ID of the user that registered the record.
-        amount (float): The amount associated with the record.
+        amount (Money): The amount associated with the record, in its
+            currency.
         description (str): A description of the record.
         created_at (datetime): The datetime timestamp of the record.
+        category (str | None): The category of the record, from the rules of
+            the user, or `None` if no rule matches.
+        currency (str): The ISO 4217 code of the currency of the amount.
 
     Static Methods:
         create: Create a new record in the database.
         get_all: Retrieve all records from the database.
+        get_columns: Retrieve the times and amounts of records as arrays.
+        get_category_totals: Retrieve the totals of each category.
+        get_archived: Retrieve archived records from the database.
+        get_carry_forward: Retrieve the totals of the archived records.
+        convert: Convert the amounts of records to a currency.
 
     Methods:
         to_dict: Convert the record object to a dictionary.
     """
 
-    def __init__(self, id: int, user_id: str, amount: float, description: str, created_at: datetime) -> None:
+    def __init__(self, id: int, user_id: str, amount: Money, description: str, created_at: datetime,
+                 category: str | None = None, currency: str = fx_config["base_currency"]) -> None:
         """
         Initialize a Record object.
 
         Args:
             id (int): The ID of the record in the database.
             user_id (str): The ID of the user that registered the record.
-            amount (float): The amount associated with the record.
+            amount (Money): The amount associated with the record.
             description (str): A description of the record.
             created_at (datetime): The datetime timestamp of the record.
+            category (str | None, optional): The category of the record
+                (default: None).
+            currency (str, optional): The currency of the amount (default:
+                the base currency).
         """
         self.id = id
         self.user_id = user_id
         self.amount = amount
         self.description = description
         self.created_at = created_at
+        self.category = category
+        self.currency = currency
 
     def to_dict(self) -> dict[str, Any]:
         """
         Convert the record object to a dictionary.
 
-        This method converts the record object to a dictionary representation.
+        This method converts the record object to a dictionary representation,
+        with the amount in currency units.
 
         Returns:
             dict[str, Any]: A dictionary containing the record's details, with
             keys corresponding to the record's attributes.
 
         Example:
-            >>> record = Record(1, "123", 50.0, "Found in my old pants", datetime.now())
+            >>> record = Record(1, "123", Money(5000), "Found in my old pants", datetime.now())
             >>> record.to_dict()
             {
                 'id': 1,
                 'user_id': '123',
                 'amount': 50.0,
                 'description': 'Found in my old pants',
-                'created_at': datetime.datetime(...)
+                'created_at': datetime.datetime(...),
+                'category': None,
+                'currency': 'BRL'
             }
         """
         rec = vars(self).copy()
+        rec["amount"] = self.amount.to_float()
         return rec
 
     @staticmethod
-    def create(user_id: str, amount: float, description: str) -> Record:
+    def create(user_id: str, amount: Money, description: str,
+               currency: str = fx_config["base_currency"]) -> Record:
         """
         Create a new record in the database.
 
         This method inserts a new record into the database with the provided
-        details and returns an equivalent Record object.
+        details and returns an equivalent Record object. The record is labeled
+        with the category rules of the user on the way. The cached balance,
+        first page of history and analytics of the user are invalidated.
 
         Args:
             user_id (str): The ID of the user that registered the record.
-            amount (float): The amount associated with the record.
+            amount (Money): The amount associated with the record.
             description (str): A description of the record.
+            currency (str, optional): The currency of the amount (default:
+                the base currency).
 
         Returns:
             Record | None: The `Record` object created.
 
         Example:
-            >>> Record.create("123", 50.0, "Found in my old pants")
+            >>> Record.create("123", Money(5000), "Found in my old pants")
             <Record object at 0x...>
         """
-        query = "insert_record.sql"
         created_at = datetime.now()
-        values = (user_id, amount, description, created_at)
-
-        query_result:list[tuple[int,]] = execute_query(query, values) # type: ignore
-        record_id = query_result[0][0]
-        return Record(record_id, user_id, amount, description, created_at)
+        category = CategoryRule.get_classifier(user_id).classify(description)
+        record_id = get_storage().insert_record(user_id, amount.cents, description, created_at,
+                                                category, currency)
+        _invalidate(user_id, "balance", "history", "analytics")
+        return Record(record_id, user_id, amount, description, created_at, category, currency)
 
     @staticmethod
-    def get_all(user_id: str) -> list[Record]:
+    def get_all(user_id: str, since: datetime | None = None, until: datetime | None = None) -> list[Record]:
         """
         Retrieve all records of a user from the database.
 
         This method retrieves all records from the database associated with the
-        given user ID and returns them as a list of `Record` objects.
+        given user ID and returns them as a list of `Record` objects. When a
+        date range is given, only the partitions of the records table for the
+        months in the range are read.
 
         Args:
             user_id (str): The ID of the user whose records are to be retrieved.
+            since (datetime | None, optional): Only get records created at or
+                after this datetime (default: None).
+            until (datetime | None, optional): Only get records created before
+                this datetime (default: None).
 
         Returns:
             list[Record]: A list of `Record` objects associated with the user.
@@ -294,21 +623,535 @@ class Record:
             >>> Record.get_all("123")
             [<Record object at 0x...>, <Record object at 0x...>, ...]
 
+            >>> Record.get_all("123", since=datetime(2024, 5, 1))
+            [<Record object at 0x...>, ...]
+
             (If no records are found)
             >>> Record.get_all("123")
             []
         """
-        query = "get_records.sql"
-        values = (user_id,)
-        result = execute_query(query, values)
-
-        if result is None:
-            return []
+        result = get_storage().get_records(user_id, since, until)
 
         all_records = []
-        for row in result:
-            id, _, amount, description, created_at = row
-            record = Record(id, user_id, amount, description, created_at)
-            all_records.append(record)
+        with span("build records", records=len(result)):
+            for row in result:
+                id, _, amount, description, created_at, category, currency = row
+                record = Record(id, user_id, Money(amount), description, created_at, category, currency)
+                all_records.append(record)
 
         return all_records
+
+    @staticmethod
+    def get_columns(user_id: str, since: datetime,
+                    currency: str = fx_config["base_currency"]) -> tuple[array, array]:
+        """
+        Retrieve the creation times and amounts of the records of a user in
+        bulk, as two compact arrays, without building `Record` objects.
+
+        This is meant for aggregations over many records, which can wrap the
+        arrays as NumPy arrays without copying them. Amounts in other
+        currencies are converted at the rate of the day of their record, all
+        at once, by `fx.convert_columns`.
+
+        Args:
+            user_id (str): The ID of the user whose records are to be retrieved.
+            since (datetime): Only get records created at or after this
+                datetime.
+            currency (str, optional): The currency of the amounts (default:
+                the base currency).
+
+        Returns:
+            tuple[array, array]: The creation times, in seconds since the Unix
+            epoch of the local time, and the amounts in cents of `currency`,
+            both 64-bit integer buffers, `array('q')` or NumPy arrays, ordered
+            by creation time.
+
+        Raises:
+            fx.UnknownCurrency: If a currency has no exchange rates.
+
+        Example:
+            >>> Record.get_columns("123", datetime(2024, 5, 1))
+            (array('q', [1714557600, ...]), array('q', [10050, -5000, ...]))
+        """
+        seconds, cents, currencies = get_storage().get_record_columns(user_id, since)
+        return seconds, convert_columns(seconds, cents, currencies, currency)
+
+    @staticmethod
+    def get_category_totals(user_id: str, since: datetime, until: datetime,
+                            currency: str = fx_config["base_currency"]) -> list[tuple[str | None, Money, Money, int]]:
+        """
+        Retrieve the income, expenses and number of records of each category
+        of a user in a date range, summed by the database.
+
+        The database sums the amounts by category, currency and day, and the
+        sums in other currencies are converted at the rate of their day, all
+        at once. Archived records are not included.
+
+        Args:
+            user_id (str): The ID of the user.
+            since (datetime): Only count records created at or after this
+                datetime.
+            until (datetime): Only count records created before this
+                datetime.
+            currency (str, optional): The currency of the totals (default:
+                the base currency).
+
+        Returns:
+            list[tuple[str | None, Money, Money, int]]: The category, income,
+            expenses (as a positive amount) and number of records of each
+            category, by category name, with the uncategorized records last
+            under a `None` category.
+
+        Raises:
+            fx.UnknownCurrency: If a currency has no exchange rates.
+
+        Example:
+            >>> Record.get_category_totals("123", datetime(2024, 5, 1), datetime(2024, 6, 1))
+            [('food', Money(0), Money(84250), 31), (None, Money(500000), Money(1200), 3)]
+        """
+        rows = get_storage().get_category_totals(user_id, since, until, currency)
+        if not rows:
+            return []
+
+        categories, currencies, days, incomes, expenses, counts = zip(*rows)
+        if currencies.count(currency) != len(currencies):
+            rates = get_rates()
+            incomes = rates.convert(incomes, currencies, days, currency).tolist()
+            expenses = rates.convert(expenses, currencies, days, currency).tolist()
+
+        # Rows are ordered by category, with one row per currency and day
+        totals: dict[str | None, list] = {}
+        for category, income, expense, count in zip(categories, incomes, expenses, counts):
+            total = totals.setdefault(category, [0, 0, 0])
+            total[0] += income
+            total[1] += expense
+            total[2] += count
+        return [(category, Money(round(income)), Money(round(expense)), count)
+                for category, (income, expense, count) in totals.items()]
+
+    @staticmethod
+    def get_archived(user_id: str, since: datetime | None = None, until: datetime | None = None) -> list[Record]:
+        """
+        Retrieve archived records of a user from the database.
+
+        Records older than the archive age are moved out of the records table
+        by the archival job and stored compressed, one row per user and month.
+        This method reads the months overlapping the given range and returns
+        the records in it.
+
+        Args:
+            user_id (str): The ID of the user whose records are to be retrieved.
+            since (datetime | None, optional): Only get records created at or
+                after this datetime (default: None).
+            until (datetime | None, optional): Only get records created before
+                this datetime (default: None).
+
+        Returns:
+            list[Record]: A list of archived `Record` objects, oldest first.
+
+        Example:
+            >>> Record.get_archived("123", since=datetime(2020, 1, 1))
+            [<Record object at 0x...>, ...]
+        """
+        since = since or datetime.min
+        until = until or datetime.max
+        payloads = get_storage().get_archived_records(user_id, since, until)
+
+        archived = []
+        for payload in payloads:
+            # Records archived before records had categories or currencies
+            # have none, and are in the base currency
+            for id, amount, description, created_at, *labels in payload:
+                created_at = datetime.fromisoformat(created_at)
+                if since <= created_at < until:
+                    category = labels[0] if labels else None
+                    currency = labels[1] if len(labels) > 1 else fx_config["base_currency"]
+                    archived.append(Record(id, user_id, Money(amount), description, created_at,
+                                           category, currency))
+
+        return archived
+
+    @staticmethod
+    def get_carry_forward(user_id: str) -> list[tuple[str, Money, datetime]]:
+        """
+        Retrieve the totals of the archived records of a user, one per
+        currency.
+
+        Args:
+            user_id (str): The ID of the user.
+
+        Returns:
+            list[tuple[str, Money, datetime]]: The currency, the sum of the
+            amounts of the archived records in that currency, and the
+            datetime before which its records are archived, or an empty list
+            if nothing was archived.
+
+        Example:
+            >>> Record.get_carry_forward("123")
+            [('BRL', Money(152075), datetime.datetime(2023, 6, 1, 0, 0))]
+        """
+        return [(currency, Money(total), archived_until)
+                for currency, total, archived_until in get_storage().get_carry_forward(user_id)]
+
+    @staticmethod
+    def convert(records: list[Record], currency: str) -> list[Money]:
+        """
+        Convert the amounts of records to a currency, each at the rate of the
+        day of the record.
+
+        The amounts in other currencies are converted all at once by
+        `fx.RateTable.convert`, and rounded to the nearest cent. When every
+        record is already in the currency, nothing is converted.
+
+        Args:
+            records (list[Record]): The records.
+            currency (str): The currency to convert to.
+
+        Returns:
+            list[Money]: The amount of each record, in `currency`.
+
+        Raises:
+            fx.UnknownCurrency: If a currency has no exchange rates.
+
+        Example:
+            >>> Record.convert(records, "USD")
+            [Money(1962), Money(-980), ...]
+        """
+        if all(record.currency == currency for record in records):
+            return [record.amount for record in records]
+
+        converted = get_rates().convert(
+            [record.amount.cents for record in records],
+            [record.currency for record in records],
+            [day_of(epoch_seconds(record.created_at)) for record in records],
+            currency,
+        )
+        return [Money(cents) for cents in converted.round().tolist()]
+
+
+class RecurringRule:
+    """
+    Represents a recurring rule, such as a monthly salary or rent.
+
+    A rule registers a record with its amount, description and currency on
+    every occurrence of its cron-like schedule. The records are registered by the
+    scheduler in `recurring`.
+
+    Attributes:
+        id (int): The ID of the rule in the database.
+        user_id (str): The ID of the user that owns the rule.
+        amount (Money): The amount of each record, negative for expenses.
+        description (str): The description of each record.
+        schedule (str): The cron-like schedule, such as '0 9 5 * *'.
+        next_run_at (datetime): The time of the next occurrence.
+        created_at (datetime): The datetime timestamp of the rule.
+        currency (str): The ISO 4217 code of the currency of the amount.
+
+    Static Methods:
+        create: Create a new rule in the database.
+        get_all: Retrieve all rules of a user from the database.
+        delete: Delete a rule from the database.
+
+    Methods:
+        to_dict: Convert the rule object to a dictionary.
+    """
+
+    def __init__(self, id: int, user_id: str, amount: Money, description: str, schedule: str,
+                 next_run_at: datetime, created_at: datetime,
+                 currency: str = fx_config["base_currency"]) -> None:
+        """
+        Initialize a RecurringRule object.
+
+        Args:
+            id (int): The ID of the rule in the database.
+            user_id (str): The ID of the user that owns the rule.
+            amount (Money): The amount of each record, negative for expenses.
+            description (str): The description of each record.
+            schedule (str): The cron-like schedule of the rule.
+            next_run_at (datetime): The time of the next occurrence.
+            created_at (datetime): The datetime timestamp of the rule.
+            currency (str, optional): The currency of the amount (default:
+                the base currency).
+        """
+        self.id = id
+        self.user_id = user_id
+        self.amount = amount
+        self.description = description
+        self.schedule = schedule
+        self.next_run_at = next_run_at
+        self.created_at = created_at
+        self.currency = currency
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Convert the rule object to a dictionary, with the amount in currency
+        units.
+
+        Returns:
+            dict[str, Any]: A dictionary containing the rule's details, with
+            keys corresponding to the rule's attributes.
+
+        Example:
+            >>> rule.to_dict()
+            {
+                'id': 1,
+                'user_id': '123',
+                'amount': -1500.0,
+                'description': 'Rent',
+                'schedule': '0 9 5 * *',
+                'next_run_at': datetime.datetime(2024, 6, 5, 9, 0),
+                'created_at': datetime.datetime(...),
+                'currency': 'BRL'
+            }
+        """
+        rule = vars(self).copy()
+        rule["amount"] = self.amount.to_float()
+        return rule
+
+    @staticmethod
+    def create(user_id: str, amount: Money, description: str, schedule: str,
+               currency: str = fx_config["base_currency"]) -> RecurringRule:
+        """
+        Create a new rule in the database.
+
+        The first occurrence is the first one of the schedule after the
+        creation of the rule, so no record is registered for the past.
+
+        Args:
+            user_id (str): The ID of the user that owns the rule.
+            amount (Money): The amount of each record, negative for expenses.
+            description (str): The description of each record.
+            schedule (str): The cron-like schedule of the rule.
+            currency (str, optional): The currency of the amount (default:
+                the base currency).
+
+        Returns:
+            RecurringRule: The `RecurringRule` object created.
+
+        Raises:
+            ValueError: If the schedule is not valid.
+
+        Example:
+            >>> RecurringRule.create("123", Money(-150000), "Rent", "0 9 5 * *")
+            <RecurringRule object at 0x...>
+        """
+        created_at = datetime.now()
+        next_run_at = parse_schedule(schedule).next_after(created_at)
+        rule_id = get_storage().insert_recurring_rule(
+            user_id, amount.cents, description, schedule, next_run_at, created_at, currency)
+        return RecurringRule(rule_id, user_id, amount, description, schedule, next_run_at, created_at,
+                             currency)
+
+    @staticmethod
+    def get_all(user_id: str) -> list[RecurringRule]:
+        """
+        Retrieve all rules of a user from the database.
+
+        Args:
+            user_id (str): The ID of the user whose rules are to be retrieved.
+
+        Returns:
+            list[RecurringRule]: The rules of the user, oldest first.
+
+        Example:
+            >>> RecurringRule.get_all("123")
+            [<RecurringRule object at 0x...>, ...]
+        """
+        return [
+            RecurringRule(id, user_id, Money(amount), description, schedule, next_run_at, created_at,
+                          currency)
+            for id, _, amount, description, schedule, next_run_at, created_at, currency
+            in get_storage().get_recurring_rules(user_id)
+        ]
+
+    @staticmethod
+    def delete(user_id: str, rule_id: int) -> bool:
+        """
+        Delete a rule from the database. Records it already registered are
+        kept.
+
+        Args:
+            user_id (str): The ID of the user that owns the rule.
+            rule_id (int): The ID of the rule.
+
+        Returns:
+            bool: `True` if the rule was deleted, `False` if the user has no
+            such rule.
+
+        Example:
+            >>> RecurringRule.delete("123", 1)
+            True
+        """
+        return get_storage().delete_recurring_rule(user_id, rule_id)
+
+
+class CategoryRule:
+    """
+    Represents a category rule, which labels the records of a user whose
+    description contains a keyword or matches a regular expression.
+
+    The rules of a user are compiled together by `categories`, and the rule
+    matching first in a description gives its category.
+
+    Attributes:
+        id (int): The ID of the rule in the database.
+        user_id (str): The ID of the user that owns the rule.
+        category (str): The category the rule labels records with.
+        kind (str): `"keyword"`, matched as a whole word, or `"regex"`.
+        pattern (str): The keyword or the regular expression, matched
+            without regard to case.
+        created_at (datetime): The datetime timestamp of the rule.
+
+    Static Methods:
+        create: Create a new rule in the database.
+        get_all: Retrieve all rules of a user from the database.
+        get_classifier: Retrieve the compiled rules of a user.
+        delete: Delete a rule from the database.
+
+    Methods:
+        to_dict: Convert the rule object to a dictionary.
+    """
+
+    def __init__(self, id: int, user_id: str, category: str, kind: str, pattern: str,
+                 created_at: datetime) -> None:
+        """
+        Initialize a CategoryRule object.
+
+        Args:
+            id (int): The ID of the rule in the database.
+            user_id (str): The ID of the user that owns the rule.
+            category (str): The category the rule labels records with.
+            kind (str): `"keyword"` or `"regex"`.
+            pattern (str): The keyword or the regular expression.
+            created_at (datetime): The datetime timestamp of the rule.
+        """
+        self.id = id
+        self.user_id = user_id
+        self.category = category
+        self.kind = kind
+        self.pattern = pattern
+        self.created_at = created_at
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Convert the rule object to a dictionary.
+
+        Returns:
+            dict[str, Any]: A dictionary containing the rule's details, with
+            keys corresponding to the rule's attributes.
+
+        Example:
+            >>> rule.to_dict()
+            {
+                'id': 1,
+                'user_id': '123',
+                'category': 'transport',
+                'kind': 'keyword',
+                'pattern': 'uber',
+                'created_at': datetime.datetime(...)
+            }
+        """
+        return vars(self).copy()
+
+    @staticmethod
+    def create(user_id: str, category: str, kind: str, pattern: str) -> CategoryRule:
+        """
+        Create a new rule in the database.
+
+        The cached rules of the user are invalidated. Existing records are not
+        labeled by this method, see `categories.relabel`.
+
+        Args:
+            user_id (str): The ID of the user that owns the rule.
+            category (str): The category the rule labels records with.
+            kind (str): `"keyword"` or `"regex"`.
+            pattern (str): The keyword or the regular expression.
+
+        Returns:
+            CategoryRule: The `CategoryRule` object created.
+
+        Raises:
+            InvalidRule: If the rule is not valid.
+            ValueError: If the user already has `categories_config["max_rules"]`
+                rules.
+
+        Example:
+            >>> CategoryRule.create("123", "transport", "keyword", "uber")
+            <CategoryRule object at 0x...>
+        """
+        validate_rule(category, kind, pattern)
+        storage = get_storage()
+        if len(storage.get_category_rules(user_id)) >= categories_config["max_rules"]:
+            raise ValueError(f"A user can have at most {categories_config['max_rules']} rules")
+
+        created_at = datetime.now()
+        rule_id = storage.insert_category_rule(user_id, category, kind, pattern, created_at)
+        _invalidate(user_id, "category_rules")
+        return CategoryRule(rule_id, user_id, category, kind, pattern, created_at)
+
+    @staticmethod
+    def get_all(user_id: str) -> list[CategoryRule]:
+        """
+        Retrieve all rules of a user from the database.
+
+        Args:
+            user_id (str): The ID of the user whose rules are to be retrieved.
+
+        Returns:
+            list[CategoryRule]: The rules of the user, oldest first.
+
+        Example:
+            >>> CategoryRule.get_all("123")
+            [<CategoryRule object at 0x...>, ...]
+        """
+        return [CategoryRule(*row) for row in get_storage().get_category_rules(user_id)]
+
+    @staticmethod
+    def get_classifier(user_id: str) -> Classifier:
+        """
+        Retrieve the rules of a user, compiled into a classifier.
+
+        The rules are read from the shared cache, or from the database on a
+        miss, and the classifier compiled for the same rules is reused, so
+        labeling a record usually costs one cache lookup and one search.
+
+        Args:
+            user_id (str): The ID of the user.
+
+        Returns:
+            Classifier: The compiled rules of the user.
+
+        Example:
+            >>> CategoryRule.get_classifier("123").classify("Uber to work")
+            'transport'
+        """
+        cache = get_cache()
+        rules = cache.get("category_rules", user_id)
+        if rules is None:
+            rules = [[category, kind, pattern]
+                     for _, _, category, kind, pattern, _ in get_storage().get_category_rules(user_id)]
+            cache.set("category_rules", user_id, rules)
+        return compile_rules(tuple(tuple(rule) for rule in rules))
+
+    @staticmethod
+    def delete(user_id: str, rule_id: int) -> bool:
+        """
+        Delete a rule from the database. The cached rules of the user are
+        invalidated, but records keep their category until relabeled.
+
+        Args:
+            user_id (str): The ID of the user that owns the rule.
+            rule_id (int): The ID of the rule.
+
+        Returns:
+            bool: `True` if the rule was deleted, `False` if the user has no
+            such rule.
+
+        Example:
+            >>> CategoryRule.delete("123", 1)
+            True
+        """
+        deleted = get_storage().delete_category_rule(user_id, rule_id)
+        if deleted:
+            _invalidate(user_id, "category_rules")
+        return deleted
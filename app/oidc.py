@@ -0,0 +1,201 @@
+from __future__ import annotations
+import base64
+import json
+import os
+import threading
+import time
+from typing import Any, Callable
+
+oidc_config = {
+    "discovery_ttl": float(os.getenv("OIDC_DISCOVERY_TTL", 24 * 60 * 60)),
+    "jwks_ttl": float(os.getenv("OIDC_JWKS_TTL", 60 * 60)),
+    # Keys are fetched again for an unknown key ID, at most this often
+    "min_refresh_interval": 60,
+    # Allowed clock difference with the provider, in seconds
+    "leeway": 60,
+    "http_timeout": 5,
+}
+
+
+class InvalidIdToken(Exception):
+    """
+    Raised when an ID token is malformed, not signed by the provider, or not
+    valid for this app.
+    """
+
+
+def _fetch_json(url: str) -> dict[str, Any]:
+    import requests
+
+    response = requests.get(url, timeout=oidc_config["http_timeout"])
+    response.raise_for_status()
+    return response.json()
+
+
+class DocumentCache:
+    """
+    JSON documents fetched over HTTP and kept for a while, such as the
+    discovery document and the signing keys (JWKS) of the provider.
+
+    Attributes:
+        ttl (float): How long a document is kept, in seconds.
+        fetch (Callable[[str], dict[str, Any]]): The function that fetches a
+            document by URL.
+    """
+
+    def __init__(self, ttl: float, fetch: Callable[[str], dict[str, Any]] = _fetch_json) -> None:
+        """
+        Initialize a DocumentCache object.
+
+        Args:
+            ttl (float): How long a document is kept, in seconds.
+            fetch (Callable[[str], dict[str, Any]], optional): The function
+                that fetches a document by URL (default: an HTTP GET).
+        """
+        self.ttl = ttl
+        self.fetch = fetch
+        self._documents: dict[str, tuple[float, dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str, max_age: float | None = None) -> dict[str, Any]:
+        """
+        Get a document, fetching it if it is not cached or too old.
+
+        Args:
+            url (str): The URL of the document.
+            max_age (float | None, optional): Fetch the document again if the
+                cached copy is older than this, in seconds, or `None` for the
+                TTL (default: None).
+
+        Returns:
+            dict[str, Any]: The document.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            entry = self._documents.get(url)
+        if entry is not None and time.monotonic() - entry[0] < max_age:
+            return entry[1]
+
+        document = self.fetch(url)
+        with self._lock:
+            self._documents[url] = (time.monotonic(), document)
+        return document
+
+
+provider_configs = DocumentCache(oidc_config["discovery_ttl"])
+key_sets = DocumentCache(oidc_config["jwks_ttl"])
+
+
+def _b64decode(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+
+def _find_key(jwks_uri: str, kid: str | None) -> dict[str, Any]:
+    """
+    Find a signing key of the provider by its key ID.
+
+    The keys are cached for `oidc_config["jwks_ttl"]` seconds. A key ID that
+    is not in the cached keys means the provider rotated its keys, so they
+    are fetched again, at most every `oidc_config["min_refresh_interval"]`
+    seconds.
+
+    Args:
+        jwks_uri (str): The URL of the keys of the provider.
+        kid (str | None): The key ID from the token header.
+
+    Returns:
+        dict[str, Any]: The key, as a JWK.
+
+    Raises:
+        InvalidIdToken: If no RSA key has the key ID.
+    """
+    def find(key_set: dict[str, Any]) -> dict[str, Any] | None:
+        return next((key for key in key_set.get("keys", [])
+                     if key.get("kid") == kid and key.get("kty") == "RSA"), None)
+
+    key = find(key_sets.get(jwks_uri))
+    if key is None:
+        key = find(key_sets.get(jwks_uri, max_age=oidc_config["min_refresh_interval"]))
+    if key is None:
+        raise InvalidIdToken(f"Unknown signing key: {kid}")
+    return key
+
+
+def verify_id_token(token: str, client_id: str, issuers: tuple[str, ...], jwks_uri: str) -> dict[str, Any]:
+    """
+    Verify an OpenID Connect ID token locally and get its claims.
+
+    The RS256 signature is checked against the provider's keys, which are
+    cached, so verifying a token usually needs no request to the provider.
+    The issuer, the audience and the expiration are checked too.
+
+    Args:
+        token (str): The `id_token` returned by the token endpoint.
+        client_id (str): The OAuth2 client ID of the app, which must be an
+            audience of the token.
+        issuers (tuple[str, ...]): The accepted issuers.
+        jwks_uri (str): The URL of the keys of the provider, from its
+            discovery document.
+
+    Returns:
+        dict[str, Any]: The claims of the token.
+
+    Raises:
+        InvalidIdToken: If the token is malformed, its signature is invalid,
+            or it is not valid for this app at this time.
+
+    Example:
+        >>> verify_id_token(token, "1234.apps.googleusercontent.com",
+                            ("https://accounts.google.com",), jwks_uri)
+        {
+            "iss": "https://accounts.google.com",
+            "sub": "110169484474386276334",
+            "email": "john@example.com",
+            "email_verified": True,
+            ...
+        }
+    """
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+    try:
+        header_segment, claims_segment, signature_segment = token.split(".")
+        header = json.loads(_b64decode(header_segment))
+        claims = json.loads(_b64decode(claims_segment))
+        signature = _b64decode(signature_segment)
+    except ValueError as e:
+        raise InvalidIdToken("Malformed token") from e
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise InvalidIdToken("Malformed token")
+
+    if header.get("alg") != "RS256":
+        raise InvalidIdToken(f"Unsupported algorithm: {header.get('alg')}")
+
+    key = _find_key(jwks_uri, header.get("kid"))
+    public_key = rsa.RSAPublicNumbers(
+        int.from_bytes(_b64decode(key["e"]), "big"),
+        int.from_bytes(_b64decode(key["n"]), "big"),
+    ).public_key()
+    try:
+        public_key.verify(signature, f"{header_segment}.{claims_segment}".encode(),
+                          padding.PKCS1v15(), hashes.SHA256())
+    except InvalidSignature:
+        raise InvalidIdToken("Invalid signature") from None
+
+    now = time.time()
+    leeway = oidc_config["leeway"]
+    audiences = claims.get("aud")
+    if not isinstance(audiences, list):
+        audiences = [audiences]
+
+    if claims.get("iss") not in issuers:
+        raise InvalidIdToken(f"Unexpected issuer: {claims.get('iss')}")
+    if client_id not in audiences:
+        raise InvalidIdToken("Token issued for another client")
+    if not isinstance(claims.get("exp"), (int, float)) or claims["exp"] < now - leeway:
+        raise InvalidIdToken("Token expired")
+    if claims.get("iat", 0) > now + leeway:
+        raise InvalidIdToken("Token issued in the future")
+
+    return claims
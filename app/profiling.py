@@ -0,0 +1,166 @@
+from __future__ import annotations
+import cProfile
+import hmac
+import os
+import random
+import re
+import threading
+import time
+
+profiling_config = {
+    "token": os.getenv("PROFILE_TOKEN"),
+    "sample_rate": float(os.getenv("PROFILE_SAMPLE_RATE", 0)),
+    "directory": os.getenv("PROFILE_DIR", "profiles"),
+    "max_profiles": int(os.getenv("PROFILE_MAX_FILES", 100)),
+}
+
+_name_pattern = re.compile(r"[0-9]+-[A-Za-z0-9_]+-[0-9a-f]+\.prof")
+
+# Only one request is profiled at a time, since a profiler slows down every
+# thread it runs on and newer Python versions allow a single active profiler
+_profiling_lock = threading.Lock()
+
+
+def is_authorized(token: str | None) -> bool:
+    """
+    Check a profiling token sent by a client.
+
+    Args:
+        token (str | None): The value of the `X-Profile-Token` header.
+
+    Returns:
+        bool: `True` if profiling is enabled with a token and it matches.
+    """
+    expected = profiling_config["token"]
+    return bool(expected and token and hmac.compare_digest(token, expected))
+
+
+def start_profile(token: str | None) -> cProfile.Profile | None:
+    """
+    Start profiling the current request if it asks for it or is sampled.
+
+    A request is profiled when it carries the profiling token, or randomly
+    with probability `profiling_config["sample_rate"]`, and no other request
+    is being profiled. Unprofiled requests only pay for this check.
+
+    Args:
+        token (str | None): The value of the `X-Profile-Token` header.
+
+    Returns:
+        cProfile.Profile | None: The running profiler, or `None` if the
+        request is not profiled.
+    """
+    rate = profiling_config["sample_rate"]
+    if token is None and not (rate > 0 and random.random() < rate):
+        return None
+    if token is not None and not is_authorized(token):
+        return None
+    if not _profiling_lock.acquire(blocking=False):
+        return None
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is already active in the process
+        _profiling_lock.release()
+        return None
+    return profiler
+
+
+def stop_profile(profiler: cProfile.Profile, endpoint: str, trace_id: str) -> str:
+    """
+    Stop a profiler and save its stats in `profiling_config["directory"]`.
+
+    Profiles are saved in the pstats format, which can be read with
+    `python -m pstats` or tools like snakeviz. Only the most recent
+    `profiling_config["max_profiles"]` profiles are kept.
+
+    Args:
+        profiler (cProfile.Profile): The profiler returned by
+            `start_profile`.
+        endpoint (str): The endpoint of the profiled request.
+        trace_id (str): The trace ID of the profiled request.
+
+    Returns:
+        str: The name of the profile file.
+    """
+    try:
+        profiler.disable()
+    finally:
+        _profiling_lock.release()
+
+    directory = profiling_config["directory"]
+    os.makedirs(directory, exist_ok=True)
+
+    name = f"{time.time_ns()}-{re.sub(r'[^A-Za-z0-9_]', '_', endpoint)}-{trace_id}.prof"
+    profiler.dump_stats(os.path.join(directory, name))
+
+    for old in list_profiles()[profiling_config["max_profiles"]:]:
+        try:
+            os.remove(os.path.join(directory, old["name"]))
+        except FileNotFoundError:
+            pass
+
+    return name
+
+
+def list_profiles() -> list[dict[str, str | int | float]]:
+    """
+    List the saved profiles, most recent first.
+
+    Returns:
+        list[dict[str, str | int | float]]: The name, endpoint, trace ID,
+        creation time (Unix seconds) and size in bytes of each profile.
+
+    Example:
+        >>> list_profiles()
+        [
+            {
+                "name": "1718000000000000000-get_history-3f0c....prof",
+                "endpoint": "get_history",
+                "trace_id": "3f0c...",
+                "created_at": 1718000000.0,
+                "size": 48213
+            },
+            ...
+        ]
+    """
+    directory = profiling_config["directory"]
+    if not os.path.isdir(directory):
+        return []
+
+    profiles = []
+    for name in os.listdir(directory):
+        if not is_profile_name(name):
+            continue
+        created_ns, endpoint, trace_id = name[:-len(".prof")].split("-")
+        try:
+            size = os.path.getsize(os.path.join(directory, name))
+        except FileNotFoundError:
+            continue
+        profiles.append({
+            "name": name,
+            "endpoint": endpoint,
+            "trace_id": trace_id,
+            "created_at": int(created_ns) / 1e9,
+            "size": size,
+        })
+
+    profiles.sort(key=lambda profile: profile["created_at"], reverse=True)
+    return profiles
+
+
+def is_profile_name(name: str) -> bool:
+    """
+    Check whether a file name is the name of a saved profile.
+
+    This is used to validate names sent by clients before reading files.
+
+    Args:
+        name (str): The file name.
+
+    Returns:
+        bool: `True` if it is a profile name.
+    """
+    return _name_pattern.fullmatch(name) is not None
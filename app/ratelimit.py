@@ -0,0 +1,239 @@
+from __future__ import annotations
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any
+
+
+def _parse_limits(spec: str) -> dict[str, tuple[float, int]]:
+    """
+    Parse per-endpoint limits in the format `endpoint=rate:burst,...`.
+
+    Args:
+        spec (str): The limits specification.
+
+    Returns:
+        dict[str, tuple[float, int]]: The `(rate, burst)` of each endpoint.
+
+    Example:
+        >>> _parse_limits("post_gain=1:5,get_history=2:10")
+        {'post_gain': (1.0, 5), 'get_history': (2.0, 10)}
+    """
+    limits = {}
+    for item in filter(None, spec.split(",")):
+        endpoint, limit = item.strip().split("=")
+        rate, burst = limit.split(":")
+        limits[endpoint] = (float(rate), int(burst))
+    return limits
+
+
+rate_limit_config = {
+    "default": (
+        float(os.getenv("RATE_LIMIT_RATE", 5)),
+        int(os.getenv("RATE_LIMIT_BURST", 20)),
+    ),
+    "endpoints": {
+        "post_gain": (1.0, 10),
+        "post_expense": (1.0, 10),
+        **_parse_limits(os.getenv("RATE_LIMITS", "")),
+    },
+    "max_buckets": int(os.getenv("RATE_LIMIT_MAX_BUCKETS", 100000)),
+}
+
+admission_config = {
+    "max_pool_waiting": int(os.getenv("ADMISSION_MAX_POOL_WAITING", 20)),
+    "retry_after": int(os.getenv("ADMISSION_RETRY_AFTER", 1)),
+}
+
+
+class TokenBucket:
+    """
+    A token bucket that refills continuously up to its burst size.
+
+    Attributes:
+        rate (float): How many tokens are added per second.
+        burst (int): The maximum number of tokens in the bucket.
+        tokens (float): The tokens currently available.
+        updated_at (float): The monotonic time of the last refill.
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        """
+        Initialize a full TokenBucket object.
+
+        Args:
+            rate (float): How many tokens are added per second.
+            burst (int): The maximum number of tokens in the bucket.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def take(self) -> float:
+        """
+        Take a token from the bucket.
+
+        Returns:
+            float: `0` if a token was taken, otherwise how many seconds until
+            a token is available.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    In-process token-bucket rate limiter per user and endpoint.
+
+    Buckets are kept in an LRU map bounded by `max_buckets`. Evicting the
+    least recently used bucket is safe, since an idle bucket is refilled by
+    the time it is evicted in practice.
+
+    Methods:
+        check: Take a token for a user on an endpoint.
+        stats: Get the allowed and limited counters per endpoint.
+    """
+
+    def __init__(self, default: tuple[float, int], endpoints: dict[str, tuple[float, int]],
+                 max_buckets: int) -> None:
+        """
+        Initialize a RateLimiter object.
+
+        Args:
+            default (tuple[float, int]): The `(rate, burst)` for endpoints
+                without a specific limit.
+            endpoints (dict[str, tuple[float, int]]): The `(rate, burst)` of
+                each endpoint with a specific limit.
+            max_buckets (int): The maximum number of buckets kept in memory.
+        """
+        self.default = default
+        self.endpoints = endpoints
+        self.max_buckets = max_buckets
+        self._buckets: OrderedDict[tuple[str, str], TokenBucket] = OrderedDict()
+        self._allowed: defaultdict[str, int] = defaultdict(int)
+        self._limited: defaultdict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def check(self, key: str, endpoint: str) -> float:
+        """
+        Take a token for a user on an endpoint.
+
+        Args:
+            key (str): The user ID, or the client address for anonymous
+                requests.
+            endpoint (str): The name of the Flask endpoint.
+
+        Returns:
+            float: `0` if the request is allowed, otherwise how many seconds
+            the client should wait before retrying.
+
+        Example:
+            >>> rate_limiter.check("123", "post_gain")
+            0
+        """
+        with self._lock:
+            bucket = self._buckets.get((key, endpoint))
+            if bucket is None:
+                bucket = TokenBucket(*self.endpoints.get(endpoint, self.default))
+                self._buckets[(key, endpoint)] = bucket
+                if len(self._buckets) > self.max_buckets:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end((key, endpoint))
+
+            wait = bucket.take()
+            if wait:
+                self._limited[endpoint] += 1
+            else:
+                self._allowed[endpoint] += 1
+            return wait
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Get the rate limiter counters.
+
+        Returns:
+            dict[str, Any]: The allowed and limited requests per endpoint and
+            the number of buckets in memory.
+        """
+        with self._lock:
+            return {
+                "allowed": dict(self._allowed),
+                "limited": dict(self._limited),
+                "buckets": len(self._buckets),
+            }
+
+
+class AdmissionController:
+    """
+    Sheds requests early when the database connection pool is saturated.
+
+    A request is rejected before it touches the database when more than
+    `max_pool_waiting` queries are already waiting for a connection, instead
+    of piling up behind them and timing out.
+
+    Methods:
+        admit: Check whether a request can be admitted.
+        stats: Get the admitted and shed counters.
+    """
+
+    def __init__(self, max_pool_waiting: int) -> None:
+        """
+        Initialize an AdmissionController object.
+
+        Args:
+            max_pool_waiting (int): How many queries may wait for a database
+                connection before new requests are shed.
+        """
+        self.max_pool_waiting = max_pool_waiting
+        self._admitted = 0
+        self._shed = 0
+        self._lock = threading.Lock()
+
+    def admit(self, pool_waiting: int) -> bool:
+        """
+        Check whether a request can be admitted.
+
+        Args:
+            pool_waiting (int): How many queries are waiting for a database
+                connection.
+
+        Returns:
+            bool: `True` if the request is admitted, `False` if it must be
+            shed.
+        """
+        admitted = pool_waiting <= self.max_pool_waiting
+        with self._lock:
+            if admitted:
+                self._admitted += 1
+            else:
+                self._shed += 1
+        return admitted
+
+    def stats(self) -> dict[str, int]:
+        """
+        Get the admission counters.
+
+        Returns:
+            dict[str, int]: The admitted and shed requests.
+        """
+        with self._lock:
+            return {"admitted": self._admitted, "shed": self._shed}
+
+
+rate_limiter = RateLimiter(
+    default=rate_limit_config["default"],
+    endpoints=rate_limit_config["endpoints"],
+    max_buckets=rate_limit_config["max_buckets"],
+)
+admission_controller = AdmissionController(
+    max_pool_waiting=admission_config["max_pool_waiting"],
+)
@@ -0,0 +1,354 @@
+"""
+Register the records of recurring rules, such as a monthly salary or rent.
+
+Each rule has a cron-like schedule and the time of its next occurrence. On
+every tick, the occurrences that are due are registered as records, for all
+users at once, in batches of rules, and the rules are moved to their next
+occurrence in the same transaction. Occurrences missed while no scheduler
+was running are registered on the next tick, with the time they were due.
+
+Usage:
+    python app/recurring.py          # Register the due occurrences once
+    python app/recurring.py --loop   # Keep registering them on every tick
+"""
+from __future__ import annotations
+import argparse
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from psycopg2.extras import execute_values
+
+import metrics
+from cache import get_cache
+from categories import classify_records
+from db import load_query, shard_connection, shards, sqlite_database
+
+logger = logging.getLogger(__name__)
+
+recurring_config = {
+    # Whether the server runs the scheduler in a background thread
+    "scheduler": os.getenv("RECURRING_SCHEDULER", "1") == "1",
+    "tick_seconds": float(os.getenv("RECURRING_TICK_SECONDS", 60)),
+    "batch_size": int(os.getenv("RECURRING_BATCH_SIZE", 1000)),
+    # Occurrences registered per rule and batch when catching up, the rest
+    # are registered by the next batches
+    "max_catch_up": int(os.getenv("RECURRING_MAX_CATCH_UP", 1000)),
+    # Key of the Postgres advisory lock held while registering occurrences
+    "lock_key": 7_265_637_572,
+}
+
+
+class CronSchedule:
+    """
+    A cron-like schedule, with the five fields of a crontab line: minute,
+    hour, day of the month, month and day of the week.
+
+    Each field is `*`, a number, a range `a-b`, a step `*/n` or `a-b/n`, or a
+    comma-separated list of them. Days of the week go from 0 (Sunday) to 6,
+    and 7 is Sunday too. As in cron, when both the day of the month and the
+    day of the week are restricted, a day matching either of them matches.
+
+    Attributes:
+        expression (str): The schedule, such as '0 9 5 * *' (09:00 on the
+            5th of every month).
+    """
+
+    _ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str) -> None:
+        """
+        Initialize a CronSchedule object.
+
+        Args:
+            expression (str): The schedule, with five fields.
+
+        Raises:
+            ValueError: If the expression is not a valid schedule, or if it
+                never happens, such as on February 30th.
+        """
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"A schedule has 5 fields. Got: {expression!r}")
+
+        self.expression = " ".join(fields)
+        self._minutes, self._hours, self._days, self._months, weekdays = (
+            self._parse_field(field, low, high) for field, (low, high) in zip(fields, self._ranges))
+        self._weekdays = {weekday % 7 for weekday in weekdays}
+        self._days_and_weekdays = not fields[2].startswith("*") and not fields[4].startswith("*")
+
+        self.next_after(datetime(2000, 1, 1))
+
+    @staticmethod
+    def _parse_field(field: str, low: int, high: int) -> frozenset[int]:
+        values = set()
+        for item in field.split(","):
+            try:
+                item, _, step_text = item.partition("/")
+                step = int(step_text) if step_text else 1
+                if item == "*":
+                    start, end = low, high
+                elif "-" in item:
+                    start, end = (int(value) for value in item.split("-", 1))
+                else:
+                    start = int(item)
+                    end = high if step_text else start
+            except ValueError:
+                raise ValueError(f"Invalid schedule field: {field!r}") from None
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError(f"Invalid schedule field: {field!r}")
+            values.update(range(start, end + 1, step))
+        return frozenset(values)
+
+    def _day_matches(self, moment: datetime) -> bool:
+        in_days = moment.day in self._days
+        # Python counts weekdays from Monday, cron from Sunday
+        in_weekdays = (moment.weekday() + 1) % 7 in self._weekdays
+        if self._days_and_weekdays:
+            return in_days or in_weekdays
+        return in_days and in_weekdays
+
+    def next_after(self, moment: datetime) -> datetime:
+        """
+        Get the first occurrence of the schedule strictly after a moment.
+
+        Non-matching months, days and hours are skipped whole, so this takes
+        a few dozen steps at most.
+
+        Args:
+            moment (datetime): The moment.
+
+        Returns:
+            datetime: The next occurrence, on a whole minute.
+
+        Raises:
+            ValueError: If the schedule never happens.
+
+        Example:
+            >>> CronSchedule("0 9 5 * *").next_after(datetime(2024, 5, 30, 12, 0))
+            datetime.datetime(2024, 6, 5, 9, 0)
+        """
+        current = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Long enough for any schedule that happens, such as on February 29th
+        limit = current + timedelta(days=8 * 366)
+
+        while current <= limit:
+            if current.month not in self._months:
+                year, month = divmod(current.month, 12)
+                current = datetime(current.year + year, month + 1, 1)
+            elif not self._day_matches(current):
+                current = datetime(current.year, current.month, current.day) + timedelta(days=1)
+            elif current.hour not in self._hours:
+                current = current.replace(minute=0) + timedelta(hours=1)
+            elif current.minute not in self._minutes:
+                current += timedelta(minutes=1)
+            else:
+                return current
+
+        raise ValueError(f"The schedule never happens: {self.expression!r}")
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_schedule(expression: str) -> CronSchedule:
+    """
+    Parse a schedule, reusing the ones parsed before, since many rules share
+    the same schedule.
+
+    Args:
+        expression (str): The schedule, with five fields.
+
+    Returns:
+        CronSchedule: The parsed schedule.
+
+    Raises:
+        ValueError: If the expression is not a valid schedule.
+    """
+    return CronSchedule(expression)
+
+
+def _plan(rules: list[tuple], now: datetime) -> tuple[list[tuple], list[tuple]]:
+    """
+    Compute the records to register for due rules, and their next runs.
+
+    Args:
+        rules (list[tuple]): The `(id, user_id, amount_cents, description,
+            schedule, next_run_at, currency)` rows of the due rules.
+        now (datetime): The current time.
+
+    Returns:
+        tuple[list[tuple], list[tuple]]: The `(user_id, amount_cents,
+        description, created_at, currency)` records, and the `(id,
+        next_run_at)` of every rule.
+    """
+    records = []
+    next_runs = []
+    for id, user_id, amount, description, expression, next_run_at, currency in rules:
+        try:
+            schedule = parse_schedule(expression)
+        except ValueError:
+            # Rules are validated when created, so this is only a safeguard
+            logger.warning("Disabling recurring rule %d with invalid schedule %r", id, expression)
+            next_runs.append((id, datetime.max))
+            continue
+
+        occurrences = 0
+        while next_run_at <= now and occurrences < recurring_config["max_catch_up"]:
+            records.append((user_id, amount, description, next_run_at, currency))
+            next_run_at = schedule.next_after(next_run_at)
+            occurrences += 1
+        next_runs.append((id, next_run_at))
+
+    return records, next_runs
+
+
+def _run_batch(shard: int, now: datetime) -> tuple[int, set[str], bool] | None:
+    """
+    Register the occurrences of a batch of due rules of a shard.
+
+    The records are labeled with the category rules of their users, read in
+    the same transaction.
+
+    With Postgres, the batch runs under a transaction-level advisory lock,
+    so workers of other processes skip the shard instead of registering the
+    same occurrences. With SQLite, the write lock of the transaction plays
+    that role.
+
+    Args:
+        shard (int): The index of the shard in `shards`.
+        now (datetime): The current time.
+
+    Returns:
+        tuple[int, set[str], bool] | None: The number of records registered,
+        the IDs of their users and whether more rules may be due, or `None`
+        if another worker holds the lock.
+    """
+    batch_size = recurring_config["batch_size"]
+
+    if sqlite_database is not None:
+        with sqlite_database.transaction() as conn:
+            rules = conn.execute(load_query("select_due_recurring_rules.sql", "sqlite"),
+                                 (now, batch_size)).fetchall()
+            records, next_runs = _plan(rules, now)
+            user_ids = sorted({record[0] for record in records})
+            category_rules = conn.execute(load_query("select_users_category_rules.sql", "sqlite"),
+                                          (json.dumps(user_ids),)).fetchall()
+            records = classify_records(records, category_rules)
+            conn.executemany(load_query("insert_records.sql", "sqlite"), records)
+            conn.executemany(load_query("update_recurring_rules_next_run.sql", "sqlite"),
+                             [(next_run_at, id) for id, next_run_at in next_runs])
+            conn.commit()
+    else:
+        with shard_connection(shard, statement_timeout=False) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(load_query("lock_recurring_rules.sql"), (recurring_config["lock_key"],))
+                if not cursor.fetchone()[0]:
+                    conn.rollback()
+                    return None
+
+                cursor.execute(load_query("select_due_recurring_rules.sql"), (now, batch_size))
+                rules = cursor.fetchall()
+                records, next_runs = _plan(rules, now)
+                if records:
+                    cursor.execute(load_query("select_users_category_rules.sql"),
+                                   (sorted({record[0] for record in records}),))
+                    records = classify_records(records, cursor.fetchall())
+                    execute_values(cursor, load_query("insert_records.sql"), records, page_size=1000)
+                if next_runs:
+                    execute_values(cursor, load_query("update_recurring_rules_next_run.sql"),
+                                   next_runs, page_size=1000)
+            conn.commit()
+
+    more = len(rules) == batch_size or any(next_run_at <= now for _, next_run_at in next_runs)
+    return len(records), {record[0] for record in records}, more
+
+
+def tick(now: datetime | None = None) -> int:
+    """
+    Register the due occurrences of the recurring rules of every shard.
+
+    The due rules are processed in batches of `recurring_config["batch_size"]`,
+    each in one transaction with one bulk insert of records, until no rule is
+    due. The cached balance, history and analytics of the users that got
+    records are invalidated.
+
+    Args:
+        now (datetime | None, optional): The current time, or `None` for
+            `datetime.now()` (default: None).
+
+    Returns:
+        int: The number of records registered.
+
+    Example:
+        >>> tick()
+        1520
+    """
+    now = now or datetime.now()
+    created = 0
+
+    for shard in shards:
+        while True:
+            result = _run_batch(shard.index, now)
+            if result is None:
+                logger.debug("Recurring rules of shard %d are locked by another worker", shard.index)
+                break
+
+            records, users, more = result
+            created += records
+            cache = get_cache()
+            for user_id in users:
+                cache.delete(user_id, "balance", "history", "analytics")
+            if not more:
+                break
+
+    metrics.recurring_records.inc(amount=created)
+    return created
+
+
+def run_scheduler(stop: threading.Event) -> None:
+    """
+    Run `tick` every `recurring_config["tick_seconds"]` seconds until
+    stopped. Failures are logged and retried on the next tick.
+
+    Args:
+        stop (threading.Event): Set to stop the scheduler.
+    """
+    while not stop.is_set():
+        started_at = time.monotonic()
+        try:
+            created = tick()
+            if created:
+                logger.info("Registered %d records from recurring rules", created)
+        except Exception:
+            logger.exception("Failed to register the records of recurring rules")
+        stop.wait(max(0, recurring_config["tick_seconds"] - (time.monotonic() - started_at)))
+
+
+def start_scheduler() -> threading.Event:
+    """
+    Start the scheduler in a background thread.
+
+    Every process may run one: the lock taken by each batch makes sure an
+    occurrence is registered once.
+
+    Returns:
+        threading.Event: Set it to stop the scheduler.
+    """
+    stop = threading.Event()
+    threading.Thread(target=run_scheduler, args=(stop,), name="recurring", daemon=True).start()
+    return stop
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--loop", action="store_true", help="keep running on every tick")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.loop:
+        run_scheduler(threading.Event())
+    else:
+        print(f"Registered {tick()} records")
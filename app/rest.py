@@ -1,17 +1,23 @@
+import hashlib
 import json
+import mimetypes
 import os
-from typing import Any
+import time
+from datetime import datetime
+from functools import wraps
+from typing import Any, Callable
 
 from flask import (
     Flask,
-    g,
     jsonify,
     request,
     make_response,
     abort,
+    g,
     Response,
     redirect,
     send_from_directory,
+    session,
     url_for,
     render_template
 )
@@ -23,24 +29,39 @@ from flask_login import (
     logout_user,
     UserMixin,
 )
-from oauthlib.oauth2 import WebApplicationClient
 
-import requests
+import assets
+import categories
 import controller
 import db
-from models import User
+import fx
+import metrics
+import oidc
+import profiling
+import recurring
+import tracing
+from idempotency import idempotency_config, idempotency_store
+from models import Money, User
+from ratelimit import admission_config, admission_controller, rate_limiter
 
 
 # TODO: load BASE_URL based on the env
 BASE_URL = ""
 GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID", None)
 GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_CLIENT_SECRET", None)
-GOOGLE_DISCOVERY_URL = (
-    "https://accounts.google.com/.well-known/openid-configuration"
+GOOGLE_DISCOVERY_URL = os.environ.get(
+    "GOOGLE_DISCOVERY_URL", "https://accounts.google.com/.well-known/openid-configuration"
 )
 
+bootstrap_config = {
+    "history_size": int(os.getenv("BOOTSTRAP_HISTORY_SIZE", 50)),
+}
+
 app_dir = os.path.dirname(os.path.abspath(__file__))
 
+# Probes that must answer while the app is starting
+health_endpoints = ("healthz", "readyz")
+
 static_folder = os.path.abspath(os.path.join(app_dir, "../static"))
 template_folder = os.path.abspath(os.path.join(app_dir, "../static/templates"))
 
@@ -50,11 +71,30 @@ app = Flask(
   template_folder=template_folder
 )
 app.secret_key = os.environ.get("APP_SECRET_KEY")
+app.jinja_env.globals["asset_url"] = assets.asset_url
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 
-client = WebApplicationClient(GOOGLE_CLIENT_ID)
+_oauth_client = None
+
+
+def get_oauth_client():
+    """
+    Get the OAuth2 client used to log in with Google, creating it on first
+    use.
+
+    `oauthlib` is imported here rather than at module level, since only the
+    login endpoints need it and it slows down the start of the app.
+
+    Returns:
+        WebApplicationClient: The OAuth2 client.
+    """
+    global _oauth_client
+    if _oauth_client is None:
+        from oauthlib.oauth2 import WebApplicationClient
+        _oauth_client = WebApplicationClient(GOOGLE_CLIENT_ID)
+    return _oauth_client
 
 
 def _assert(
@@ -159,6 +199,151 @@ def _abort(
     abort(response)
 
 
+def idempotent(view: Callable) -> Callable:
+    """
+    Make a write endpoint safe to retry with an `Idempotency-Key` header.
+
+    When the request carries an `Idempotency-Key` header, the first request
+    with that key is processed normally and its response is stored. Any retry
+    with the same key gets the stored response back, with the
+    `Idempotent-Replayed` header set, without running the endpoint again.
+    Requests without the header are not affected.
+
+    Args:
+        view (Callable): The endpoint function to wrap. It must be used after
+            `login_required`, since keys are scoped by user.
+
+    Returns:
+        Callable: The wrapped endpoint function.
+
+    Error Responses:
+        400: The key is empty or longer than the maximum length.
+        409: A request with the same key is still being processed.
+        422: The key was already used with a different request body.
+
+    Example:
+        >>> @app.route("/gain", methods=["POST"])
+        >>> @login_required
+        >>> @idempotent
+        >>> def post_gain():
+        >>>     ...
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if key is None:
+            return view(*args, **kwargs)
+
+        max_length = idempotency_config["max_key_length"]
+        _assert(0 < len(key) <= max_length, 400, "Invalid Idempotency-Key header", {
+            "reason": f"Must have between 1 and {max_length} characters" })
+
+        user_id = current_user.id # type: ignore
+        request_hash = hashlib.sha256(request.get_data()).hexdigest()
+
+        stored = idempotency_store.claim(user_id, key, request_hash)
+        if stored is not None:
+            _assert(stored.request_hash == request_hash, 422,
+                    "Idempotency-Key already used with a different request")
+            _assert(not stored.in_progress, 409,
+                    "A request with this Idempotency-Key is being processed")
+
+            res = Response(stored.body, status=stored.status_code,
+                           mimetype="application/json")
+            res.headers["Idempotent-Replayed"] = "true"
+            return res
+
+        try:
+            res = make_response(view(*args, **kwargs))
+        except Exception:
+            idempotency_store.release(user_id, key)
+            raise
+
+        if res.status_code >= 500:
+            idempotency_store.release(user_id, key)
+        else:
+            idempotency_store.complete(user_id, key, request_hash,
+                                       res.status_code, res.get_data(as_text=True))
+        return res
+
+    return wrapper
+
+
+def _get_datetime_arg(name: str) -> datetime | None:
+    """
+    Get an optional ISO 8601 datetime from the query string.
+
+    Args:
+        name (str): The name of the query parameter.
+
+    Returns:
+        datetime | None: The parsed datetime, or `None` if the parameter is not
+        present. The request is aborted with a 400 response if it is not a
+        valid datetime.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+
+    try:
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is not None:
+            # Records are stored in the server's local time
+            parsed = parsed.astimezone().replace(tzinfo=None)
+        return parsed
+    except ValueError:
+        _abort(400, "Invalid query parameter", {
+            "invalid_field": name,
+            "reason": f"Must be an ISO 8601 datetime. Got: {value}"
+        })
+
+
+def _get_amount(amount: int | float) -> Money:
+    """
+    Convert an amount sent by a client to an exact amount of money.
+
+    Args:
+        amount (int | float): The amount, in currency units.
+
+    Returns:
+        Money: The amount, rounded to the nearest cent. The request is aborted
+        with a 400 response if it is not finite or too large.
+    """
+    try:
+        return Money.parse(amount)
+    except ValueError:
+        _abort(400, "Invalid field", {
+            "invalid_field": "amount",
+            "reason": f"Must be a finite number within range. Got: {amount}"
+        })
+
+
+def _get_currency(value: Any, message: str) -> str:
+    """
+    Validate an optional currency sent by a client, in the body or in the
+    query string.
+
+    Args:
+        value (Any): The ISO 4217 code of the currency, in any case, or
+            `None` for the base currency.
+        message (str): The error message of the 400 response.
+
+    Returns:
+        str: The currency code, in upper case. The request is aborted with a
+        400 response if it is not the base currency nor one with exchange
+        rates.
+    """
+    if value is None:
+        return fx.fx_config["base_currency"]
+
+    if not isinstance(value, str) or not fx.is_known(value.upper()):
+        _abort(400, message, {
+            "invalid_field": "currency",
+            "reason": f"Must be one of {', '.join(sorted(fx.get_rates().currencies))}. Got: {value}"
+        })
+    return value.upper()
+
+
 @login_manager.user_loader
 def load_user(user_id: str) -> UserMixin | None:
     """
@@ -168,6 +353,10 @@ def load_user(user_id: str) -> UserMixin | None:
     in the session. It expects a user ID as a string and returns a `UserMixin`
     object if the user is found, otherwise `None`.
 
+    On the app page, which embeds the bootstrap data of the user, the user is
+    read with that data, in a single query, and the data is kept in
+    `g.bootstrap` for `index`.
+
     Args:
         user_id (str): The ID of the user to be loaded.
 
@@ -182,6 +371,13 @@ def load_user(user_id: str) -> UserMixin | None:
         >>> load_user("nonexistent_id")
         None
     """
+    if request.endpoint == "index":
+        g.bootstrap = controller.get_bootstrap(user_id, bootstrap_config["history_size"])
+        if g.bootstrap is None:
+            return None
+        profile = g.bootstrap["user"]
+        return User(profile["id"], profile["username"], profile["email"], profile["profile_pic"])
+
     return controller.get_user(user_id)
 
 
@@ -191,7 +387,8 @@ def get_google_provider_cfg() -> dict[str, Any]:
 
     This function makes a GET request to the Google Discovery URL to fetch the
     OAuth2 provider configuration, including details like the authorization
-    endpoint, token endpoint, etc.
+    endpoint, token endpoint, etc. The configuration is cached for
+    `oidc_config["discovery_ttl"]` seconds.
 
     Returns:
         Dict[str, Any]: A dictionary containing the Google OAuth2 provider
@@ -206,7 +403,7 @@ def get_google_provider_cfg() -> dict[str, Any]:
             ...
         }
     """
-    return requests.get(GOOGLE_DISCOVERY_URL).json()
+    return oidc.provider_configs.get(GOOGLE_DISCOVERY_URL)
 
 
 @app.route("/login")
@@ -225,7 +422,7 @@ def login():
     google_provider_cfg = get_google_provider_cfg()
     authorization_endpoint = google_provider_cfg["authorization_endpoint"]
 
-    request_uri = client.prepare_request_uri(
+    request_uri = get_oauth_client().prepare_request_uri(
         authorization_endpoint,
         redirect_uri=f"{request.base_url}/callback",
         scope=["openid", "email", "profile"],
@@ -240,16 +437,22 @@ def callback():
     the user.
 
     This endpoint receives the authorization code from Google, exchanges it for
-    an access token, retrieves user information, creates or retrieves the user
-    from the database, logs the user in, and redirects them to the frontend
-    URL.
+    tokens, reads the user information from the claims of the ID token,
+    creates or updates the user in the database, logs the user in, and
+    redirects them to the frontend URL. The ID token is verified locally
+    against Google's cached signing keys, so no other request is made to
+    Google after the token exchange.
 
     Returns:
         redirect: Redirects the user to the frontend URL after successful
         login.
-        jsonify: Returns a JSON response with an error message if the user
-        email is not available or verified.
+        jsonify: Returns a JSON response with an error message if the ID
+        token is invalid (401) or if the user email is not available or
+        verified (400).
     """
+    import requests
+
+    client = get_oauth_client()
     code = request.args.get("code")
     google_provider_cfg = get_google_provider_cfg()
 
@@ -266,17 +469,27 @@ def callback():
         data=body,
         auth=(GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET), # type: ignore
     )
-    client.parse_request_body_response(json.dumps(token_response.json()))
+    tokens = token_response.json()
+    client.parse_request_body_response(json.dumps(tokens))
 
-    userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
-    uri, headers, body = client.add_token(userinfo_endpoint)
-    userinfo_response = requests.get(uri, headers=headers, data=body)
+    # Google also accepts its issuer without the scheme
+    issuer = google_provider_cfg["issuer"]
+    issuers = (issuer, issuer.removeprefix("https://"))
+    try:
+        claims = oidc.verify_id_token(tokens.get("id_token", ""), GOOGLE_CLIENT_ID, # type: ignore
+                                      issuers, google_provider_cfg["jwks_uri"])
+    except oidc.InvalidIdToken as e:
+        return jsonify(
+            {
+                "error": f"Invalid ID token: {e}"
+            }
+        ), 401
 
-    if userinfo_response.json().get("email_verified"):
-        unique_id = userinfo_response.json()["sub"]
-        users_email = userinfo_response.json()["email"]
-        picture = userinfo_response.json()["picture"]
-        users_name = userinfo_response.json()["given_name"]
+    if claims.get("email_verified"):
+        unique_id = claims["sub"]
+        users_email = claims["email"]
+        picture = claims.get("picture", "")
+        users_name = claims.get("given_name") or claims.get("name") or users_email
     else:
         return jsonify(
             {
@@ -285,7 +498,7 @@ def callback():
         ), 400
 
     try:
-        user = controller.get_or_create_user(unique_id, users_name, users_email, picture)
+        user = controller.upsert_user(unique_id, users_name, users_email, picture)
     except Exception as e:
         return jsonify(
             {
@@ -320,13 +533,65 @@ def logout():
 
 @app.route("/")
 def index():
-    return render_template("index.html", base_url=BASE_URL) # type: ignore
+    """
+    Render the app page with its content.
+
+    For a logged in user, the page embeds the user profile, the balance and
+    the latest `bootstrap_config["history_size"]` records as inline JSON,
+    gathered with a single database query, so the browser can show it
+    without any further request. `load_user` reads the data when Flask-Login
+    loads `current_user`, so the user is not read with a query of its own.
+
+    Returns:
+        str: The rendered page.
+    """
+    bootstrap = g.get("bootstrap") if current_user.is_authenticated else None
+
+    return render_template("index.html", base_url=BASE_URL, bootstrap=bootstrap) # type: ignore
+
+
+@app.route("/static/dist/<path:filename>")
+def get_asset(filename: str) -> Response:
+    """
+    Serve an asset built by `assets.py`.
+
+    Built assets have a hash of their content in their name, so they are
+    cached by browsers for a year without revalidation. The `.br` or `.gz`
+    variant written by the build is served when the browser accepts it.
+
+    Args:
+        filename (str): The name of the built asset.
+
+    Returns:
+        Response: The asset file.
+    """
+    dist_dir = os.path.join(static_folder, assets.assets_config["dist_dir"])
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    served, encoding = filename, None
+    for name, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if request.accept_encodings[name] > 0 and \
+                os.path.isfile(os.path.join(dist_dir, filename + suffix)):
+            served, encoding = filename + suffix, name
+            break
+
+    res = send_from_directory(dist_dir, served, mimetype=mimetype,
+                              max_age=assets.assets_config["cache_max_age"])
+    if encoding is not None:
+        res.headers["Content-Encoding"] = encoding
+    res.vary.add("Accept-Encoding")
+    res.cache_control.public = True
+    res.cache_control.immutable = True
+    return res
 
 
 @app.route("/get_content")
 def get_content():
     if current_user.is_authenticated:
-        res = make_response(render_template("authenticated.html", user=current_user))
+        bootstrap = controller.get_bootstrap(current_user.id, # type: ignore
+                                             bootstrap_config["history_size"])
+        res = make_response(render_template("authenticated.html", user=current_user,
+                                            bootstrap=bootstrap))
     else:
         res = make_response(render_template("login.html", base_url=BASE_URL))
 
@@ -411,7 +676,12 @@ def get_balance() -> tuple[Response,int]:
     Retrieve the current balance.
 
     This endpoint returns the current balance of the user. The response is a
-    JSON object containing the balance and additional metadata.
+    JSON object containing the balance and additional metadata. Records in
+    other currencies are converted at the rate of their day.
+
+    Query Parameters:
+        currency (str, optional): The currency of the balance. Defaults to
+            the base currency, BRL.
 
     Returns:
         tuple[Response, int]: A tuple where the first element is a Flask
@@ -420,25 +690,30 @@ def get_balance() -> tuple[Response,int]:
 
     Response JSON Structure:
         {
-            "balance": float   # The current balance amount
+            "balance": float,  # The current balance amount
+            "currency": str    # The currency of the balance
         }
 
     Example Response:
         HTTP/1.1 200 OK
         Content-Type: application/json
         {
-            "balance": 100.50
+            "balance": 100.50,
+            "currency": "BRL"
         }
 
     """
+    currency = _get_currency(request.args.get("currency"), "Invalid query parameter")
+
     status_code = 200
     user_id = current_user.id # type: ignore
 
     try:
-        balance = controller.get_balance(user_id)
+        balance = controller.get_balance(user_id, currency)
 
         res = {
-            "balance": balance
+            "balance": balance.to_float(),
+            "currency": currency,
         }
     except Exception as e:
         res = {
@@ -453,8 +728,87 @@ def get_balance() -> tuple[Response,int]:
     return jsonify(res), status_code
 
 
+@app.route("/analytics")
+@login_required
+def get_analytics() -> tuple[Response,int]:
+    """
+    Retrieve the spending trends and balance forecast.
+
+    This endpoint returns, for the last `analytics_config["days"]` days, the
+    daily income, expenses, closing balance and moving average of the
+    expenses, the totals of each month, the average expenses of each day of
+    the week, and the balance projected for the end of the month. Records in
+    other currencies are converted at the rate of their day.
+
+    Query Parameters:
+        currency (str, optional): The currency of the amounts. Defaults to
+            the base currency, BRL.
+
+    Returns:
+        tuple[Response, int]: A tuple where the first element is a Flask
+        `Response` object containing the JSON payload and the second element is
+        the HTTP status code.
+
+    Response JSON Structure:
+        {
+            "currency": str,       # The currency of the amounts
+            "since": str,          # The first day covered (ISO 8601)
+            "until": str,          # The last day covered, today
+            "daily": {
+                "dates": list[str],
+                "income": list[float],
+                "expenses": list[float],
+                "balance": list[float],
+                "expenses_moving_average": list[float]
+            },
+            "months": list[dict],    # income, expenses, net and records per month
+            "weekdays": list[dict],  # average expenses per day of the week
+            "forecast": {
+                "date": str,         # The last day of the month
+                "balance": float,    # The projected balance on that day
+                "daily_trend": float # How much the balance changes per day
+            }
+        }
+
+    Example Response:
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+        {
+            "currency": "BRL",
+            "since": "2024-03-02",
+            "until": "2024-05-30",
+            "daily": {"dates": ["2024-03-02", ...], ...},
+            "months": [{"month": "2024-03", "income": 3000.0, "expenses": 1250.4,
+                        "net": 1749.6, "records": 31}, ...],
+            "weekdays": [{"weekday": "monday", "average_expenses": 40.12}, ...],
+            "forecast": {"date": "2024-05-31", "balance": 5012.3, "daily_trend": -7.7}
+        }
+
+    """
+    currency = _get_currency(request.args.get("currency"), "Invalid query parameter")
+
+    status_code = 200
+    user_id = current_user.id # type: ignore
+
+    try:
+        with tracing.span("get_analytics"):
+            res = controller.get_analytics(user_id, currency)
+    except Exception as e:
+        res = {
+            "status": "error",
+            "reason": f"Erro during analytics for user {user_id}",
+            "adicional_info": {
+                "exception": str(e),
+                }
+        }
+        status_code = 500
+
+    return jsonify(res), status_code
+
+
 @app.route("/gain", methods=["POST"])
 @login_required
+@idempotent
 def post_gain() -> tuple[Response, int]:
     """
     Process and record a gain.
@@ -467,16 +821,26 @@ def post_gain() -> tuple[Response, int]:
     `Response` object containing the JSON payload and the second element is the
     HTTP status code.
 
+    Requests may carry an `Idempotency-Key` header so that retries return the
+    original response instead of registering the gain again.
+
+    The balance is in the currency of the optional `currency` query
+    parameter, BRL by default.
+
     Request JSON Structure:
         {
             "amount": float,     # The amount of the gain
-            "description": str   # A description of the gain
+            "description": str,  # A description of the gain, at most
+                                 # 200 characters by default
+            "currency": str      # Optional, the currency of the amount, BRL
+                                 # by default
         }
 
     Response JSON Structure (200):
         {
             "record": dict,    # A dictionary with the registered record
-            "balance": float   # The new balance after the registered record
+            "balance": float,  # The new balance after the registered record
+            "currency": str    # The currency of the balance
         }
 
     Error Response JSON Structure (400):
@@ -539,12 +903,13 @@ def post_gain() -> tuple[Response, int]:
     }
     _assert(isinstance(amount, int) or isinstance(amount, float),
             400, "Invalid field", aditional_info)
+    money = _get_amount(amount)
 
     aditional_info = {
         "invalid_field": "amount",
         "reason": f"Can't be 0. Got: {amount}"
     }
-    _assert(amount != 0, 400, "Invalid field", aditional_info)
+    _assert(bool(money), 400, "Invalid field", aditional_info)
 
     aditional_info = {
         "invalid_field": "amount",
@@ -560,16 +925,27 @@ def post_gain() -> tuple[Response, int]:
     }
     _assert(isinstance(description, str), 400, "Invalid field", aditional_info)
 
+    max_length = categories.categories_config["max_description_length"]
+    aditional_info = {
+        "invalid_field": "description",
+        "reason": f"Must have at most {max_length} characters. Got: {len(description)}"
+    }
+    _assert(len(description) <= max_length, 400, "Invalid field", aditional_info)
+
+    record_currency = _get_currency(data.get("currency"), "Invalid field")
+    currency = _get_currency(request.args.get("currency"), "Invalid query parameter")
+
     status_code = 200
     user_id = current_user.id # type: ignore
 
     try:
-        rec = controller.register_gain(user_id, amount, description)
-        balance = controller.get_balance(user_id)
+        rec = controller.register_gain(user_id, money, description, record_currency)
+        balance = controller.get_balance(user_id, currency)
 
         res = {
             "record": rec.to_dict(),
-            "balance": balance
+            "balance": balance.to_float(),
+            "currency": currency,
         }
     except Exception as e:
         res = {
@@ -586,6 +962,7 @@ def post_gain() -> tuple[Response, int]:
 
 @app.route("/expense", methods=["POST"])
 @login_required
+@idempotent
 def post_expense():
     """
     Process and record an expense.
@@ -598,16 +975,26 @@ def post_expense():
     `Response` object containing the JSON payload and the second element is the
     HTTP status code.
 
+    Requests may carry an `Idempotency-Key` header so that retries return the
+    original response instead of registering the expense again.
+
+    The balance is in the currency of the optional `currency` query
+    parameter, BRL by default.
+
     Request JSON Structure:
         {
             "amount": float,     # The amount of the expense
-            "description": str   # A description of the expense
+            "description": str,  # A description of the expense, at most
+                                 # 200 characters by default
+            "currency": str      # Optional, the currency of the amount, BRL
+                                 # by default
         }
 
     Response JSON Structure (200):
         {
             "record": dict,    # A dictionary with the registered record
-            "balance": float   # The new balance after the registered record
+            "balance": float,  # The new balance after the registered record
+            "currency": str    # The currency of the balance
         }
 
     Error Response JSON Structure (400):
@@ -670,12 +1057,13 @@ def post_expense():
     }
     _assert(isinstance(amount, int) or isinstance(amount, float),
             400, "Invalid field", aditional_info)
+    money = _get_amount(amount)
 
     aditional_info = {
         "invalid_field": "amount",
         "reason": f"Can't be 0. Got: {amount}"
     }
-    _assert(amount != 0, 400, "Invalid field", aditional_info)
+    _assert(bool(money), 400, "Invalid field", aditional_info)
 
     aditional_info = {
         "invalid_field": "amount",
@@ -691,15 +1079,26 @@ def post_expense():
     }
     _assert(isinstance(description, str), 400, "Invalid field", aditional_info)
 
+    max_length = categories.categories_config["max_description_length"]
+    aditional_info = {
+        "invalid_field": "description",
+        "reason": f"Must have at most {max_length} characters. Got: {len(description)}"
+    }
+    _assert(len(description) <= max_length, 400, "Invalid field", aditional_info)
+
+    record_currency = _get_currency(data.get("currency"), "Invalid field")
+    currency = _get_currency(request.args.get("currency"), "Invalid query parameter")
+
     status_code = 200
     user_id = current_user.id # type: ignore
     try:
-        rec = controller.register_expense(user_id, amount, description)
-        balance = controller.get_balance(user_id)
+        rec = controller.register_expense(user_id, money, description, record_currency)
+        balance = controller.get_balance(user_id, currency)
 
         res = {
             "record": rec.to_dict(),
-            "balance": balance
+            "balance": balance.to_float(),
+            "currency": currency,
         }
     except Exception as e:
         res = {
@@ -714,64 +1113,50 @@ def post_expense():
     return jsonify(res), status_code
 
 
-@app.route("/history", methods=["GET"])
-def get_history() -> tuple[Response,int]:
+@app.route("/recurring", methods=["GET"])
+@login_required
+def get_recurring_rules() -> tuple[Response, int]:
     """
-    Retrieve the history of all records.
-
-    This endpoint returns a list of all records. Each record contains
-    information about individual transactions or events.
+    Retrieve the recurring rules of the user.
 
     Returns:
         tuple[Response, int]: A tuple where the first element is a Flask
         `Response` object containing the JSON payload and the second element is
         the HTTP status code.
 
-    Response JSON Structure (200):
-        [
-            {
-                "amount": float,      # The amount associated with the record
-                "description": str,   # A description of the record
-                "ts": str             # The timestamp of when the record was
-                                      # created
-            },
-            ...
-        ]
+    Response JSON Structure:
+        {
+            "rules": list[dict]   # The rules, oldest first
+        }
 
-    Example Success Response:
+    Example Response:
         HTTP/1.1 200 OK
         Content-Type: application/json
-        [
-            {
-                "amount": 100.50,
-                "description": "Found in my old pants",
-                "ts": "2024-05-23T10:00:00Z"
-            },
-            {
-                "amount": -50.00,
-                "description": "Buy new pants",
-                "ts": "2024-05-24T15:30:00Z"
-            }
-        ]
-
+        {
+            "rules": [
+                {
+                    "id": 1,
+                    "amount": -1500.0,
+                    "description": "Rent",
+                    "schedule": "0 9 5 * *",
+                    "next_run_at": "Wed, 05 Jun 2024 09:00:00 GMT",
+                    ...
+                }
+            ]
+        }
     """
     status_code = 200
     user_id = current_user.id # type: ignore
 
     try:
-        user = controller.get_user(user_id)
-        records = user.get_records()
-        history = [rec.to_dict() for rec in records]
-        balance = sum([rec.amount for rec in records])
-
+        rules = controller.get_recurring_rules(user_id)
         res = {
-            "history": history,
-            "balance": balance,
+            "rules": [rule.to_dict() for rule in rules],
         }
     except Exception as e:
         res = {
             "status": "error",
-            "reason": f"Erro during get history for user {user_id}",
+            "reason": f"Erro during get recurring rules for user {user_id}",
             "adicional_info": {
                 "exception": str(e),
                 }
@@ -781,37 +1166,868 @@ def get_history() -> tuple[Response,int]:
     return jsonify(res), status_code
 
 
-@app.before_request
-def before_request():
+@app.route("/recurring", methods=["POST"])
+@login_required
+@idempotent
+def post_recurring_rule() -> tuple[Response, int]:
     """
-    Initialize the database connection pool before each request.
+    Create a recurring rule, which registers a gain or an expense on every
+    occurrence of a cron-like schedule.
 
-    This function is called before each request to initialize the connection
-    pool, ensuring that database connections are ready to be used by the
-    request handlers. It sets up necessary resources required for handling the
-    request.
+    The schedule has the five fields of a crontab line: minute, hour, day of
+    the month, month and day of the week. Occurrences are registered by the
+    scheduler within `RECURRING_TICK_SECONDS` seconds, with the time they
+    were due.
+
+    Requests may carry an `Idempotency-Key` header so that retries return the
+    original response instead of creating the rule again.
 
     Returns:
-        None
-    """
-    db.init_pool()
+        tuple[Response, int]: A tuple where the first element is a Flask
+        `Response` object containing the JSON payload and the second element is
+        the HTTP status code.
 
+    Request JSON Structure:
+        {
+            "type": str,         # "gain" or "expense"
+            "amount": float,     # The amount of each record
+            "description": str,  # A description of each record, at
+                                 # most 200 characters by default
+            "schedule": str,     # The schedule, such as "0 9 5 * *"
+            "currency": str      # Optional, the currency of the amount, BRL
+                                 # by default
+        }
+
+    Response JSON Structure (200):
+        {
+            "rule": dict   # A dictionary with the created rule
+        }
+
+    Example Success Response:
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+        {
+            "rule": {
+                "id": 1,
+                "amount": -1500.0,
+                "description": "Rent",
+                "schedule": "0 9 5 * *",
+                "next_run_at": "Wed, 05 Jun 2024 09:00:00 GMT",
+                "currency": "BRL",
+                ...
+            }
+        }
 
-@app.teardown_appcontext
-def teardown_appcontext(exception):
+    Example Error Response:
+        HTTP/1.1 400 Bad Request
+        Content-Type: application/json
+        {
+            "status": "error",
+            "reason": "Invalid field",
+            "additional_info": {
+                "invalid_field": "schedule",
+                "reason": "Invalid schedule field: '61'"
+            }
+        }
     """
-    Release the connection pool after each request.
+    try:
+        data = request.get_json()
+    except Exception:
+        data = {}
 
-    This function is called after each request to release the database
-    connection pool, ensuring that all connections are properly closed and
-    resources are cleaned up. It helps maintain the stability and performance
-    of the application by managing the connection lifecycle.
+    required_fields = ["type", "amount", "description", "schedule"]
+    missing_fields = []
 
-    Args: exception (Exception): The exception that was raised during the
-    request, if any.
+    _assert(data is not None, 400, "Missing request body")
 
-    Returns:
-        None
+    for field in required_fields:
+        if field not in data:
+            missing_fields.append(field)
+
+    _assert(not bool(missing_fields), 400, "Missing body fields", {
+        "missing_fields": missing_fields })
+
+    kind: str = data.get("type") # type: ignore
+
+    aditional_info = {
+        "invalid_field": "type",
+        "reason": f"Must be 'gain' or 'expense'. Got: {kind}"
+    }
+    _assert(kind in ("gain", "expense"), 400, "Invalid field", aditional_info)
+
+    amount: int | float = data.get("amount") # type: ignore
+
+    aditional_info = {
+        "invalid_field": "amount",
+        "reason": f"Must be a number. Got: {type(amount).__name__}"
+    }
+    _assert(isinstance(amount, int) or isinstance(amount, float),
+            400, "Invalid field", aditional_info)
+    money = _get_amount(amount)
+
+    aditional_info = {
+        "invalid_field": "amount",
+        "reason": f"Must be a positive number. Got: {amount}"
+    }
+    _assert(money.cents > 0, 400, "Invalid field", aditional_info)
+
+    description: str = data.get("description") # type: ignore
+
+    aditional_info = {
+        "invalid_field": "description",
+        "reason": f"Must be a string. Got: {type(description).__name__}"
+    }
+    _assert(isinstance(description, str), 400, "Invalid field", aditional_info)
+
+    max_length = categories.categories_config["max_description_length"]
+    aditional_info = {
+        "invalid_field": "description",
+        "reason": f"Must have at most {max_length} characters. Got: {len(description)}"
+    }
+    _assert(len(description) <= max_length, 400, "Invalid field", aditional_info)
+
+    schedule: str = data.get("schedule") # type: ignore
+
+    aditional_info = {
+        "invalid_field": "schedule",
+        "reason": f"Must be a string. Got: {type(schedule).__name__}"
+    }
+    _assert(isinstance(schedule, str), 400, "Invalid field", aditional_info)
+
+    try:
+        recurring.parse_schedule(schedule)
+    except ValueError as e:
+        _abort(400, "Invalid field", {
+            "invalid_field": "schedule",
+            "reason": str(e)
+        })
+
+    rule_currency = _get_currency(data.get("currency"), "Invalid field")
+
+    status_code = 200
+    user_id = current_user.id # type: ignore
+
+    try:
+        rule = controller.create_recurring_rule(
+            user_id, money if kind == "gain" else -money, description, schedule, rule_currency)
+        res = {
+            "rule": rule.to_dict(),
+        }
+    except Exception as e:
+        res = {
+            "status": "error",
+            "reason": f"Erro during recurring rule creation for user {user_id}",
+            "adicional_info": {
+                "exception": str(e),
+                }
+        }
+        status_code = 500
+
+    return jsonify(res), status_code
+
+
+@app.route("/recurring/<int:rule_id>", methods=["DELETE"])
+@login_required
+def delete_recurring_rule(rule_id: int) -> tuple[Response, int]:
+    """
+    Delete a recurring rule of the user. Records it already registered are
+    kept.
+
+    Args:
+        rule_id (int): The ID of the rule.
+
+    Returns:
+        tuple[Response, int]: A tuple where the first element is a Flask
+        `Response` object containing the JSON payload and the second element is
+        the HTTP status code, 404 if the user has no such rule.
+
+    Example Response:
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+        {
+            "deleted": 1
+        }
+    """
+    user_id = current_user.id # type: ignore
+
+    try:
+        deleted = controller.delete_recurring_rule(user_id, rule_id)
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "reason": f"Erro during recurring rule deletion for user {user_id}",
+            "adicional_info": {
+                "exception": str(e),
+                }
+        }), 500
+
+    _assert(deleted, 404, "Recurring rule not found")
+    return jsonify({"deleted": rule_id}), 200
+
+
+@app.route("/categories/rules", methods=["GET"])
+@login_required
+def get_category_rules() -> tuple[Response, int]:
+    """
+    Retrieve the category rules of the user.
+
+    Returns:
+        tuple[Response, int]: A tuple where the first element is a Flask
+        `Response` object containing the JSON payload and the second element is
+        the HTTP status code.
+
+    Response JSON Structure:
+        {
+            "rules": list[dict]   # The rules, oldest first, which is their
+                                  # order of priority
+        }
+
+    Example Response:
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+        {
+            "rules": [
+                {
+                    "id": 1,
+                    "category": "transport",
+                    "kind": "keyword",
+                    "pattern": "uber",
+                    ...
+                }
+            ]
+        }
+    """
+    status_code = 200
+    user_id = current_user.id # type: ignore
+
+    try:
+        rules = controller.get_category_rules(user_id)
+        res = {
+            "rules": [rule.to_dict() for rule in rules],
+        }
+    except Exception as e:
+        res = {
+            "status": "error",
+            "reason": f"Erro during get category rules for user {user_id}",
+            "adicional_info": {
+                "exception": str(e),
+                }
+        }
+        status_code = 500
+
+    return jsonify(res), status_code
+
+
+@app.route("/categories/rules", methods=["POST"])
+@login_required
+@idempotent
+def post_category_rule() -> tuple[Response, int]:
+    """
+    Create a category rule, which labels the records whose description
+    contains a keyword, as a whole word, or matches a regular expression.
+    Both are matched without regard to case.
+
+    New records are labeled right away, and the existing records of the user
+    are labeled again in the background.
+
+    Requests may carry an `Idempotency-Key` header so that retries return the
+    original response instead of creating the rule again.
+
+    Returns:
+        tuple[Response, int]: A tuple where the first element is a Flask
+        `Response` object containing the JSON payload and the second element is
+        the HTTP status code.
+
+    Request JSON Structure:
+        {
+            "category": str,   # The category, such as "transport"
+            "kind": str,       # "keyword" or "regex"
+            "pattern": str     # The keyword or the regular expression
+        }
+
+    Response JSON Structure (200):
+        {
+            "rule": dict   # A dictionary with the created rule
+        }
+
+    Example Error Response:
+        HTTP/1.1 400 Bad Request
+        Content-Type: application/json
+        {
+            "status": "error",
+            "reason": "Invalid field",
+            "additional_info": {
+                "invalid_field": "pattern",
+                "reason": "Regular expressions can't have capturing groups, use (?:...)"
+            }
+        }
+    """
+    try:
+        data = request.get_json()
+    except Exception:
+        data = {}
+
+    required_fields = ["category", "kind", "pattern"]
+    missing_fields = []
+
+    _assert(data is not None, 400, "Missing request body")
+
+    for field in required_fields:
+        if field not in data:
+            missing_fields.append(field)
+
+    _assert(not bool(missing_fields), 400, "Missing body fields", {
+        "missing_fields": missing_fields })
+
+    for field in required_fields:
+        aditional_info = {
+            "invalid_field": field,
+            "reason": f"Must be a string. Got: {type(data[field]).__name__}"
+        }
+        _assert(isinstance(data[field], str), 400, "Invalid field", aditional_info)
+
+    category: str = data["category"].strip()
+    kind: str = data["kind"]
+    pattern: str = data["pattern"]
+
+    try:
+        categories.validate_rule(category, kind, pattern)
+    except categories.InvalidRule as e:
+        _abort(400, "Invalid field", {
+            "invalid_field": e.field,
+            "reason": str(e)
+        })
+
+    status_code = 200
+    user_id = current_user.id # type: ignore
+
+    try:
+        rule = controller.create_category_rule(user_id, category, kind, pattern)
+        res = {
+            "rule": rule.to_dict(),
+        }
+    except ValueError as e:
+        # Too many rules
+        _abort(400, "Invalid request", {"reason": str(e)})
+    except Exception as e:
+        res = {
+            "status": "error",
+            "reason": f"Erro during category rule creation for user {user_id}",
+            "adicional_info": {
+                "exception": str(e),
+                }
+        }
+        status_code = 500
+
+    return jsonify(res), status_code
+
+
+@app.route("/categories/rules/<int:rule_id>", methods=["DELETE"])
+@login_required
+def delete_category_rule(rule_id: int) -> tuple[Response, int]:
+    """
+    Delete a category rule of the user. The records of the user are labeled
+    again without it in the background.
+
+    Args:
+        rule_id (int): The ID of the rule.
+
+    Returns:
+        tuple[Response, int]: A tuple where the first element is a Flask
+        `Response` object containing the JSON payload and the second element is
+        the HTTP status code, 404 if the user has no such rule.
+
+    Example Response:
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+        {
+            "deleted": 1
+        }
+    """
+    user_id = current_user.id # type: ignore
+
+    try:
+        deleted = controller.delete_category_rule(user_id, rule_id)
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "reason": f"Erro during category rule deletion for user {user_id}",
+            "adicional_info": {
+                "exception": str(e),
+                }
+        }), 500
+
+    _assert(deleted, 404, "Category rule not found")
+    return jsonify({"deleted": rule_id}), 200
+
+
+@app.route("/categories/totals", methods=["GET"])
+@login_required
+def get_category_totals() -> tuple[Response, int]:
+    """
+    Retrieve the income, expenses, net result and number of records of each
+    category, summed by the database over the records that were not
+    archived. Records in other currencies are converted at the rate of their
+    day.
+
+    Query Parameters:
+        since (str, optional): Only count records created at or after this
+            datetime (ISO 8601). Defaults to the start of the current month.
+        until (str, optional): Only count records created before this
+            datetime (ISO 8601).
+        currency (str, optional): The currency of the totals. Defaults to
+            the base currency, BRL.
+
+    Returns:
+        tuple[Response, int]: A tuple where the first element is a Flask
+        `Response` object containing the JSON payload and the second element is
+        the HTTP status code.
+
+    Response JSON Structure:
+        {
+            "currency": str,           # The currency of the totals
+            "categories": list[dict]   # The totals of each category, by name,
+                                       # with uncategorized records last
+        }
+
+    Example Response:
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+        {
+            "currency": "BRL",
+            "categories": [
+                {"category": "food", "income": 0.0, "expenses": 842.5,
+                 "net": -842.5, "records": 31},
+                {"category": null, "income": 5000.0, "expenses": 12.0,
+                 "net": 4988.0, "records": 3}
+            ]
+        }
+    """
+    since = _get_datetime_arg("since")
+    until = _get_datetime_arg("until")
+    currency = _get_currency(request.args.get("currency"), "Invalid query parameter")
+
+    status_code = 200
+    user_id = current_user.id # type: ignore
+
+    try:
+        res = {
+            "currency": currency,
+            "categories": controller.get_category_totals(user_id, since, until, currency),
+        }
+    except Exception as e:
+        res = {
+            "status": "error",
+            "reason": f"Erro during category totals for user {user_id}",
+            "adicional_info": {
+                "exception": str(e),
+                }
+        }
+        status_code = 500
+
+    return jsonify(res), status_code
+
+
+@app.route("/history", methods=["GET"])
+def get_history() -> tuple[Response,int]:
+    """
+    Retrieve the history of all records.
+
+    This endpoint returns a list of all records. Each record contains
+    information about individual transactions or events. The optional `since`
+    and `until` query parameters (ISO 8601 datetimes) limit the history to
+    records created in that range, and only the months in the range are read
+    from the database. Without `since`, only records that were not archived
+    yet are returned; archived records are included when `since` is older
+    than the archived period.
+
+    The balance is the user's total balance when no range is given, otherwise
+    the sum of the returned records. Each record has its amount in its own
+    currency, and converted to the currency of the history at the rate of its
+    day, which the balance is in.
+
+    Query Parameters:
+        since (str, optional): Only return records created at or after this
+            datetime.
+        until (str, optional): Only return records created before this
+            datetime.
+        currency (str, optional): The currency of the history. Defaults to
+            the base currency, BRL.
+
+    Returns:
+        tuple[Response, int]: A tuple where the first element is a Flask
+        `Response` object containing the JSON payload and the second element is
+        the HTTP status code.
+
+    Response JSON Structure (200):
+        [
+            {
+                "amount": float,      # The amount associated with the record
+                "description": str,   # A description of the record
+                "ts": str             # The timestamp of when the record was
+                                      # created
+            },
+            ...
+        ]
+
+    Example Success Response:
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+        [
+            {
+                "amount": 100.50,
+                "description": "Found in my old pants",
+                "ts": "2024-05-23T10:00:00Z"
+            },
+            {
+                "amount": -50.00,
+                "description": "Buy new pants",
+                "ts": "2024-05-24T15:30:00Z"
+            }
+        ]
+
+    """
+    since = _get_datetime_arg("since")
+    until = _get_datetime_arg("until")
+    currency = _get_currency(request.args.get("currency"), "Invalid query parameter")
+
+    status_code = 200
+    user_id = current_user.id # type: ignore
+
+    try:
+        with tracing.span("get_records"):
+            records = controller.get_records(user_id, since, until)
+        with tracing.span("to_dict", records=len(records)):
+            history, balance = controller.convert_history(records, currency)
+        if since is None and until is None:
+            balance += controller.get_carry_forward(user_id, currency)
+
+        res = {
+            "history": history,
+            "balance": balance.to_float(),
+            "currency": currency,
+        }
+    except Exception as e:
+        res = {
+            "status": "error",
+            "reason": f"Erro during get history for user {user_id}",
+            "adicional_info": {
+                "exception": str(e),
+                }
+        }
+        status_code = 500
+
+    with tracing.span("jsonify"):
+        return jsonify(res), status_code
+
+
+@app.route("/stats", methods=["GET"])
+def get_stats() -> tuple[Response,int]:
+    """
+    Retrieve the rate limiting and admission control counters.
+
+    This endpoint is meant for monitoring. It returns how many requests were
+    allowed and limited per endpoint, and how many were admitted and shed
+    because the database connection pool was saturated.
+
+    Returns:
+        tuple[Response, int]: A tuple where the first element is a Flask
+        `Response` object containing the JSON payload and the second element is
+        the HTTP status code.
+
+    Response JSON Structure (200):
+        {
+            "rate_limit": {
+                "allowed": dict,    # Allowed requests per endpoint
+                "limited": dict,    # Limited requests per endpoint
+                "buckets": int      # Token buckets in memory
+            },
+            "admission": {
+                "admitted": int,    # Admitted requests
+                "shed": int,        # Shed requests
+                "pool_waiting": int # Queries waiting for a connection
+            }
+        }
+    """
+    res = {
+        "rate_limit": rate_limiter.stats(),
+        "admission": {
+            **admission_controller.stats(),
+            "pool_waiting": db.pool_waiting(),
+        },
+    }
+    return jsonify(res), 200
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz() -> tuple[Response, int]:
+    """
+    Liveness probe.
+
+    It answers as soon as the server accepts connections, without touching
+    the database, so that orchestrators only restart the process when it is
+    stuck, not while the database is unavailable.
+
+    Returns:
+        tuple[Response, int]: `{"status": "ok"}` with status 200.
+    """
+    return jsonify({"status": "ok"}), 200
+
+
+@app.route("/readyz", methods=["GET"])
+def readyz() -> tuple[Response, int]:
+    """
+    Readiness probe.
+
+    It answers 200 once the database is initialized and the connection pools
+    are open, and 503 before, so that orchestrators only route traffic to the
+    process when it can serve requests. Other endpoints also answer 503 until
+    then.
+
+    Returns:
+        tuple[Response, int]: `{"status": "ready"}` with status 200, or
+        `{"status": "starting"}` with status 503.
+    """
+    if not db.is_ready():
+        return jsonify({"status": "starting"}), 503
+    return jsonify({"status": "ready"}), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics() -> Response:
+    """
+    Expose the application metrics in the Prometheus text format.
+
+    The metrics include, per SQL query file, the latency histogram, the
+    number of returned rows and the errors, the time spent waiting for a
+    database connection, and the latency histogram of each endpoint.
+
+    Returns:
+        Response: A `text/plain` response with the metrics.
+
+    Example Response:
+        HTTP/1.1 200 OK
+        Content-Type: text/plain; version=0.0.4
+        # HELP db_query_duration_seconds Time spent executing each SQL file
+        # TYPE db_query_duration_seconds histogram
+        db_query_duration_seconds_bucket{query="get_records.sql",le="0.001"} 12
+        ...
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/profiles", methods=["GET"])
+def list_profiles() -> tuple[Response, int]:
+    """
+    List the most recent request profiles.
+
+    Requests are profiled when they carry the `X-Profile-Token` header with
+    the token configured in `PROFILE_TOKEN`, or when they are sampled with
+    probability `PROFILE_SAMPLE_RATE`. Their profiles are saved in the pstats
+    format and the response of the profiled request has an `X-Profile-Id`
+    header with the profile name. This endpoint requires the same header.
+
+    Returns:
+        tuple[Response, int]: A tuple where the first element is a Flask
+        `Response` object containing the JSON payload and the second element is
+        the HTTP status code.
+
+    Response JSON Structure (200):
+        {
+            "profiles": [
+                {
+                    "name": str,          # The profile name
+                    "endpoint": str,      # The profiled endpoint
+                    "trace_id": str,      # The trace ID of the request
+                    "created_at": float,  # Unix time of the request
+                    "size": int           # Size of the profile in bytes
+                },
+                ...
+            ]
+        }
+
+    Error Response (404):
+        Profiling is disabled or the token is wrong.
+    """
+    _assert(profiling.is_authorized(request.headers.get("X-Profile-Token")),
+            404, "Not found")
+    return jsonify({"profiles": profiling.list_profiles()}), 200
+
+
+@app.route("/profiles/<name>", methods=["GET"])
+def get_profile(name: str) -> Response:
+    """
+    Download a request profile in the pstats format.
+
+    It requires the `X-Profile-Token` header, like `/profiles`.
+
+    Args:
+        name (str): The profile name, as listed by `/profiles`.
+
+    Returns:
+        Response: The profile file.
+
+    Example:
+        curl -H "X-Profile-Token: $PROFILE_TOKEN" -o history.prof https://localhost:5000/profiles/<name>
+        python -m pstats history.prof
+    """
+    _assert(profiling.is_authorized(request.headers.get("X-Profile-Token")),
+            404, "Not found")
+    _assert(profiling.is_profile_name(name), 404, "Profile not found")
+    return send_from_directory(os.path.abspath(profiling.profiling_config["directory"]),
+                               name, mimetype="application/octet-stream")
+
+
+def _limit_request() -> Response | None:
+    """
+    Apply admission control and rate limiting to the current request.
+
+    Requests are shed with a 503 response when the database connection pool
+    is saturated, and limited with a 429 response when the user (or the
+    client address, for anonymous requests) ran out of tokens for the
+    endpoint. The user ID is read from the session, so that no database query
+    is made before the request is admitted.
+
+    Returns:
+        Response | None: The error response if the request must be rejected,
+        otherwise `None`.
+    """
+    if request.endpoint in (None, "static", "get_asset", "get_stats", "get_metrics", *health_endpoints):
+        return None
+
+    if not admission_controller.admit(db.pool_waiting()):
+        res = make_response(jsonify({
+            "status": "error",
+            "reason": "Server overloaded",
+        }), 503)
+        res.headers["Retry-After"] = str(admission_config["retry_after"])
+        return res
+
+    key = session.get("_user_id") or request.remote_addr or ""
+    wait = rate_limiter.check(key, request.endpoint)
+    if wait:
+        res = make_response(jsonify({
+            "status": "error",
+            "reason": "Too many requests",
+        }), 429)
+        res.headers["Retry-After"] = str(int(wait) + 1)
+        return res
+
+    return None
+
+
+@app.before_request
+def before_request():
+    """
+    Prepare each request before it is handled.
+
+    This function is called before each request to start its trace and, if
+    requested, its profile, and to reject it early if the database is not
+    initialized yet, if it is over the rate limit or if the server is
+    overloaded. Accepted requests get a unit of work, so all of their queries
+    share one connection and one transaction, committed by `after_request`.
+    Its reads skip the read replicas when the session says the user wrote in
+    the last `REPLICA_STICKY_SECONDS` seconds, whichever process served the
+    write.
+
+    Returns:
+        Response | None: The error response if the request was rejected,
+        otherwise `None`.
+    """
+    g.request_start = time.perf_counter()
+    g.trace = tracing.start_trace(request.endpoint or "unmatched",
+                                  request.headers.get("X-Trace-Id"),
+                                  method=request.method, path=request.path)
+    if request.endpoint not in ("list_profiles", "get_profile"):
+        g.profiler = profiling.start_profile(request.headers.get("X-Profile-Token"))
+
+    if request.endpoint not in health_endpoints and not db.is_ready():
+        res = make_response(jsonify({
+            "status": "error",
+            "reason": "Server starting",
+        }), 503)
+        res.headers["Retry-After"] = "1"
+        return res
+
+    res = _limit_request()
+    if res is None:
+        last_write_at = session.get("last_write_at")
+        db.begin(primary_reads=last_write_at is not None and
+                 time.time() - last_write_at < db.replica_config["sticky_seconds"])
+    return res
+
+
+@app.after_request
+def after_request(response: Response) -> Response:
+    """
+    Commit the unit of work of the request, record the latency of the
+    request in the `http_request_duration_seconds` metric, by endpoint,
+    method and status code, and finish its trace and profile. The trace ID is
+    returned in the `X-Trace-Id` header and the profile name, if the request
+    was profiled, in the `X-Profile-Id` header.
+
+    The changes of requests that fail with a 5xx status are rolled back. The
+    commit happens before the response is sent, so a request whose commit
+    fails gets a 500 response instead of the one of the endpoint. When the
+    request wrote and there are read replicas, the time of the write is kept
+    in the session, so the next reads of the user go to the primary even in
+    another process.
+
+    Args:
+        response (Response): The response of the request.
+
+    Returns:
+        Response: The same response, or an error response if the commit
+        failed.
+    """
+    unit = db.current_unit_of_work()
+    if unit is not None:
+        if response.status_code >= 500:
+            unit.rollback()
+        else:
+            try:
+                unit.commit()
+                if unit.has_writes() and any(shard.replicas for shard in db.shards):
+                    session["last_write_at"] = time.time()
+            except Exception as e:
+                response = make_response(jsonify({
+                    "status": "error",
+                    "reason": "Error while saving the changes of the request",
+                    "adicional_info": {
+                        "exception": str(e),
+                    }
+                }), 500)
+
+    start = g.get("request_start")
+    if start is not None:
+        metrics.http_request_duration.observe(
+            time.perf_counter() - start, request.endpoint or "unmatched",
+            request.method, str(response.status_code))
+
+    trace = g.get("trace")
+    if trace is not None:
+        trace.attributes["status"] = response.status_code
+        tracing.finish_trace(trace)
+        response.headers["X-Trace-Id"] = trace.trace_id
+
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            response.headers["X-Profile-Id"] = profiling.stop_profile(
+                profiler, request.endpoint or "unmatched", trace.trace_id)
+    return response
+
+
+@app.teardown_request
+def teardown_request(error: BaseException | None) -> None:
+    """
+    Roll back the unit of work of a request that `after_request` did not
+    end, such as one interrupted by an error in another hook, so that its
+    connection goes back to the pool.
+
+    Args:
+        error (BaseException | None): The unhandled error of the request, if
+            any.
     """
-    if "connection_pool" in g:
-        g.connection_pool.closeall()
+    unit = db.current_unit_of_work()
+    if unit is not None:
+        unit.rollback()
@@ -0,0 +1,242 @@
+"""
+Admin tools for a sharded deployment.
+
+Usage:
+    python app/shards.py move <user_id> <shard>
+    python app/shards.py stats
+"""
+import argparse
+import logging
+
+from psycopg2.extras import Json, execute_values
+
+from cache import get_cache
+from db import (
+    execute_on_all_shards,
+    execute_query,
+    load_query,
+    refresh_directory,
+    shard_connection,
+    shard_for,
+    shards,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _copy_records(user_id: str, target: int, rows: list[tuple]) -> int:
+    """
+    Insert records of a user into a shard.
+
+    Args:
+        user_id (str): The ID of the user that owns the records.
+        target (int): The index of the shard to insert the records into.
+        rows (list[tuple]): The `(id, amount_cents, description, created_at,
+            category, currency)` rows to insert, ordered by ID.
+
+    Returns:
+        int: The ID of the last copied record in the source shard, or `0` if
+        there were no rows.
+    """
+    if not rows:
+        return 0
+
+    with shard_connection(target) as conn:
+        with conn.cursor() as cursor:
+            execute_values(cursor, load_query("copy_records.sql"), [
+                (user_id, amount, description, created_at, category, currency)
+                for _, amount, description, created_at, category, currency in rows
+            ])
+        conn.commit()
+
+    return rows[-1][0]
+
+
+def _copy_archives(cursor, user_id: str, target: int) -> None:
+    """
+    Copy the archived records and carry-forward totals of a user to a shard.
+
+    Args:
+        cursor: A cursor on the source shard.
+        user_id (str): The ID of the user.
+        target (int): The index of the shard to copy the archive into.
+    """
+    cursor.execute(load_query("select_user_archives.sql"), (user_id,))
+    archives = [(*row[:4], Json(row[4])) for row in cursor.fetchall()]
+    cursor.execute(load_query("select_user_carry_forward.sql"), (user_id,))
+    carry_forward = cursor.fetchall()
+
+    with shard_connection(target) as conn:
+        with conn.cursor() as target_cursor:
+            if archives:
+                execute_values(target_cursor, load_query("copy_archives.sql"), archives)
+            if carry_forward:
+                execute_values(target_cursor, load_query("copy_carry_forward.sql"), carry_forward)
+        conn.commit()
+
+
+def _copy_recurring_rules(cursor, user_id: str, target: int) -> None:
+    """
+    Copy the recurring rules of a user to a shard.
+
+    Args:
+        cursor: A cursor on the source shard.
+        user_id (str): The ID of the user.
+        target (int): The index of the shard to copy the rules into.
+    """
+    cursor.execute(load_query("get_recurring_rules.sql"), (user_id,))
+    rules = [row[1:] for row in cursor.fetchall()]
+    if not rules:
+        return
+
+    with shard_connection(target) as conn:
+        with conn.cursor() as target_cursor:
+            execute_values(target_cursor, load_query("copy_recurring_rules.sql"), rules)
+        conn.commit()
+
+
+def _copy_category_rules(cursor, user_id: str, target: int) -> None:
+    """
+    Copy the category rules of a user to a shard.
+
+    Args:
+        cursor: A cursor on the source shard.
+        user_id (str): The ID of the user.
+        target (int): The index of the shard to copy the rules into.
+    """
+    cursor.execute(load_query("get_category_rules.sql"), (user_id,))
+    rules = [row[1:] for row in cursor.fetchall()]
+    if not rules:
+        return
+
+    with shard_connection(target) as conn:
+        with conn.cursor() as target_cursor:
+            execute_values(target_cursor, load_query("copy_category_rules.sql"), rules)
+        conn.commit()
+
+
+def move_user(user_id: str, target: int) -> int:
+    """
+    Move a user and their records to another shard while the app is running.
+
+    The rows are copied in two phases. The bulk of the records is copied
+    without any lock. Then the user row is locked in the source shard with
+    `SELECT ... FOR UPDATE`, which blocks new records of the user from being
+    inserted there, and the records inserted in the meantime are copied.
+    Archived records, the carry-forward totals, the recurring rules and the
+    category rules are copied while the lock is held too.
+
+    Once every copy is committed in the target shard, the directory is
+    updated and the user is deleted from the source shard. The directory
+    lives in the first shard, so when the user moves away from it both
+    happen in the same transaction. Otherwise the directory is committed
+    first: if the source shard then fails to commit, the directory already
+    points at a complete copy, and the rows left in the source shard are
+    never read and are dropped if the user moves back to it.
+
+    Requests for the user that were blocked by the lock fail once the user is
+    deleted from the source shard, and are routed to the new shard when
+    retried. The cached data of the user is invalidated, so the next request
+    reads the user from the database, and a process whose directory is older
+    than the move reloads it when the user is not found in their old shard
+    (see `storage.SqlStorage.get_user`).
+
+    Record, recurring rule and category rule IDs are assigned by the target
+    shard, so they change with the move.
+
+    Args:
+        user_id (str): The ID of the user to move.
+        target (int): The index of the shard to move the user to.
+
+    Returns:
+        int: The number of records moved.
+
+    Raises:
+        Exception: If the user is not found in their current shard.
+
+    Example:
+        >>> move_user("123", 2)
+        1520
+    """
+    source = shard_for(user_id)
+    if source == target:
+        return 0
+
+    user = execute_query("select_user_by_id.sql", (user_id,), shard=source)
+    if not user:
+        raise Exception(f"User id not found: {user_id}")
+
+    # Drop leftovers of a previous move that didn't finish
+    execute_query("delete_user_data.sql", (user_id,) * 7, shard=target)
+    execute_query("copy_user.sql", user[0], shard=target)
+
+    rows = execute_query("select_records_after_id.sql", (user_id, 0), shard=source) or []
+    copied_until = _copy_records(user_id, target, rows)
+    moved = len(rows)
+
+    with shard_connection(source) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(load_query("lock_user.sql"), (user_id,))
+            cursor.execute(load_query("select_records_after_id.sql"), (user_id, copied_until))
+            rows = cursor.fetchall()
+            _copy_records(user_id, target, rows)
+            moved += len(rows)
+            _copy_archives(cursor, user_id, target)
+            _copy_recurring_rules(cursor, user_id, target)
+            _copy_category_rules(cursor, user_id, target)
+
+            if source == 0:
+                cursor.execute(load_query("upsert_user_shard.sql"), (user_id, target))
+            else:
+                execute_query("upsert_user_shard.sql", (user_id, target), shard=0)
+            cursor.execute(load_query("delete_user_data.sql"), (user_id,) * 7)
+        try:
+            conn.commit()
+        except Exception:
+            if source != 0:
+                logger.warning("User %s was moved to shard %d, but their rows could not be "
+                               "deleted from shard %d", user_id, target, source)
+            raise
+
+    refresh_directory(force=True)
+    get_cache().delete(user_id, "user", "balance", "history", "analytics", "category_rules")
+    return moved
+
+
+def shard_stats() -> list[dict[str, int]]:
+    """
+    Count the users and records of every shard.
+
+    The counts are queried on all shards in parallel.
+
+    Returns:
+        list[dict[str, int]]: The number of users and records of each shard.
+
+    Example:
+        >>> shard_stats()
+        [{"shard": 0, "users": 10, "records": 1520}, ...]
+    """
+    rows = execute_on_all_shards("shard_stats.sql")
+    return [
+        {"shard": shard.index, "users": users, "records": records}
+        for shard, (users, records) in zip(shards, rows)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    move_parser = subparsers.add_parser("move", help="Move a user to another shard")
+    move_parser.add_argument("user_id")
+    move_parser.add_argument("shard", type=int)
+
+    subparsers.add_parser("stats", help="Count users and records per shard")
+
+    args = parser.parse_args()
+    if args.command == "move":
+        moved = move_user(args.user_id, args.shard)
+        print(f"Moved user {args.user_id} with {moved} records to shard {args.shard}")
+    else:
+        for stats in shard_stats():
+            print(f"shard {stats['shard']}: {stats['users']} users, {stats['records']} records")
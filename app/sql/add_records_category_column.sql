@@ -0,0 +1 @@
+ALTER TABLE records ADD COLUMN category TEXT;
@@ -0,0 +1 @@
+ALTER TABLE recurring_rules ADD COLUMN currency TEXT NOT NULL DEFAULT 'BRL';
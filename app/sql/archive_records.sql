@@ -0,0 +1,23 @@
+WITH moved AS (
+  DELETE FROM records
+   WHERE created_at >= %s AND created_at < %s
+  RETURNING id, user_id, amount_cents, description, created_at, category, currency
+), archived AS (
+  INSERT INTO record_archives (user_id, month, record_count, total_cents, payload)
+  SELECT user_id, %s, count(*), COALESCE(sum(amount_cents), 0),
+         jsonb_agg(jsonb_build_array(id, amount_cents, description, created_at, category, currency) ORDER BY created_at)
+    FROM moved
+   GROUP BY user_id
+  ON CONFLICT (user_id, month) DO UPDATE
+    SET record_count = record_archives.record_count + EXCLUDED.record_count,
+        total_cents = record_archives.total_cents + EXCLUDED.total_cents,
+        payload = record_archives.payload || EXCLUDED.payload
+  RETURNING user_id
+)
+INSERT INTO record_carry_forward (user_id, currency, total_cents, archived_until)
+SELECT user_id, currency, COALESCE(sum(amount_cents), 0), %s
+  FROM moved
+ GROUP BY user_id, currency
+ON CONFLICT (user_id, currency) DO UPDATE
+  SET total_cents = record_carry_forward.total_cents + EXCLUDED.total_cents,
+      archived_until = GREATEST(record_carry_forward.archived_until, EXCLUDED.archived_until);
@@ -0,0 +1,17 @@
+WITH claimed AS (
+  INSERT INTO idempotency_keys (user_id, key, request_hash, created_at)
+  VALUES (%s, %s, %s, %s)
+  ON CONFLICT (user_id, key) DO UPDATE
+    SET request_hash = EXCLUDED.request_hash,
+        created_at = EXCLUDED.created_at,
+        status_code = NULL,
+        response = NULL
+    WHERE idempotency_keys.created_at < %s
+  RETURNING key
+)
+SELECT TRUE, NULL::text, NULL::integer, NULL::text FROM claimed
+UNION ALL
+SELECT FALSE, request_hash, status_code, response
+  FROM idempotency_keys
+ WHERE user_id = %s AND key = %s
+   AND NOT EXISTS (SELECT 1 FROM claimed);
@@ -0,0 +1 @@
+UPDATE idempotency_keys SET status_code = %s, response = %s WHERE user_id = %s AND key = %s;
@@ -0,0 +1 @@
+INSERT INTO record_archives (user_id, month, record_count, total_cents, payload) VALUES %s;
@@ -0,0 +1 @@
+INSERT INTO record_carry_forward (user_id, total_cents, archived_until, currency) VALUES %s;
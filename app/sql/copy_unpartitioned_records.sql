@@ -0,0 +1,5 @@
+INSERT INTO records (id, user_id, amount, description, created_at)
+SELECT id, user_id, amount, description, COALESCE(created_at, 'epoch')
+  FROM records_unpartitioned;
+
+DROP TABLE records_unpartitioned;
@@ -0,0 +1 @@
+INSERT INTO users (id, name, email, profile_pic) VALUES (%s, %s, %s, %s) ON CONFLICT (id) DO NOTHING;
@@ -0,0 +1 @@
+CREATE TABLE IF NOT EXISTS {partition} PARTITION OF records FOR VALUES FROM (%s) TO (%s);
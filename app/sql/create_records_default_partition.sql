@@ -0,0 +1,2 @@
+CREATE TABLE IF NOT EXISTS records_default PARTITION OF records DEFAULT;
+CREATE INDEX IF NOT EXISTS records_user_id_created_at_idx ON records (user_id, created_at);
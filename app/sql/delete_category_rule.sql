@@ -0,0 +1 @@
+DELETE FROM category_rules WHERE id = %s AND user_id = %s RETURNING id;
@@ -0,0 +1,7 @@
+DELETE FROM idempotency_keys WHERE user_id = %s;
+DELETE FROM record_archives WHERE user_id = %s;
+DELETE FROM record_carry_forward WHERE user_id = %s;
+DELETE FROM records WHERE user_id = %s;
+DELETE FROM recurring_rules WHERE user_id = %s;
+DELETE FROM category_rules WHERE user_id = %s;
+DELETE FROM users WHERE id = %s;
@@ -0,0 +1 @@
+SELECT payload FROM record_archives WHERE user_id = %s AND month >= %s AND month < %s ORDER BY month;
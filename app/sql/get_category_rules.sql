@@ -0,0 +1,4 @@
+SELECT id, user_id, category, kind, pattern, created_at
+  FROM category_rules
+ WHERE user_id = %s
+ ORDER BY id;
@@ -0,0 +1 @@
+SELECT * FROM records WHERE user_id = %s AND created_at >= %s AND created_at < %s;
@@ -0,0 +1,2 @@
+INSERT INTO category_rules (user_id, category, kind, pattern, created_at)
+VALUES (%s, %s, %s, %s, %s) RETURNING id;
@@ -1 +1 @@
-INSERT INTO records (user_id, amount, description, created_at) VALUES (%s, %s, %s, %s) RETURNING id;
+INSERT INTO records (user_id, amount_cents, description, created_at, category, currency) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id;
@@ -0,0 +1 @@
+SELECT id FROM users WHERE id = %s FOR UPDATE;
@@ -0,0 +1,10 @@
+ALTER TABLE record_archives RENAME COLUMN total TO total_cents;
+ALTER TABLE record_archives
+  ALTER COLUMN total_cents TYPE BIGINT USING round(total_cents::numeric * 100)::bigint;
+
+UPDATE record_archives SET payload = COALESCE((
+  SELECT jsonb_agg(jsonb_set(
+    item, '{1}', COALESCE(to_jsonb(round((item->>1)::numeric * 100)::bigint), 'null'::jsonb)
+  ) ORDER BY position)
+  FROM jsonb_array_elements(payload) WITH ORDINALITY AS items(item, position)
+), '[]'::jsonb);
@@ -0,0 +1,3 @@
+ALTER TABLE record_carry_forward ADD COLUMN currency TEXT NOT NULL DEFAULT 'BRL';
+ALTER TABLE record_carry_forward DROP CONSTRAINT record_carry_forward_pkey;
+ALTER TABLE record_carry_forward ADD PRIMARY KEY (user_id, currency);
@@ -0,0 +1,3 @@
+ALTER TABLE record_carry_forward RENAME COLUMN total TO total_cents;
+ALTER TABLE record_carry_forward
+  ALTER COLUMN total_cents TYPE BIGINT USING round(total_cents::numeric * 100)::bigint;
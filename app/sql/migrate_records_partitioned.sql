@@ -0,0 +1,13 @@
+LOCK TABLE records IN ACCESS EXCLUSIVE MODE;
+ALTER TABLE records RENAME TO records_unpartitioned;
+
+CREATE TABLE records (
+  id INTEGER NOT NULL DEFAULT nextval('records_id_seq'),
+  user_id TEXT REFERENCES users(id),
+  amount float,
+  description varchar,
+  created_at timestamp NOT NULL,
+  PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE records_id_seq OWNED BY records.id;
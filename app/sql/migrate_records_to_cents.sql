@@ -0,0 +1,5 @@
+-- Floats are converted through numeric, which keeps the 15 significant
+-- digits a float holds exactly, before rounding to cents
+ALTER TABLE records RENAME COLUMN amount TO amount_cents;
+ALTER TABLE records
+  ALTER COLUMN amount_cents TYPE BIGINT USING round(amount_cents::numeric * 100)::bigint;
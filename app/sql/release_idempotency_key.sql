@@ -0,0 +1 @@
+DELETE FROM idempotency_keys WHERE user_id = %s AND key = %s AND status_code IS NULL;
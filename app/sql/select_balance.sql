@@ -0,0 +1,17 @@
+SELECT totals.currency, totals.day, totals.cents
+  FROM users
+  LEFT JOIN (
+    SELECT currency,
+           CASE WHEN currency = %s THEN 0 ELSE floor(extract(epoch FROM created_at) / 86400)::bigint END AS day,
+           sum(amount_cents)::bigint AS cents
+      FROM records
+     WHERE user_id = %s
+     GROUP BY 1, 2
+    UNION ALL
+    SELECT currency,
+           CASE WHEN currency = %s THEN 0 ELSE floor(extract(epoch FROM archived_until) / 86400)::bigint END,
+           total_cents
+      FROM record_carry_forward
+     WHERE user_id = %s
+  ) AS totals ON true
+ WHERE users.id = %s;
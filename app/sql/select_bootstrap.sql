@@ -0,0 +1,40 @@
+SELECT
+  users.id,
+  users.name,
+  users.email,
+  users.profile_pic,
+  COALESCE((
+    SELECT json_agg(json_build_array(totals.currency, totals.day, totals.cents))
+    FROM (
+      SELECT currency,
+             CASE WHEN currency = %s THEN 0 ELSE floor(extract(epoch FROM created_at) / 86400)::bigint END AS day,
+             sum(amount_cents)::bigint AS cents
+        FROM records
+       WHERE user_id = users.id
+       GROUP BY 1, 2
+      UNION ALL
+      SELECT currency,
+             CASE WHEN currency = %s THEN 0 ELSE floor(extract(epoch FROM archived_until) / 86400)::bigint END,
+             total_cents
+        FROM record_carry_forward
+       WHERE user_id = users.id
+    ) AS totals
+  ), '[]'::json),
+  COALESCE((
+    SELECT json_agg(json_build_array(
+      page.id,
+      page.amount_cents,
+      page.description,
+      to_char(page.created_at, 'YYYY-MM-DD"T"HH24:MI:SS.US'),
+      page.category,
+      page.currency
+    ) ORDER BY page.created_at, page.id)
+    FROM (
+      SELECT id, amount_cents, description, created_at, category, currency FROM records
+      WHERE user_id = users.id
+      ORDER BY created_at DESC, id DESC
+      LIMIT %s
+    ) AS page
+  ), '[]'::json)
+FROM users
+WHERE users.id = %s;
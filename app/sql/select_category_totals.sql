@@ -0,0 +1,10 @@
+SELECT category,
+       currency,
+       CASE WHEN currency = %s THEN 0 ELSE floor(extract(epoch FROM created_at) / 86400)::bigint END AS day,
+       COALESCE(sum(amount_cents) FILTER (WHERE amount_cents > 0), 0)::bigint,
+       COALESCE(-sum(amount_cents) FILTER (WHERE amount_cents < 0), 0)::bigint,
+       count(*)
+  FROM records
+ WHERE user_id = %s AND created_at >= %s AND created_at < %s
+ GROUP BY 1, 2, 3
+ ORDER BY category NULLS LAST;
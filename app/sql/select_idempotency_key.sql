@@ -0,0 +1,3 @@
+SELECT FALSE, request_hash, status_code, response
+  FROM idempotency_keys
+ WHERE user_id = %s AND key = %s;
@@ -0,0 +1 @@
+SELECT min(created_at) FROM records;
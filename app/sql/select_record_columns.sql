@@ -0,0 +1,4 @@
+SELECT floor(extract(epoch FROM created_at))::bigint, amount_cents, currency
+  FROM records
+ WHERE user_id = %s AND created_at >= %s
+ ORDER BY created_at;
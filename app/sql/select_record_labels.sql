@@ -0,0 +1,5 @@
+SELECT id, created_at, description, category
+  FROM records
+ WHERE user_id = %s AND created_at >= %s AND created_at < %s AND (created_at, id) > (%s, %s)
+ ORDER BY created_at, id
+ LIMIT %s;
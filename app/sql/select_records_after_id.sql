@@ -0,0 +1 @@
+SELECT id, amount_cents, description, created_at, category, currency FROM records WHERE user_id = %s AND id > %s ORDER BY id;
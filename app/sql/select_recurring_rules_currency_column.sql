@@ -0,0 +1,2 @@
+SELECT count(*) FROM information_schema.columns
+ WHERE table_schema = current_schema() AND table_name = 'recurring_rules' AND column_name = 'currency';
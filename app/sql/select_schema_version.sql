@@ -0,0 +1 @@
+SELECT obj_description(to_regclass('users'), 'pg_class');
@@ -0,0 +1 @@
+SELECT user_id, month, record_count, total_cents, payload FROM record_archives WHERE user_id = %s;
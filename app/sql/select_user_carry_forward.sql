@@ -0,0 +1 @@
+SELECT user_id, total_cents, archived_until, currency FROM record_carry_forward WHERE user_id = %s;
@@ -0,0 +1 @@
+SELECT user_id, shard FROM user_shards;
@@ -0,0 +1 @@
+COMMENT ON TABLE users IS %s;
@@ -0,0 +1 @@
+SELECT (SELECT count(*) FROM users), (SELECT count(*) FROM records);
@@ -0,0 +1,5 @@
+ALTER TABLE records DETACH PARTITION records_default;
+CREATE TABLE IF NOT EXISTS {partition} PARTITION OF records FOR VALUES FROM (%s) TO (%s);
+INSERT INTO records SELECT * FROM records_default WHERE created_at >= %s AND created_at < %s;
+DELETE FROM records_default WHERE created_at >= %s AND created_at < %s;
+ALTER TABLE records ATTACH PARTITION records_default DEFAULT;
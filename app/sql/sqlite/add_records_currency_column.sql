@@ -0,0 +1 @@
+ALTER TABLE records ADD COLUMN currency TEXT NOT NULL DEFAULT 'BRL';
@@ -0,0 +1,12 @@
+INSERT INTO idempotency_keys (user_id, key, request_hash, created_at)
+VALUES (?, ?, ?, ?)
+ON CONFLICT (user_id, key) DO UPDATE
+  SET request_hash = excluded.request_hash,
+      created_at = excluded.created_at,
+      status_code = NULL,
+      response = NULL
+  WHERE idempotency_keys.created_at < ?;
+
+SELECT changes() > 0, request_hash, status_code, response
+  FROM idempotency_keys
+ WHERE user_id = ? AND key = ?;
@@ -0,0 +1 @@
+UPDATE idempotency_keys SET status_code = ?, response = ? WHERE user_id = ? AND key = ?;
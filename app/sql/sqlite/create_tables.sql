@@ -0,0 +1,72 @@
+CREATE TABLE IF NOT EXISTS users (
+  id TEXT PRIMARY KEY,
+  name TEXT NOT NULL,
+  email TEXT UNIQUE NOT NULL,
+  profile_pic TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS records (
+  id INTEGER PRIMARY KEY,
+  user_id TEXT REFERENCES users(id),
+  amount_cents INTEGER,
+  description varchar,
+  created_at timestamp NOT NULL,
+  category TEXT,
+  currency TEXT NOT NULL DEFAULT 'BRL'
+);
+
+CREATE INDEX IF NOT EXISTS records_user_id_created_at_idx ON records (user_id, created_at);
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+  user_id TEXT REFERENCES users(id),
+  key TEXT,
+  request_hash TEXT NOT NULL,
+  status_code INTEGER,
+  response TEXT,
+  created_at timestamp NOT NULL,
+  PRIMARY KEY (user_id, key)
+);
+
+CREATE INDEX IF NOT EXISTS idempotency_keys_created_at_idx ON idempotency_keys (created_at);
+
+CREATE TABLE IF NOT EXISTS record_archives (
+  user_id TEXT REFERENCES users(id),
+  month date,
+  record_count INTEGER NOT NULL,
+  total_cents INTEGER NOT NULL,
+  payload TEXT NOT NULL,
+  PRIMARY KEY (user_id, month)
+);
+
+CREATE TABLE IF NOT EXISTS record_carry_forward (
+  user_id TEXT REFERENCES users(id),
+  total_cents INTEGER NOT NULL,
+  archived_until timestamp NOT NULL,
+  currency TEXT NOT NULL DEFAULT 'BRL',
+  PRIMARY KEY (user_id, currency)
+);
+
+CREATE TABLE IF NOT EXISTS recurring_rules (
+  id INTEGER PRIMARY KEY,
+  user_id TEXT NOT NULL REFERENCES users(id),
+  amount_cents INTEGER NOT NULL,
+  description varchar NOT NULL,
+  schedule TEXT NOT NULL,
+  next_run_at timestamp NOT NULL,
+  created_at timestamp NOT NULL,
+  currency TEXT NOT NULL DEFAULT 'BRL'
+);
+
+CREATE INDEX IF NOT EXISTS recurring_rules_next_run_at_idx ON recurring_rules (next_run_at);
+CREATE INDEX IF NOT EXISTS recurring_rules_user_id_idx ON recurring_rules (user_id);
+
+CREATE TABLE IF NOT EXISTS category_rules (
+  id INTEGER PRIMARY KEY,
+  user_id TEXT NOT NULL REFERENCES users(id),
+  category TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  pattern TEXT NOT NULL,
+  created_at timestamp NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS category_rules_user_id_idx ON category_rules (user_id);
@@ -0,0 +1 @@
+DELETE FROM category_rules WHERE id = ? AND user_id = ? RETURNING id;
@@ -0,0 +1 @@
+DELETE FROM idempotency_keys WHERE created_at < ?;
@@ -0,0 +1 @@
+DELETE FROM recurring_rules WHERE id = ? AND user_id = ? RETURNING id;
@@ -0,0 +1 @@
+SELECT payload FROM record_archives WHERE user_id = ? AND month >= ? AND month < ? ORDER BY month;
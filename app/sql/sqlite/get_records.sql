@@ -0,0 +1 @@
+SELECT * FROM records WHERE user_id = ?;
@@ -0,0 +1 @@
+SELECT * FROM records WHERE user_id = ? AND created_at >= ? AND created_at < ?;
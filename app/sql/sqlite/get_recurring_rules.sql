@@ -0,0 +1,4 @@
+SELECT id, user_id, amount_cents, description, schedule, next_run_at, created_at, currency
+  FROM recurring_rules
+ WHERE user_id = ?
+ ORDER BY id;
@@ -0,0 +1 @@
+INSERT INTO records (user_id, amount_cents, description, created_at, category, currency) VALUES (?, ?, ?, ?, ?, ?) RETURNING id;
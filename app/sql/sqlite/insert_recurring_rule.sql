@@ -0,0 +1,2 @@
+INSERT INTO recurring_rules (user_id, amount_cents, description, schedule, next_run_at, created_at, currency)
+VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id;
@@ -0,0 +1,23 @@
+CREATE TABLE record_archives_cents (
+  user_id TEXT REFERENCES users(id),
+  month date,
+  record_count INTEGER NOT NULL,
+  total_cents INTEGER NOT NULL,
+  payload TEXT NOT NULL,
+  PRIMARY KEY (user_id, month)
+);
+
+INSERT INTO record_archives_cents (user_id, month, record_count, total_cents, payload)
+SELECT user_id, month, record_count, CAST(round(total * 100) AS INTEGER), (
+  SELECT json_group_array(json_array(
+    json_extract(item.value, '$[0]'),
+    CAST(round(json_extract(item.value, '$[1]') * 100) AS INTEGER),
+    json_extract(item.value, '$[2]'),
+    json_extract(item.value, '$[3]')
+  ))
+  FROM json_each(record_archives.payload) AS item
+)
+FROM record_archives;
+
+DROP TABLE record_archives;
+ALTER TABLE record_archives_cents RENAME TO record_archives;
@@ -0,0 +1,13 @@
+CREATE TABLE record_carry_forward_currencies (
+  user_id TEXT REFERENCES users(id),
+  total_cents INTEGER NOT NULL,
+  archived_until timestamp NOT NULL,
+  currency TEXT NOT NULL DEFAULT 'BRL',
+  PRIMARY KEY (user_id, currency)
+);
+
+INSERT INTO record_carry_forward_currencies (user_id, total_cents, archived_until)
+SELECT user_id, total_cents, archived_until FROM record_carry_forward;
+
+DROP TABLE record_carry_forward;
+ALTER TABLE record_carry_forward_currencies RENAME TO record_carry_forward;
@@ -0,0 +1,11 @@
+CREATE TABLE record_carry_forward_cents (
+  user_id TEXT PRIMARY KEY REFERENCES users(id),
+  total_cents INTEGER NOT NULL,
+  archived_until timestamp NOT NULL
+);
+
+INSERT INTO record_carry_forward_cents (user_id, total_cents, archived_until)
+SELECT user_id, CAST(round(total * 100) AS INTEGER), archived_until FROM record_carry_forward;
+
+DROP TABLE record_carry_forward;
+ALTER TABLE record_carry_forward_cents RENAME TO record_carry_forward;
@@ -0,0 +1,14 @@
+CREATE TABLE records_cents (
+  id INTEGER PRIMARY KEY,
+  user_id TEXT REFERENCES users(id),
+  amount_cents INTEGER,
+  description varchar,
+  created_at timestamp NOT NULL
+);
+
+INSERT INTO records_cents (id, user_id, amount_cents, description, created_at)
+SELECT id, user_id, CAST(round(amount * 100) AS INTEGER), description, created_at FROM records;
+
+DROP TABLE records;
+ALTER TABLE records_cents RENAME TO records;
+CREATE INDEX IF NOT EXISTS records_user_id_created_at_idx ON records (user_id, created_at);
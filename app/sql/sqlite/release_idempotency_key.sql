@@ -0,0 +1 @@
+DELETE FROM idempotency_keys WHERE user_id = ? AND key = ? AND status_code IS NULL;
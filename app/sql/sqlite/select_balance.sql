@@ -0,0 +1,17 @@
+SELECT totals.currency, totals.day, totals.cents
+  FROM users
+  LEFT JOIN (
+    SELECT currency,
+           CASE WHEN currency = ? THEN 0 ELSE CAST(strftime('%s', created_at) AS INTEGER) / 86400 END AS day,
+           sum(amount_cents) AS cents
+      FROM records
+     WHERE user_id = ?
+     GROUP BY 1, 2
+    UNION ALL
+    SELECT currency,
+           CASE WHEN currency = ? THEN 0 ELSE CAST(strftime('%s', archived_until) AS INTEGER) / 86400 END,
+           total_cents
+      FROM record_carry_forward
+     WHERE user_id = ?
+  ) AS totals ON true
+ WHERE users.id = ?;
@@ -0,0 +1,43 @@
+SELECT
+  users.id,
+  users.name,
+  users.email,
+  users.profile_pic,
+  (
+    SELECT json_group_array(json_array(totals.currency, totals.day, totals.cents))
+    FROM (
+      SELECT currency,
+             CASE WHEN currency = ? THEN 0 ELSE CAST(strftime('%s', created_at) AS INTEGER) / 86400 END AS day,
+             sum(amount_cents) AS cents
+        FROM records
+       WHERE user_id = users.id
+       GROUP BY 1, 2
+      UNION ALL
+      SELECT currency,
+             CASE WHEN currency = ? THEN 0 ELSE CAST(strftime('%s', archived_until) AS INTEGER) / 86400 END,
+             total_cents
+        FROM record_carry_forward
+       WHERE user_id = users.id
+    ) AS totals
+  ),
+  (
+    SELECT json_group_array(json_array(
+      page.id,
+      page.amount_cents,
+      page.description,
+      replace(page.created_at, ' ', 'T'),
+      page.category,
+      page.currency
+    ))
+    FROM (
+      SELECT * FROM (
+        SELECT id, amount_cents, description, created_at, category, currency FROM records
+        WHERE user_id = users.id
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+      )
+      ORDER BY created_at, id
+    ) AS page
+  )
+FROM users
+WHERE users.id = ?;
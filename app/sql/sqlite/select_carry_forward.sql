@@ -0,0 +1 @@
+SELECT currency, total_cents, archived_until FROM record_carry_forward WHERE user_id = ? ORDER BY currency;
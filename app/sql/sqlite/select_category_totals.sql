@@ -0,0 +1,10 @@
+SELECT category,
+       currency,
+       CASE WHEN currency = ? THEN 0 ELSE CAST(strftime('%s', created_at) AS INTEGER) / 86400 END AS day,
+       COALESCE(sum(amount_cents) FILTER (WHERE amount_cents > 0), 0),
+       COALESCE(-sum(amount_cents) FILTER (WHERE amount_cents < 0), 0),
+       count(*)
+  FROM records
+ WHERE user_id = ? AND created_at >= ? AND created_at < ?
+ GROUP BY 1, 2, 3
+ ORDER BY category NULLS LAST;
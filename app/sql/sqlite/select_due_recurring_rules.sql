@@ -0,0 +1,5 @@
+SELECT id, user_id, amount_cents, description, schedule, next_run_at, currency
+  FROM recurring_rules
+ WHERE next_run_at <= ?
+ ORDER BY next_run_at, id
+ LIMIT ?;
@@ -0,0 +1,3 @@
+SELECT 0, request_hash, status_code, response
+  FROM idempotency_keys
+ WHERE user_id = ? AND key = ?;
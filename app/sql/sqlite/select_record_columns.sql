@@ -0,0 +1,4 @@
+SELECT CAST(strftime('%s', created_at) AS INTEGER), amount_cents, currency
+  FROM records
+ WHERE user_id = ? AND created_at >= ?
+ ORDER BY created_at;
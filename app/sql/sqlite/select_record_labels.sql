@@ -0,0 +1,5 @@
+SELECT id, created_at, description, category
+  FROM records
+ WHERE user_id = ? AND created_at >= ? AND created_at < ? AND (created_at, id) > (?, ?)
+ ORDER BY created_at, id
+ LIMIT ?;
@@ -0,0 +1 @@
+SELECT min(created_at), max(created_at) FROM records WHERE user_id = ?;
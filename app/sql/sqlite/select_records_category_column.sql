@@ -0,0 +1 @@
+SELECT count(*) FROM pragma_table_info('records') WHERE name = 'category';
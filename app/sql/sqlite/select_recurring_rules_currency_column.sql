@@ -0,0 +1 @@
+SELECT count(*) FROM pragma_table_info('recurring_rules') WHERE name = 'currency';
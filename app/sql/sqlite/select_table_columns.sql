@@ -0,0 +1,2 @@
+SELECT tables.value, columns.name
+  FROM json_each(?) AS tables, pragma_table_info(tables.value) AS columns;
@@ -0,0 +1 @@
+SELECT * FROM users WHERE id = ?;
@@ -0,0 +1,4 @@
+SELECT user_id, category, kind, pattern
+  FROM category_rules
+ WHERE user_id IN (SELECT value FROM json_each(?))
+ ORDER BY id;
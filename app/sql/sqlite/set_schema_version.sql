@@ -0,0 +1 @@
+PRAGMA user_version = {version};
@@ -0,0 +1,8 @@
+-- The labels are a JSON array of [id, category] pairs
+UPDATE records SET category = labels.category
+  FROM (
+    SELECT json_extract(value, '$[0]') AS id, json_extract(value, '$[1]') AS category
+      FROM json_each(?)
+  ) AS labels
+ WHERE records.id = labels.id
+   AND records.user_id = ? AND records.created_at >= ? AND records.created_at < ?;
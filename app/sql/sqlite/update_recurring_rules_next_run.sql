@@ -0,0 +1 @@
+UPDATE recurring_rules SET next_run_at = ? WHERE id = ?;
@@ -0,0 +1,9 @@
+INSERT INTO users (id, name, email, profile_pic)
+VALUES (?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE
+  SET name = excluded.name,
+      email = excluded.email,
+      profile_pic = excluded.profile_pic
+  WHERE (users.name, users.email, users.profile_pic)
+    IS NOT (excluded.name, excluded.email, excluded.profile_pic)
+RETURNING id, name, email, profile_pic
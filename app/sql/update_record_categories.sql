@@ -0,0 +1,9 @@
+-- The labels are a JSON array of [id, category] pairs, and the date range
+-- limits the update to the partitions they come from
+UPDATE records SET category = labels.category
+  FROM (
+    SELECT (item->>0)::integer AS id, item->>1 AS category
+      FROM json_array_elements(%s::json) AS item
+  ) AS labels
+ WHERE records.id = labels.id
+   AND records.user_id = %s AND records.created_at >= %s AND records.created_at < %s;
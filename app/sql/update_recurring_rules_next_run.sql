@@ -0,0 +1,3 @@
+UPDATE recurring_rules SET next_run_at = runs.next_run_at
+  FROM (VALUES %s) AS runs (id, next_run_at)
+ WHERE recurring_rules.id = runs.id;
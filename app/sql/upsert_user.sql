@@ -0,0 +1,9 @@
+INSERT INTO users (id, name, email, profile_pic)
+VALUES (%s, %s, %s, %s)
+ON CONFLICT (id) DO UPDATE
+  SET name = EXCLUDED.name,
+      email = EXCLUDED.email,
+      profile_pic = EXCLUDED.profile_pic
+  WHERE (users.name, users.email, users.profile_pic)
+    IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.email, EXCLUDED.profile_pic)
+RETURNING id, name, email, profile_pic
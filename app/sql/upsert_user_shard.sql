@@ -0,0 +1 @@
+INSERT INTO user_shards (user_id, shard) VALUES (%s, %s) ON CONFLICT (user_id) DO UPDATE SET shard = EXCLUDED.shard;
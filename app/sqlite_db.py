@@ -0,0 +1,226 @@
+from __future__ import annotations
+import functools
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime
+from typing import Iterator
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" ", "microseconds"))
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_converter("timestamp", lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter("date", lambda value: date.fromisoformat(value.decode()))
+
+# Literals, quoted identifiers and comments, whose `;` and `?` are not
+# separators nor placeholders, then the separators and placeholders
+_tokens = re.compile(r"""
+    '(?:[^']|'')*' | "(?:[^"]|"")*" | `[^`]*` | \[[^\]]*\]
+    | --[^\n]* | /\*.*?(?:\*/|$)
+    | (?P<separator>;) | (?P<placeholder>\?)
+""", re.VERBOSE | re.DOTALL)
+_comments = re.compile(r"--[^\n]*|/\*.*?(?:\*/|$)", re.DOTALL)
+
+
+@functools.lru_cache(maxsize=256)
+def split_statements(script: str) -> tuple[tuple[str, int], ...]:
+    """
+    Split an SQL script into its statements.
+
+    Semicolons and question marks inside string literals, quoted identifiers
+    and comments are kept as they are, so they neither end a statement nor
+    take a value.
+
+    Args:
+        script (str): The SQL statements, separated by `;`.
+
+    Returns:
+        tuple[tuple[str, int], ...]: Each statement that is not empty, with
+        its number of `?` placeholders.
+
+    Example:
+        >>> split_statements("INSERT INTO t VALUES (?, ';'); SELECT '?' FROM t")
+        (("INSERT INTO t VALUES (?, ';')", 1), ("SELECT '?' FROM t", 0))
+    """
+    statements = []
+    start = 0
+    placeholders = 0
+
+    for match in _tokens.finditer(script):
+        if match.group("placeholder"):
+            placeholders += 1
+        elif match.group("separator"):
+            statements.append((script[start:match.start()], placeholders))
+            start = match.end()
+            placeholders = 0
+    statements.append((script[start:], placeholders))
+
+    return tuple((statement.strip(), placeholders) for statement, placeholders in statements
+                 if _comments.sub("", statement).strip())
+
+
+class SqliteDatabase:
+    """
+    An embedded SQLite database in WAL mode.
+
+    WAL mode lets readers run concurrently with the single writer. Each
+    thread reads through its own connection, while all writes go through one
+    shared connection guarded by a lock, so writers never fail with
+    `database is locked` inside the process.
+
+    Query files may hold several statements separated by `;`. They run in
+    order, each one taking as many of the values as it has `?` placeholders
+    (see `split_statements`), and the rows of the last statement that
+    returns rows are the result. Scripts without values, such as the schema
+    and its migrations, run with `executescript` in a transaction of their
+    own.
+
+    Methods:
+        execute: Execute the statements of a query file.
+        transaction: Hold the writer connection for a transaction.
+        close: Close the writer connection.
+    """
+
+    def __init__(self, path: str, busy_timeout: int = 5000) -> None:
+        """
+        Initialize a SqliteDatabase object.
+
+        Args:
+            path (str): The path of the database file.
+            busy_timeout (int, optional): How many milliseconds a connection
+                waits for a lock held by another process (default: 5000).
+        """
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._writer: sqlite3.Connection | None = None
+        self._writer_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def _writer_connection(self) -> sqlite3.Connection:
+        # Called with the writer lock held
+        if self._writer is None:
+            self._writer = self._connect()
+        return self._writer
+
+    @staticmethod
+    def _run(conn: sqlite3.Connection, query: str, values: tuple) -> None|list[tuple]:
+        statements = split_statements(query)
+        expected = sum(placeholders for _, placeholders in statements)
+        if expected != len(values):
+            raise sqlite3.ProgrammingError(
+                f"The query has {expected} placeholders, but {len(values)} values were given")
+
+        result = None
+        position = 0
+        for statement, placeholders in statements:
+            cursor = conn.execute(statement, values[position:position + placeholders])
+            position += placeholders
+            if cursor.description:
+                result = cursor.fetchall()
+
+        return result
+
+    def _run_script(self, query: str) -> None:
+        # `executescript` commits the open transaction first, so the script
+        # brings its own
+        with self._writer_lock:
+            conn = self._writer_connection()
+            try:
+                conn.executescript(f"BEGIN IMMEDIATE;\n{query}\n;\nCOMMIT;")
+            finally:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+
+    def execute(self, query: str, values: tuple = (), read_only: bool = False,
+                connection: sqlite3.Connection | None = None) -> None|list[tuple]:
+        """
+        Execute the statements of a query file.
+
+        Read-only queries run on the calling thread's reader connection.
+        Any other query runs on the writer connection, in a single
+        transaction that is rolled back if a statement fails. Scripts of
+        several statements without values run with `executescript`.
+
+        Args:
+            query (str): The SQL statements to execute.
+            values (tuple, optional): The parameter values for the statements
+                (default: ()).
+            read_only (bool, optional): Whether the query never writes
+                (default: False).
+            connection (sqlite3.Connection | None, optional): Run the
+                statements on this connection, in its open transaction, such
+                as one yielded by `transaction` (default: None).
+
+        Returns:
+            None|list[tuple]: The rows of the last statement that returns
+            rows, or None.
+        """
+        if connection is not None:
+            return self._run(connection, query, values)
+        if read_only:
+            return self._run(self._reader(), query, values)
+        if not values and len(split_statements(query)) > 1:
+            self._run_script(query)
+            return None
+
+        with self.transaction() as conn:
+            result = self._run(conn, query, values)
+            conn.commit()
+            return result
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        Hold the writer connection for a transaction.
+
+        The transaction is begun immediately, so it holds the write lock of
+        the database until the caller commits it, and it is rolled back if
+        the block raises or ends without committing. Other writers of the
+        process wait for the block to end.
+
+        Yields:
+            sqlite3.Connection: The writer connection, to commit with
+            `commit()`.
+
+        Example:
+            >>> with database.transaction() as conn:
+            >>>     database.execute(query, values, connection=conn)
+            >>>     conn.commit()
+        """
+        with self._writer_lock:
+            conn = self._writer_connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+
+    def close(self) -> None:
+        """
+        Close the writer connection.
+        """
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
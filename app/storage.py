@@ -0,0 +1,769 @@
+from __future__ import annotations
+import bisect
+import itertools
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from array import array
+from datetime import datetime, timedelta
+
+from db import execute_query, reload_user_shard
+from fx import Total, day_of, fx_config
+
+storage_config = {
+    "backend": os.getenv("STORAGE_BACKEND", "database"),
+}
+
+UserRow = tuple[str, str, str, str]
+# Amounts are integer cents, in the currency of the record
+RecordRow = tuple[int, str, int, str, datetime, str | None, str]
+# Amounts are integer cents, in the currency of the rule
+RecurringRuleRow = tuple[int, str, int, str, str, datetime, datetime, str]
+CategoryRuleRow = tuple[int, str, str, str, str, datetime]
+# (id, created_at, description, category)
+RecordLabelRow = tuple[int, datetime, str, str | None]
+# (category, currency, day, income, expenses, records), with amounts in cents
+CategoryTotalsRow = tuple[str | None, str, int, int, int, int]
+# (currency, total, archived_until), with the total in cents
+CarryForwardRow = tuple[str, int, datetime]
+
+_epoch = datetime(1970, 1, 1)
+
+
+def epoch_seconds(value: datetime) -> int:
+    """
+    Convert a naive datetime to seconds since the Unix epoch.
+
+    Records are stored in the server's local time, without a time zone, and
+    the datetime is taken as is, the same way the database does it, so that
+    day boundaries stay those of the local time.
+
+    Args:
+        value (datetime): The datetime.
+
+    Returns:
+        int: The whole seconds since 1970-01-01 00:00.
+    """
+    return (value - _epoch) // timedelta(seconds=1)
+
+
+class Storage(ABC):
+    """
+    Interface of the storage used by the `User` and `Record` models.
+
+    Implementations return plain rows, in the same column order as the
+    database tables, and the models build the objects from them. Amounts and
+    totals are integer cents. Totals over records in several currencies are
+    returned as `(currency, day, cents)` sums, with the days counted from
+    1970-01-01, for `fx` to convert, and the sums already in the currency
+    asked for are merged into day `0`, since they need no conversion.
+
+    Methods:
+        get_user: Retrieve a user row by ID.
+        insert_user: Insert a user.
+        upsert_user: Insert a user or update their profile.
+        insert_record: Insert a record and return its ID.
+        get_records: Retrieve the record rows of a user.
+        get_record_columns: Retrieve the times, amounts and currencies of
+            the records of a user as arrays.
+        get_archived_records: Retrieve the archived record payloads of a user.
+        get_carry_forward: Retrieve the carry-forward totals of a user.
+        get_balance: Retrieve the totals of the balance of a user.
+        get_bootstrap: Retrieve a user, their balance and latest records.
+        insert_recurring_rule: Insert a recurring rule and return its ID.
+        get_recurring_rules: Retrieve the recurring rule rows of a user.
+        delete_recurring_rule: Delete a recurring rule of a user.
+        insert_category_rule: Insert a category rule and return its ID.
+        get_category_rules: Retrieve the category rule rows of a user.
+        delete_category_rule: Delete a category rule of a user.
+        get_record_range: Retrieve the dates of the first and last records
+            of a user.
+        get_record_labels: Retrieve a batch of descriptions and categories
+            of records of a user.
+        update_record_categories: Set the categories of records of a user.
+        get_category_totals: Retrieve the totals of each category of a user.
+    """
+
+    @abstractmethod
+    def get_user(self, user_id: str) -> UserRow | None:
+        """
+        Retrieve a user row by ID.
+
+        Args:
+            user_id (str): The ID of the user.
+
+        Returns:
+            UserRow | None: The `(id, name, email, profile_pic)` row, or
+            `None` if the user is not found.
+        """
+
+    @abstractmethod
+    def insert_user(self, id: str, name: str, email: str, profile_pic: str) -> None:
+        """
+        Insert a user.
+
+        Args:
+            id (str): The unique identifier for the user.
+            name (str): The name of the user.
+            email (str): The email address of the user.
+            profile_pic (str): The URL of the user's profile picture.
+        """
+
+    @abstractmethod
+    def upsert_user(self, id: str, name: str, email: str, profile_pic: str) -> bool:
+        """
+        Insert a user, or update their profile if it changed.
+
+        Args:
+            id (str): The unique identifier for the user.
+            name (str): The name of the user.
+            email (str): The email address of the user.
+            profile_pic (str): The URL of the user's profile picture.
+
+        Returns:
+            bool: `True` if the user was inserted or updated, `False` if the
+            stored profile was already the same.
+        """
+
+    @abstractmethod
+    def insert_record(self, user_id: str, amount: int, description: str, created_at: datetime,
+                      category: str | None = None, currency: str = fx_config["base_currency"]) -> int:
+        """
+        Insert a record.
+
+        Args:
+            user_id (str): The ID of the user that registered the record.
+            amount (int): The amount associated with the record, in cents.
+            description (str): A description of the record.
+            created_at (datetime): The datetime timestamp of the record.
+            category (str | None, optional): The category of the record, or
+                `None` if uncategorized (default: None).
+            currency (str, optional): The currency of the amount (default:
+                the base currency).
+
+        Returns:
+            int: The ID of the record.
+        """
+
+    @abstractmethod
+    def get_records(self, user_id: str, since: datetime | None = None,
+                    until: datetime | None = None) -> list[RecordRow]:
+        """
+        Retrieve the record rows of a user, optionally in a date range.
+
+        Args:
+            user_id (str): The ID of the user.
+            since (datetime | None, optional): Only get records created at or
+                after this datetime (default: None).
+            until (datetime | None, optional): Only get records created before
+                this datetime (default: None).
+
+        Returns:
+            list[RecordRow]: The `(id, user_id, amount, description,
+            created_at, category, currency)` rows.
+        """
+
+    @abstractmethod
+    def get_record_columns(self, user_id: str, since: datetime) -> tuple[array, array, list[str]]:
+        """
+        Retrieve the creation times, amounts and currencies of the records of
+        a user created at or after a datetime, as columns, without building a
+        row per record.
+
+        Args:
+            user_id (str): The ID of the user.
+            since (datetime): Only get records created at or after this
+                datetime.
+
+        Returns:
+            tuple[array, array, list[str]]: The creation times, as
+            `epoch_seconds`, and the amounts in cents, both `array('q')`, and
+            the currencies, ordered by creation time.
+        """
+
+    @abstractmethod
+    def get_archived_records(self, user_id: str, since: datetime, until: datetime) -> list[list]:
+        """
+        Retrieve the archived records of a user for the months in a range.
+
+        Args:
+            user_id (str): The ID of the user.
+            since (datetime): The start of the range.
+            until (datetime): The end of the range.
+
+        Returns:
+            list[list]: One payload per archived month, each a list of
+            `[id, amount, description, created_at, category, currency]`
+            items, without the category or the currency for records archived
+            before records had them.
+        """
+
+    @abstractmethod
+    def get_carry_forward(self, user_id: str) -> list[CarryForwardRow]:
+        """
+        Retrieve the carry-forward totals of a user, one per currency.
+
+        Args:
+            user_id (str): The ID of the user.
+
+        Returns:
+            list[CarryForwardRow]: The `(currency, total, archived_until)` of
+            each currency, with the total of the archived records in cents
+            and the datetime before which records are archived, or an empty
+            list if nothing was archived.
+        """
+
+    @abstractmethod
+    def get_balance(self, user_id: str, currency: str) -> list[Total] | None:
+        """
+        Retrieve the totals the balance of a user is the sum of, summed by
+        the storage.
+
+        Args:
+            user_id (str): The ID of the user.
+            currency (str): The currency of the balance, whose totals are
+                merged into day `0`.
+
+        Returns:
+            list[Total] | None: The `(currency, day, cents)` sums of the
+            amounts of the records and of the carry-forward totals, or `None`
+            if the user is not found.
+        """
+
+    @abstractmethod
+    def get_bootstrap(self, user_id: str, history_size: int,
+                      currency: str) -> tuple[UserRow, list[Total], list[RecordRow]] | None:
+        """
+        Retrieve a user, their balance and their latest records at once.
+
+        Args:
+            user_id (str): The ID of the user.
+            history_size (int): How many of the latest records to retrieve.
+            currency (str): The currency of the balance.
+
+        Returns:
+            tuple[UserRow, list[Total], list[RecordRow]] | None: The user row,
+            the totals of the balance as in `get_balance`, and the latest
+            record rows from oldest to newest, or `None` if the user is not
+            found.
+        """
+
+    @abstractmethod
+    def insert_recurring_rule(self, user_id: str, amount: int, description: str, schedule: str,
+                              next_run_at: datetime, created_at: datetime,
+                              currency: str = fx_config["base_currency"]) -> int:
+        """
+        Insert a recurring rule.
+
+        Args:
+            user_id (str): The ID of the user that owns the rule.
+            amount (int): The amount of each record, in cents.
+            description (str): The description of each record.
+            schedule (str): The cron-like schedule of the rule.
+            next_run_at (datetime): The time of the first occurrence.
+            created_at (datetime): The datetime timestamp of the rule.
+            currency (str, optional): The currency of the amount (default:
+                the base currency).
+
+        Returns:
+            int: The ID of the rule.
+        """
+
+    @abstractmethod
+    def get_recurring_rules(self, user_id: str) -> list[RecurringRuleRow]:
+        """
+        Retrieve the recurring rule rows of a user.
+
+        Args:
+            user_id (str): The ID of the user.
+
+        Returns:
+            list[RecurringRuleRow]: The `(id, user_id, amount, description,
+            schedule, next_run_at, created_at, currency)` rows, ordered by
+            ID.
+        """
+
+    @abstractmethod
+    def delete_recurring_rule(self, user_id: str, rule_id: int) -> bool:
+        """
+        Delete a recurring rule of a user.
+
+        Args:
+            user_id (str): The ID of the user that owns the rule.
+            rule_id (int): The ID of the rule.
+
+        Returns:
+            bool: `True` if the rule was deleted, `False` if the user has no
+            such rule.
+        """
+
+    @abstractmethod
+    def insert_category_rule(self, user_id: str, category: str, kind: str, pattern: str,
+                             created_at: datetime) -> int:
+        """
+        Insert a category rule.
+
+        Args:
+            user_id (str): The ID of the user that owns the rule.
+            category (str): The category the rule labels records with.
+            kind (str): `"keyword"` or `"regex"`.
+            pattern (str): The keyword or the regular expression.
+            created_at (datetime): The datetime timestamp of the rule.
+
+        Returns:
+            int: The ID of the rule.
+        """
+
+    @abstractmethod
+    def get_category_rules(self, user_id: str) -> list[CategoryRuleRow]:
+        """
+        Retrieve the category rule rows of a user.
+
+        Args:
+            user_id (str): The ID of the user.
+
+        Returns:
+            list[CategoryRuleRow]: The `(id, user_id, category, kind, pattern,
+            created_at)` rows, ordered by ID.
+        """
+
+    @abstractmethod
+    def delete_category_rule(self, user_id: str, rule_id: int) -> bool:
+        """
+        Delete a category rule of a user.
+
+        Args:
+            user_id (str): The ID of the user that owns the rule.
+            rule_id (int): The ID of the rule.
+
+        Returns:
+            bool: `True` if the rule was deleted, `False` if the user has no
+            such rule.
+        """
+
+    @abstractmethod
+    def get_record_range(self, user_id: str) -> tuple[datetime | None, datetime | None]:
+        """
+        Retrieve the creation times of the first and last records of a user.
+
+        Args:
+            user_id (str): The ID of the user.
+
+        Returns:
+            tuple[datetime | None, datetime | None]: The first and last
+            creation times, or `(None, None)` if the user has no records.
+        """
+
+    @abstractmethod
+    def get_record_labels(self, user_id: str, since: datetime, until: datetime,
+                          after: tuple[datetime, int], limit: int) -> list[RecordLabelRow]:
+        """
+        Retrieve a batch of descriptions and categories of the records of a
+        user in a date range, in order of creation.
+
+        Args:
+            user_id (str): The ID of the user.
+            since (datetime): The start of the range.
+            until (datetime): The end of the range, excluded.
+            after (tuple[datetime, int]): Only get records after this
+                `(created_at, id)`, the last one of the previous batch.
+            limit (int): The size of the batch.
+
+        Returns:
+            list[RecordLabelRow]: The `(id, created_at, description,
+            category)` rows, ordered by creation time and ID.
+        """
+
+    @abstractmethod
+    def update_record_categories(self, user_id: str, since: datetime, until: datetime,
+                                 labels: list[tuple[int, str | None]]) -> None:
+        """
+        Set the categories of records of a user, in one statement.
+
+        Args:
+            user_id (str): The ID of the user.
+            since (datetime): The start of the range the records are in.
+            until (datetime): The end of the range, excluded.
+            labels (list[tuple[int, str | None]]): The `(id, category)` of
+                each record.
+        """
+
+    @abstractmethod
+    def get_category_totals(self, user_id: str, since: datetime, until: datetime,
+                            currency: str) -> list[CategoryTotalsRow]:
+        """
+        Retrieve the totals of each category of the records of a user in a
+        date range, summed by the storage.
+
+        Args:
+            user_id (str): The ID of the user.
+            since (datetime): The start of the range.
+            until (datetime): The end of the range, excluded.
+            currency (str): The currency of the totals, whose sums are merged
+                into day `0`.
+
+        Returns:
+            list[CategoryTotalsRow]: The `(category, currency, day, income,
+            expenses, records)` of each category, currency and day, with
+            amounts in cents, expenses as a positive amount, and
+            uncategorized records last, with a `None` category.
+        """
+
+
+class SqlStorage(Storage):
+    """
+    Storage backed by the database, through `db.execute_query`.
+
+    It works with every engine supported by `db`, Postgres or SQLite.
+    """
+
+    def get_user(self, user_id: str) -> UserRow | None:
+        result = execute_query("select_user_by_id.sql", (user_id,), user_id=user_id)
+        if not result and reload_user_shard(user_id):
+            result = execute_query("select_user_by_id.sql", (user_id,), user_id=user_id)
+        return result[0] if result else None # type: ignore
+
+    def insert_user(self, id: str, name: str, email: str, profile_pic: str) -> None:
+        execute_query("insert_user.sql", (id, name, email, profile_pic), user_id=id)
+
+    def upsert_user(self, id: str, name: str, email: str, profile_pic: str) -> bool:
+        # A single statement, which only writes when the profile changed
+        result = execute_query("upsert_user.sql", (id, name, email, profile_pic), user_id=id)
+        return bool(result)
+
+    def insert_record(self, user_id: str, amount: int, description: str, created_at: datetime,
+                      category: str | None = None, currency: str = fx_config["base_currency"]) -> int:
+        values = (user_id, amount, description, created_at, category, currency)
+        result = execute_query("insert_record.sql", values, user_id=user_id)
+        return result[0][0] # type: ignore
+
+    def get_records(self, user_id: str, since: datetime | None = None,
+                    until: datetime | None = None) -> list[RecordRow]:
+        if since is None and until is None:
+            query = "get_records.sql"
+            values = (user_id,)
+        else:
+            query = "get_records_between.sql"
+            values = (user_id, since or datetime.min, until or datetime.max)
+        return execute_query(query, values, user_id=user_id) or [] # type: ignore
+
+    def get_record_columns(self, user_id: str, since: datetime) -> tuple[array, array, list[str]]:
+        result = execute_query("select_record_columns.sql", (user_id, since), user_id=user_id) or []
+        return (array("q", [row[0] for row in result]), array("q", [row[1] for row in result]),
+                [row[2] for row in result])
+
+    def get_archived_records(self, user_id: str, since: datetime, until: datetime) -> list[list]:
+        values = (user_id, since.replace(day=1).date(), until)
+        result = execute_query("get_archived_records.sql", values, user_id=user_id)
+        # SQLite returns the JSON payload as text
+        return [json.loads(payload) if isinstance(payload, str) else payload
+                for payload, in result or []]
+
+    def get_carry_forward(self, user_id: str) -> list[CarryForwardRow]:
+        return execute_query("select_carry_forward.sql", (user_id,), user_id=user_id) or [] # type: ignore
+
+    def get_balance(self, user_id: str, currency: str) -> list[Total] | None:
+        # Summed by the database, by currency and day, without loading the records
+        values = (currency, user_id, currency, user_id, user_id)
+        result = execute_query("select_balance.sql", values, user_id=user_id)
+        if not result:
+            return None
+        # A user without records nor archive gets a single empty row
+        return [row for row in result if row[0] is not None] # type: ignore
+
+    def get_bootstrap(self, user_id: str, history_size: int,
+                      currency: str) -> tuple[UserRow, list[Total], list[RecordRow]] | None:
+        # A single query, with the totals and records aggregated as JSON arrays
+        values = (currency, currency, history_size, user_id)
+        result = execute_query("select_bootstrap.sql", values, user_id=user_id)
+        if not result:
+            return None
+
+        *user, totals, history = result[0]
+        if isinstance(totals, str):
+            totals = json.loads(totals)
+        if isinstance(history, str):
+            history = json.loads(history)
+        records = [(id, user_id, amount, description, datetime.fromisoformat(created_at), category, code)
+                   for id, amount, description, created_at, category, code in history]
+        return tuple(user), [tuple(total) for total in totals], records # type: ignore
+
+    def insert_recurring_rule(self, user_id: str, amount: int, description: str, schedule: str,
+                              next_run_at: datetime, created_at: datetime,
+                              currency: str = fx_config["base_currency"]) -> int:
+        values = (user_id, amount, description, schedule, next_run_at, created_at, currency)
+        result = execute_query("insert_recurring_rule.sql", values, user_id=user_id)
+        return result[0][0] # type: ignore
+
+    def get_recurring_rules(self, user_id: str) -> list[RecurringRuleRow]:
+        return execute_query("get_recurring_rules.sql", (user_id,), user_id=user_id) or [] # type: ignore
+
+    def delete_recurring_rule(self, user_id: str, rule_id: int) -> bool:
+        result = execute_query("delete_recurring_rule.sql", (rule_id, user_id), user_id=user_id)
+        return bool(result)
+
+    def insert_category_rule(self, user_id: str, category: str, kind: str, pattern: str,
+                             created_at: datetime) -> int:
+        values = (user_id, category, kind, pattern, created_at)
+        result = execute_query("insert_category_rule.sql", values, user_id=user_id)
+        return result[0][0] # type: ignore
+
+    def get_category_rules(self, user_id: str) -> list[CategoryRuleRow]:
+        return execute_query("get_category_rules.sql", (user_id,), user_id=user_id) or [] # type: ignore
+
+    def delete_category_rule(self, user_id: str, rule_id: int) -> bool:
+        result = execute_query("delete_category_rule.sql", (rule_id, user_id), user_id=user_id)
+        return bool(result)
+
+    def get_record_range(self, user_id: str) -> tuple[datetime | None, datetime | None]:
+        result = execute_query("select_record_range.sql", (user_id,), user_id=user_id)
+        # SQLite returns aggregates of timestamps as text
+        return tuple(datetime.fromisoformat(value) if isinstance(value, str) else value
+                     for value in result[0]) if result else (None, None) # type: ignore
+
+    def get_record_labels(self, user_id: str, since: datetime, until: datetime,
+                          after: tuple[datetime, int], limit: int) -> list[RecordLabelRow]:
+        values = (user_id, since, until, *after, limit)
+        return execute_query("select_record_labels.sql", values, user_id=user_id) or [] # type: ignore
+
+    def update_record_categories(self, user_id: str, since: datetime, until: datetime,
+                                 labels: list[tuple[int, str | None]]) -> None:
+        # The labels are sent as one JSON parameter, whatever their number
+        values = (json.dumps(labels), user_id, since, until)
+        execute_query("update_record_categories.sql", values, user_id=user_id)
+
+    def get_category_totals(self, user_id: str, since: datetime, until: datetime,
+                            currency: str) -> list[CategoryTotalsRow]:
+        values = (currency, user_id, since, until)
+        return execute_query("select_category_totals.sql", values, user_id=user_id) or [] # type: ignore
+
+
+class MemoryStorage(Storage):
+    """
+    Storage kept in memory, for tests, micro-benchmarks and profiling.
+
+    Users are indexed by ID. Records are indexed by user and, for each user,
+    kept sorted by creation time. Next to them are a parallel list of
+    timestamps, so date ranges are found with a binary search, parallel
+    `array('q')` of amounts in cents and of creation times in seconds, and a
+    parallel list of currencies, so balances and analytics work without
+    touching the rows. Nothing is archived, and recurring rules are stored
+    but never materialized. Category rules are stored, and records are
+    labeled by the models as with the database.
+    """
+
+    def __init__(self) -> None:
+        """
+        Initialize an empty MemoryStorage object.
+        """
+        self._users: dict[str, UserRow] = {}
+        self._records: dict[str, tuple[list[datetime], list[RecordRow], array, array, list[str]]] = {}
+        self._ids = itertools.count(1)
+        self._rules: dict[int, RecurringRuleRow] = {}
+        self._rule_ids = itertools.count(1)
+        self._category_rules: dict[int, CategoryRuleRow] = {}
+        self._lock = threading.Lock()
+
+    def get_user(self, user_id: str) -> UserRow | None:
+        return self._users.get(user_id)
+
+    def insert_user(self, id: str, name: str, email: str, profile_pic: str) -> None:
+        with self._lock:
+            if id in self._users:
+                raise Exception(f"User id already exists: {id}")
+            self._users[id] = (id, name, email, profile_pic)
+
+    def upsert_user(self, id: str, name: str, email: str, profile_pic: str) -> bool:
+        with self._lock:
+            user = (id, name, email, profile_pic)
+            if self._users.get(id) == user:
+                return False
+            self._users[id] = user
+            return True
+
+    def insert_record(self, user_id: str, amount: int, description: str, created_at: datetime,
+                      category: str | None = None, currency: str = fx_config["base_currency"]) -> int:
+        with self._lock:
+            if user_id not in self._users:
+                raise Exception(f"User id not found: {user_id}")
+
+            record_id = next(self._ids)
+            timestamps, rows, amounts, seconds, currencies = self._records.setdefault(
+                user_id, ([], [], array("q"), array("q"), []))
+            index = bisect.bisect_right(timestamps, created_at)
+            amounts.insert(index, amount)
+            seconds.insert(index, epoch_seconds(created_at))
+            currencies.insert(index, currency)
+            timestamps.insert(index, created_at)
+            rows.insert(index, (record_id, user_id, amount, description, created_at, category, currency))
+            return record_id
+
+    @staticmethod
+    def _totals(seconds: array, amounts: array, currencies: list[str], currency: str) -> list[Total]:
+        if currencies.count(currency) == len(currencies):
+            return [(currency, 0, sum(amounts))] if amounts else []
+
+        totals: dict[tuple[str, int], int] = {}
+        for second, amount, code in zip(seconds, amounts, currencies):
+            key = (code, 0 if code == currency else day_of(second))
+            totals[key] = totals.get(key, 0) + amount
+        return [(code, day, cents) for (code, day), cents in totals.items()]
+
+    def get_records(self, user_id: str, since: datetime | None = None,
+                    until: datetime | None = None) -> list[RecordRow]:
+        timestamps, rows, _, _, _ = self._records.get(user_id, ([], [], array("q"), array("q"), []))
+        start = 0 if since is None else bisect.bisect_left(timestamps, since)
+        end = len(rows) if until is None else bisect.bisect_left(timestamps, until)
+        return rows[start:end]
+
+    def get_record_columns(self, user_id: str, since: datetime) -> tuple[array, array, list[str]]:
+        timestamps, _, amounts, seconds, currencies = self._records.get(
+            user_id, ([], [], array("q"), array("q"), []))
+        start = bisect.bisect_left(timestamps, since)
+        return seconds[start:], amounts[start:], currencies[start:]
+
+    def get_archived_records(self, user_id: str, since: datetime, until: datetime) -> list[list]:
+        return []
+
+    def get_carry_forward(self, user_id: str) -> list[CarryForwardRow]:
+        return []
+
+    def get_balance(self, user_id: str, currency: str) -> list[Total] | None:
+        if user_id not in self._users:
+            return None
+        _, _, amounts, seconds, currencies = self._records.get(user_id, ([], [], array("q"), array("q"), []))
+        return self._totals(seconds, amounts, currencies, currency)
+
+    def get_bootstrap(self, user_id: str, history_size: int,
+                      currency: str) -> tuple[UserRow, list[Total], list[RecordRow]] | None:
+        user = self._users.get(user_id)
+        if user is None:
+            return None
+
+        _, rows, amounts, seconds, currencies = self._records.get(
+            user_id, ([], [], array("q"), array("q"), []))
+        totals = self._totals(seconds, amounts, currencies, currency)
+        return user, totals, rows[max(0, len(rows) - history_size):]
+
+    def insert_recurring_rule(self, user_id: str, amount: int, description: str, schedule: str,
+                              next_run_at: datetime, created_at: datetime,
+                              currency: str = fx_config["base_currency"]) -> int:
+        with self._lock:
+            if user_id not in self._users:
+                raise Exception(f"User id not found: {user_id}")
+
+            rule_id = next(self._rule_ids)
+            self._rules[rule_id] = (rule_id, user_id, amount, description, schedule, next_run_at,
+                                    created_at, currency)
+            return rule_id
+
+    def get_recurring_rules(self, user_id: str) -> list[RecurringRuleRow]:
+        return [rule for rule in self._rules.values() if rule[1] == user_id]
+
+    def delete_recurring_rule(self, user_id: str, rule_id: int) -> bool:
+        with self._lock:
+            rule = self._rules.get(rule_id)
+            if rule is None or rule[1] != user_id:
+                return False
+            del self._rules[rule_id]
+            return True
+
+    def insert_category_rule(self, user_id: str, category: str, kind: str, pattern: str,
+                             created_at: datetime) -> int:
+        with self._lock:
+            if user_id not in self._users:
+                raise Exception(f"User id not found: {user_id}")
+
+            # Shares the sequence of recurring rules, IDs only need to be unique
+            rule_id = next(self._rule_ids)
+            self._category_rules[rule_id] = (rule_id, user_id, category, kind, pattern, created_at)
+            return rule_id
+
+    def get_category_rules(self, user_id: str) -> list[CategoryRuleRow]:
+        return [rule for rule in self._category_rules.values() if rule[1] == user_id]
+
+    def delete_category_rule(self, user_id: str, rule_id: int) -> bool:
+        with self._lock:
+            rule = self._category_rules.get(rule_id)
+            if rule is None or rule[1] != user_id:
+                return False
+            del self._category_rules[rule_id]
+            return True
+
+    def get_record_range(self, user_id: str) -> tuple[datetime | None, datetime | None]:
+        timestamps, _, _, _, _ = self._records.get(user_id, ([], [], array("q"), array("q"), []))
+        return (timestamps[0], timestamps[-1]) if timestamps else (None, None)
+
+    def get_record_labels(self, user_id: str, since: datetime, until: datetime,
+                          after: tuple[datetime, int], limit: int) -> list[RecordLabelRow]:
+        timestamps, rows, _, _, _ = self._records.get(user_id, ([], [], array("q"), array("q"), []))
+        start = bisect.bisect_left(timestamps, max(since, after[0]))
+        end = bisect.bisect_left(timestamps, until)
+        # Rows with the same timestamp are in insertion order, so in ID order
+        while start < end and (rows[start][4], rows[start][0]) <= after:
+            start += 1
+        return [(id, created_at, description, category)
+                for id, _, _, description, created_at, category, _ in rows[start:min(end, start + limit)]]
+
+    def update_record_categories(self, user_id: str, since: datetime, until: datetime,
+                                 labels: list[tuple[int, str | None]]) -> None:
+        with self._lock:
+            timestamps, rows, _, _, _ = self._records.get(user_id, ([], [], array("q"), array("q"), []))
+            start = bisect.bisect_left(timestamps, since)
+            end = bisect.bisect_left(timestamps, until)
+            positions = {rows[index][0]: index for index in range(start, end)}
+            for id, category in labels:
+                index = positions.get(id)
+                if index is not None:
+                    rows[index] = (*rows[index][:5], category, rows[index][6])
+
+    def get_category_totals(self, user_id: str, since: datetime, until: datetime,
+                            currency: str) -> list[CategoryTotalsRow]:
+        totals: dict[tuple[str | None, str, int], list[int]] = {}
+        for _, _, amount, _, created_at, category, code in self.get_records(user_id, since, until):
+            day = 0 if code == currency else day_of(epoch_seconds(created_at))
+            income, expenses, records = totals.setdefault((category, code, day), [0, 0, 0])
+            totals[category, code, day] = [income + max(amount, 0), expenses - min(amount, 0), records + 1]
+        return [(*key, *totals[key])
+                for key in sorted(totals, key=lambda key: (key[0] is None, key[0] or "", key[1:]))]
+
+
+_storage: Storage | None = None
+
+
+def get_storage() -> Storage:
+    """
+    Get the storage used by the models.
+
+    The backend is selected by `storage_config["backend"]` the first time this
+    function is called, unless one was set with `set_storage`.
+
+    Returns:
+        Storage: The storage used by the models.
+
+    Raises:
+        ValueError: If the configured backend is unknown.
+    """
+    global _storage
+    if _storage is None:
+        backends = {"database": SqlStorage, "memory": MemoryStorage}
+        backend = storage_config["backend"]
+        if backend not in backends:
+            raise ValueError(f"Unknown storage backend: {backend}")
+        _storage = backends[backend]()
+    return _storage
+
+
+def set_storage(storage: Storage) -> None:
+    """
+    Set the storage used by the models.
+
+    Args:
+        storage (Storage): The storage to use.
+
+    Example:
+        >>> set_storage(MemoryStorage())
+    """
+    global _storage
+    _storage = storage
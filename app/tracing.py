@@ -0,0 +1,269 @@
+from __future__ import annotations
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator
+
+tracing_config = {
+    "slow_request_ms": float(os.getenv("TRACE_SLOW_REQUEST_MS", 500)),
+    "export_path": os.getenv("TRACE_EXPORT_PATH"),
+}
+
+logger = logging.getLogger(__name__)
+
+_trace_id_pattern = re.compile(r"[0-9a-f]{32}")
+
+# The innermost open span of the current request, if it is traced
+_current: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    A timed step of a request, such as a query or the serialization of the
+    response, with the steps it contains.
+
+    Attributes:
+        name (str): The name of the step.
+        trace_id (str): The ID of the trace, shared by all spans of a request.
+        span_id (str): The ID of the span.
+        parent_id (str | None): The ID of the parent span, or `None` for the
+            root span of a request.
+        attributes (dict[str, Any]): Details about the step.
+        children (list[Span]): The spans started inside this one.
+        start_ns (int): The wall clock start time, in nanoseconds.
+        duration_ns (int | None): The duration, or `None` while the span is
+            open.
+    """
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attributes",
+                 "children", "start_ns", "duration_ns", "_start")
+
+    def __init__(self, name: str, trace_id: str, parent_id: str | None,
+                 attributes: dict[str, Any]) -> None:
+        """
+        Initialize and start a Span object.
+
+        Args:
+            name (str): The name of the step.
+            trace_id (str): The ID of the trace.
+            parent_id (str | None): The ID of the parent span.
+            attributes (dict[str, Any]): Details about the step.
+        """
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.children: list[Span] = []
+        self.start_ns = time.time_ns()
+        self.duration_ns: int | None = None
+        self._start = time.perf_counter_ns()
+
+    def end(self) -> None:
+        """
+        End the span.
+        """
+        self.duration_ns = time.perf_counter_ns() - self._start
+
+    @property
+    def duration_ms(self) -> float:
+        """
+        The duration of the span, in milliseconds.
+
+        Returns:
+            float: The duration, up to now if the span is still open.
+        """
+        duration_ns = self.duration_ns
+        if duration_ns is None:
+            duration_ns = time.perf_counter_ns() - self._start
+        return duration_ns / 1e6
+
+    def walk(self) -> Iterator[Span]:
+        """
+        Iterate over this span and all the spans inside it.
+
+        Yields:
+            Span: The spans, parents before their children.
+        """
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Convert the span and the spans inside it to a dictionary.
+
+        Returns:
+            dict[str, Any]: The span tree.
+
+        Example:
+            >>> root.to_dict()
+            {
+                "name": "get_history",
+                "duration_ms": 12.5,
+                "attributes": {"method": "GET", "status": 200},
+                "children": [{"name": "db get_records.sql", ...}, ...]
+            }
+        """
+        return {
+            "name": self.name,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "children": [child.to_dict() for child in self.children],
+        }
+
+
+class FileExporter:
+    """
+    Writes traces to a local file, one OTLP/JSON `ExportTraceServiceRequest`
+    per line, which OpenTelemetry collectors can read with their file
+    receiver.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Initialize a FileExporter object.
+
+        Args:
+            path (str): The path of the file to append the traces to.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _attributes(attributes: dict[str, Any]) -> list[dict[str, Any]]:
+        converted = []
+        for key, value in attributes.items():
+            if isinstance(value, bool):
+                converted.append({"key": key, "value": {"boolValue": value}})
+            elif isinstance(value, int):
+                converted.append({"key": key, "value": {"intValue": str(value)}})
+            elif isinstance(value, float):
+                converted.append({"key": key, "value": {"doubleValue": value}})
+            else:
+                converted.append({"key": key, "value": {"stringValue": str(value)}})
+        return converted
+
+    def export(self, root: Span) -> None:
+        """
+        Append a trace to the file.
+
+        Args:
+            root (Span): The root span of the trace.
+        """
+        spans = [{
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+            "name": span.name,
+            "kind": 2 if span.parent_id is None else 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.start_ns + (span.duration_ns or 0)),
+            "attributes": self._attributes(span.attributes),
+        } for span in root.walk()]
+
+        line = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": self._attributes({"service.name": "registraai"})},
+            "scopeSpans": [{"scope": {"name": "registraai.tracing"}, "spans": spans}],
+        }]})
+        with self._lock:
+            with open(self.path, "a") as file:
+                file.write(line + "\n")
+
+
+exporter = FileExporter(tracing_config["export_path"]) if tracing_config["export_path"] else None
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span | None]:
+    """
+    Time a step of the current request as a child of the innermost open span.
+
+    Outside of a traced request this does nothing, so code shared with the
+    command line tools can be instrumented freely.
+
+    Args:
+        name (str): The name of the step.
+        **attributes (Any): Details about the step.
+
+    Yields:
+        Span | None: The span, to add attributes to, or `None` if the request
+        is not traced.
+
+    Example:
+        >>> with span("to_dict", records=len(records)):
+        >>>     history = [rec.to_dict() for rec in records]
+    """
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name, parent.trace_id, parent.span_id, attributes)
+    parent.children.append(child)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.attributes["error"] = type(e).__name__
+        raise
+    finally:
+        child.end()
+        _current.reset(token)
+
+
+def start_trace(name: str, trace_id: str | None = None, **attributes: Any) -> Span:
+    """
+    Start tracing a request.
+
+    Args:
+        name (str): The name of the root span, usually the endpoint.
+        trace_id (str | None, optional): The trace ID sent by the client, if
+            any. It is used when it is 32 lowercase hex characters, otherwise
+            a new ID is generated (default: None).
+        **attributes (Any): Details about the request.
+
+    Returns:
+        Span: The root span of the request.
+    """
+    if trace_id is None or not _trace_id_pattern.fullmatch(trace_id):
+        trace_id = os.urandom(16).hex()
+
+    root = Span(name, trace_id, None, attributes)
+    _current.set(root)
+    return root
+
+
+def finish_trace(root: Span) -> None:
+    """
+    Finish tracing a request.
+
+    If the request took longer than `tracing_config["slow_request_ms"]`, its
+    span tree is logged as JSON together with the time spent in the
+    database. The trace is also written by the file exporter when
+    `tracing_config["export_path"]` is set.
+
+    Args:
+        root (Span): The root span of the request.
+    """
+    root.end()
+    _current.set(None)
+
+    if root.duration_ms >= tracing_config["slow_request_ms"]:
+        db_spans = [span for span in root.walk() if "db.query" in span.attributes]
+        logger.warning(json.dumps({
+            "event": "slow_request",
+            "trace_id": root.trace_id,
+            "duration_ms": round(root.duration_ms, 3),
+            "db_ms": round(sum(span.duration_ms for span in db_spans), 3),
+            "db_queries": len(db_spans),
+            "spans": root.to_dict(),
+        }, default=str))
+
+    if exporter is not None:
+        exporter.export(root)
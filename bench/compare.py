@@ -0,0 +1,46 @@
+"""
+Compare two benchmark result files.
+
+Usage:
+    python bench/compare.py <baseline.json> <candidate.json>
+"""
+import argparse
+import json
+
+
+def change(before: float, after: float) -> str:
+    """
+    Format the relative change between two values.
+    """
+    if not before:
+        return "    n/a"
+    return f"{(after - before) / before * 100:+6.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    args = parser.parse_args()
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.candidate) as file:
+        candidate = json.load(file)
+
+    print(f"{baseline['commit']} -> {candidate['commit']}")
+    for name, after in candidate["endpoints"].items():
+        before = baseline["endpoints"].get(name)
+        if before is None:
+            print(f"{name:14} (new)")
+            continue
+
+        print(f"{name:14} throughput {change(before['throughput'], after['throughput'])}  "
+              f"p50 {change(before['latency_ms']['p50'], after['latency_ms']['p50'])}  "
+              f"p95 {change(before['latency_ms']['p95'], after['latency_ms']['p95'])}  "
+              f"p99 {change(before['latency_ms']['p99'], after['latency_ms']['p99'])}  "
+              f"queries/req {before['queries_per_request']:.2f} -> {after['queries_per_request']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+Load test the REST API against a local Postgres.
+
+Starts `bench/server.py`, seeds benchmark users with a configurable history
+size, then drives each endpoint concurrently for a fixed duration and reports
+throughput, latency percentiles and database statements per request. The
+results are saved as JSON so they can be compared between commits with
+`bench/compare.py`.
+
+Usage:
+    python bench/http_bench.py [--users N] [--history-size N]
+                               [--concurrency N] [--duration SECONDS]
+                               [--output PATH]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import requests
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, "..", "app"))
+
+from psycopg2.extras import execute_values
+
+import db
+
+ENDPOINTS = {
+    "get_balance": ("GET", "/balance"),
+    "get_history": ("GET", "/history"),
+    "get_analytics": ("GET", "/analytics"),
+    "get_category_totals": ("GET", "/categories/totals"),
+    "post_gain": ("POST", "/gain"),
+    "post_expense": ("POST", "/expense"),
+}
+
+
+def git_commit() -> str:
+    """
+    Get the current git commit, or "unknown" outside of a git checkout.
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=bench_dir, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def seed(users: int, history_size: int) -> list[str]:
+    """
+    Create benchmark users with `history_size` records each.
+
+    Users from a previous run are deleted first, so every run starts from the
+    same data.
+
+    Args:
+        users (int): How many users to create.
+        history_size (int): How many records each user has.
+
+    Returns:
+        list[str]: The IDs of the created users.
+    """
+    user_ids = [f"bench-user-{i}" for i in range(users)]
+    start = datetime.now() - timedelta(days=90)
+
+    for user_id in user_ids:
+        shard = db.shard_for(user_id)
+        db.execute_query("delete_user_data.sql", (user_id,) * 7, shard=shard)
+        db.execute_query("copy_user.sql", (
+            user_id, user_id, f"{user_id}@bench.local", "https://example.com/bench.png"
+        ), shard=shard)
+
+        rows = [
+            (user_id, random.randint(-10000, 10000), f"record {i}",
+             start + timedelta(minutes=i * 90 * 24 * 60 / max(history_size, 1)), None, "BRL")
+            for i in range(history_size)
+        ]
+        with db.shard_connection(shard) as conn:
+            with conn.cursor() as cursor:
+                execute_values(cursor, db.load_query("copy_records.sql"), rows, page_size=1000)
+            conn.commit()
+
+    return user_ids
+
+
+def start_server(port: int) -> subprocess.Popen:
+    """
+    Start the benchmark server and wait until it accepts requests.
+
+    Args:
+        port (int): The port to serve on.
+
+    Returns:
+        subprocess.Popen: The server process.
+    """
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(bench_dir, "server.py"), "--port", str(port)])
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/__bench__/queries", timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError("Benchmark server did not start")
+
+
+def login(base_url: str, user_id: str) -> requests.Session:
+    """
+    Get an authenticated session for a user through the login bypass.
+    """
+    session = requests.Session()
+    session.get(f"{base_url}/__bench__/login/{user_id}").raise_for_status()
+    return session
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """
+    Get a percentile of already sorted values, by nearest rank.
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values))) - 1)
+    return sorted_values[max(index, 0)]
+
+
+def run_endpoint(base_url: str, endpoint: str, sessions: list[requests.Session],
+                 concurrency: int, duration: float) -> dict:
+    """
+    Drive one endpoint concurrently for a fixed duration.
+
+    Args:
+        base_url (str): The URL of the benchmark server.
+        endpoint (str): The name of the endpoint in `ENDPOINTS`.
+        sessions (list[requests.Session]): Authenticated sessions to pick
+            from, one per user.
+        concurrency (int): How many requests are in flight at a time.
+        duration (float): How many seconds to run.
+
+    Returns:
+        dict: The throughput, latency percentiles, errors and database
+        statements per request of the endpoint.
+    """
+    method, route = ENDPOINTS[endpoint]
+    latencies: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+    queries_before = requests.get(f"{base_url}/__bench__/queries").json().get(endpoint, 0)
+
+    def worker():
+        nonlocal errors
+        local_latencies = []
+        local_errors = 0
+        while time.monotonic() < deadline:
+            session = random.choice(sessions)
+            body = {"amount": round(random.uniform(1, 100), 2), "description": "bench"}
+            start = time.perf_counter()
+            try:
+                res = session.request(method, f"{base_url}{route}",
+                                      json=body if method == "POST" else None)
+                ok = res.status_code < 400
+            except requests.RequestException:
+                ok = False
+            local_latencies.append(time.perf_counter() - start)
+            local_errors += not ok
+        with lock:
+            latencies.extend(local_latencies)
+            errors += local_errors
+
+    started = time.monotonic()
+    deadline = started + duration
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    queries_after = requests.get(f"{base_url}/__bench__/queries").json().get(endpoint, 0)
+    latencies.sort()
+    requests_done = len(latencies)
+
+    return {
+        "requests": requests_done,
+        "errors": errors,
+        "throughput": requests_done / elapsed,
+        "latency_ms": {
+            "p50": percentile(latencies, 50) * 1000,
+            "p95": percentile(latencies, 95) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+        },
+        "queries_per_request": (queries_after - queries_before) / max(requests_done, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--history-size", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--endpoints", nargs="+", choices=list(ENDPOINTS), default=list(ENDPOINTS))
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    base_url = f"http://127.0.0.1:{args.port}"
+    commit = git_commit()
+
+    server = start_server(args.port)
+    try:
+        user_ids = seed(args.users, args.history_size)
+        sessions = [login(base_url, user_id) for user_id in user_ids]
+
+        results = {}
+        for endpoint in args.endpoints:
+            results[endpoint] = run_endpoint(base_url, endpoint, sessions,
+                                             args.concurrency, args.duration)
+            stats = results[endpoint]
+            print(f"{endpoint:14} {stats['throughput']:8.1f} req/s  "
+                  f"p50 {stats['latency_ms']['p50']:7.2f} ms  "
+                  f"p95 {stats['latency_ms']['p95']:7.2f} ms  "
+                  f"p99 {stats['latency_ms']['p99']:7.2f} ms  "
+                  f"{stats['queries_per_request']:.2f} queries/req  "
+                  f"{stats['errors']} errors")
+    finally:
+        server.terminate()
+        server.wait()
+
+    output = args.output or os.path.join(bench_dir, "results", f"http-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump({
+            "commit": commit,
+            "timestamp": datetime.now().isoformat(),
+            "config": {
+                "users": args.users,
+                "history_size": args.history_size,
+                "concurrency": args.concurrency,
+                "duration": args.duration,
+                "seed": args.seed,
+            },
+            "endpoints": results,
+        }, file, indent=2)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Micro-benchmark the models and controller without a database.
+
+Seeds the in-memory storage with users and records, then times
+`controller.get_balance`, `controller.register_gain`,
+`controller.get_records` and the serialization of a history, optionally
+under cProfile.
+
+Usage:
+    python bench/micro_bench.py [--users N] [--history-size N]
+                                [--repeat N] [--profile OPERATION]
+                                [--output PATH]
+"""
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Callable
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, "..", "app"))
+
+import controller
+from models import Money
+from storage import MemoryStorage, set_storage
+
+
+def seed(storage: MemoryStorage, users: int, history_size: int) -> list[str]:
+    """
+    Create users with `history_size` records each in the in-memory storage.
+
+    Args:
+        storage (MemoryStorage): The storage to seed.
+        users (int): How many users to create.
+        history_size (int): How many records each user has.
+
+    Returns:
+        list[str]: The IDs of the created users.
+    """
+    user_ids = [f"bench-user-{i}" for i in range(users)]
+    start = datetime.now() - timedelta(days=365)
+    step = timedelta(days=365) / max(history_size, 1)
+
+    for user_id in user_ids:
+        storage.insert_user(user_id, user_id, f"{user_id}@bench.local", "https://example.com/bench.png")
+        for i in range(history_size):
+            amount = random.randint(-10000, 10000)
+            storage.insert_record(user_id, amount, f"record {i}", start + step * i)
+
+    return user_ids
+
+
+def serialize_history(user_id: str) -> str:
+    """
+    Serialize the history of a user the same way `/history` does.
+    """
+    records = controller.get_records(user_id)
+    history = [rec.to_dict() for rec in records]
+    return json.dumps({"history": history}, default=str)
+
+
+def measure(operation: Callable[[], object], repeat: int) -> dict[str, float]:
+    """
+    Time an operation `repeat` times.
+
+    Returns:
+        dict[str, float]: The minimum, median and maximum time in
+        milliseconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operation()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        "min_ms": min(timings),
+        "median_ms": statistics.median(timings),
+        "max_ms": max(timings),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--history-size", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--profile", help="Profile this operation and print the top functions")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    storage = MemoryStorage()
+    set_storage(storage)
+
+    start = time.perf_counter()
+    user_ids = seed(storage, args.users, args.history_size)
+    print(f"Seeded {args.users * args.history_size} records in {time.perf_counter() - start:.1f} s")
+
+    user_id = user_ids[0]
+    operations: dict[str, Callable[[], object]] = {
+        "get_balance": lambda: controller.get_balance(user_id),
+        "get_records": lambda: controller.get_records(user_id),
+        "serialize_history": lambda: serialize_history(user_id),
+        "register_gain": lambda: controller.register_gain(user_id, Money(1000), "bench"),
+    }
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(operations[args.profile])
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+        return
+
+    results = {}
+    for name, operation in operations.items():
+        results[name] = measure(operation, args.repeat)
+        print(f"{name:18} median {results[name]['median_ms']:9.3f} ms  "
+              f"min {results[name]['min_ms']:9.3f} ms")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({
+                "timestamp": datetime.now().isoformat(),
+                "config": {"users": args.users, "history_size": args.history_size,
+                           "repeat": args.repeat, "seed": args.seed},
+                "operations": results,
+            }, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
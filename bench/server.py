@@ -0,0 +1,77 @@
+"""
+Run the REST API for benchmarks.
+
+The app is served over plain HTTP with rate limiting disabled and two extra
+routes that only exist in this process:
+
+    GET /__bench__/login/<user_id>   Log in as a user, without OAuth
+    GET /__bench__/queries           Database queries run per endpoint
+
+Usage:
+    python bench/server.py [--port PORT]
+"""
+import argparse
+import os
+import sys
+import threading
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from flask import has_request_context, jsonify, request
+from flask_login import login_user
+from werkzeug.serving import make_server
+
+import db
+from models import User
+from ratelimit import rate_limiter
+from rest import app
+
+query_counts: Counter[str] = Counter()
+query_counts_lock = threading.Lock()
+_route_query = db._route_query
+
+
+def counting_route_query(*args, **kwargs):
+    """
+    Count a database query for the endpoint of the current request.
+
+    Every query of `db.execute_query` goes through `db._route_query`, with
+    Postgres or SQLite and inside a unit of work or not, so each one is
+    counted once.
+    """
+    endpoint = request.endpoint if has_request_context() else None
+    with query_counts_lock:
+        query_counts[endpoint or "<none>"] += 1
+    return _route_query(*args, **kwargs)
+
+
+@app.route("/__bench__/login/<user_id>")
+def bench_login(user_id: str):
+    user = User.get(user_id)
+    if user is None:
+        return jsonify({"status": "error", "reason": "User not found"}), 404
+    login_user(user)
+    return jsonify({"status": "ok"}), 200
+
+
+@app.route("/__bench__/queries")
+def bench_queries():
+    with query_counts_lock:
+        return jsonify(dict(query_counts)), 200
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=5001)
+    args = parser.parse_args()
+
+    db._route_query = counting_route_query
+    rate_limiter.default = (1e9, 10**9)
+    rate_limiter.endpoints = {}
+    app.secret_key = app.secret_key or "bench"
+
+    db.init_db(app)
+    server = make_server("127.0.0.1", args.port, app, threaded=True)
+    print(f"Serving on http://127.0.0.1:{args.port}", flush=True)
+    server.serve_forever()
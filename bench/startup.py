@@ -0,0 +1,148 @@
+"""
+Measure the time from starting the app to its first served request.
+
+Starts `bench/server.py` several times and measures how long it takes until
+`GET /readyz` reports the app as ready and until `GET /` answers, and the
+resident memory of the server afterwards. The time to import the app module
+is measured separately.
+
+Usage:
+    python bench/startup.py [--engine postgres|sqlite] [--sqlite-path PATH]
+                            [--runs N] [--output PATH]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def rss_mb(pid: int) -> float | None:
+    """
+    Get the resident memory of a process in MB, on Linux.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def measure_import(env: dict[str, str]) -> float:
+    """
+    Measure the time to import the app module in a fresh interpreter.
+
+    Args:
+        env (dict[str, str]): The environment of the interpreter.
+
+    Returns:
+        float: The import time, in seconds.
+    """
+    code = (
+        "import sys, time\n"
+        f"sys.path.insert(0, {os.path.join(bench_dir, '..', 'app')!r})\n"
+        "start = time.perf_counter()\n"
+        "import rest\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    output = subprocess.run([sys.executable, "-c", code], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def measure_startup(port: int, env: dict[str, str], timeout: float = 60) -> tuple[float, float, float | None]:
+    """
+    Start the server once and wait until it is ready and answers a request.
+
+    Args:
+        port (int): The port to serve on.
+        env (dict[str, str]): The environment of the server process.
+        timeout (float, optional): How many seconds to wait (default: 60).
+
+    Returns:
+        tuple[float, float, float | None]: The seconds until `/readyz`
+        answers 200, the seconds until the first `GET /` answers, and the
+        resident memory of the server in MB.
+    """
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(bench_dir, "server.py"), "--port", str(port)],
+        env=env, stdout=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                if requests.get(f"http://127.0.0.1:{port}/readyz", timeout=1).status_code == 200:
+                    ready = time.perf_counter() - start
+                    requests.get(f"http://127.0.0.1:{port}/", timeout=timeout).raise_for_status()
+                    return ready, time.perf_counter() - start, rss_mb(server.pid)
+            except requests.ConnectionError:
+                pass
+            if server.poll() is not None:
+                raise RuntimeError("Server exited before serving a request")
+            time.sleep(0.01)
+        raise RuntimeError("Server did not answer in time")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=["postgres", "sqlite"], default="postgres")
+    parser.add_argument("--sqlite-path", default=os.path.join(bench_dir, "results", "startup.db"))
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=5002)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    env = {**os.environ, "DB_ENGINE": args.engine}
+    if args.engine == "sqlite":
+        os.makedirs(os.path.dirname(os.path.abspath(args.sqlite_path)), exist_ok=True)
+        env["SQLITE_PATH"] = args.sqlite_path
+
+    imports = []
+    ready = []
+    timings = []
+    memory = []
+    for _ in range(args.runs):
+        imports.append(measure_import(env) * 1000)
+        ready_seconds, seconds, rss = measure_startup(args.port, env)
+        ready.append(ready_seconds * 1000)
+        timings.append(seconds * 1000)
+        if rss is not None:
+            memory.append(rss)
+
+    result = {
+        "engine": args.engine,
+        "runs": args.runs,
+        "import_ms": statistics.median(imports),
+        "ready_ms": statistics.median(ready),
+        "first_request_ms": {
+            "median": statistics.median(timings),
+            "min": min(timings),
+            "max": max(timings),
+        },
+        "rss_mb": statistics.median(memory) if memory else None,
+    }
+    print(f"{args.engine}: import {result['import_ms']:.0f} ms, "
+          f"ready after {result['ready_ms']:.0f} ms, "
+          f"first request after {result['first_request_ms']['median']:.0f} ms "
+          f"(min {result['first_request_ms']['min']:.0f} ms), "
+          f"RSS {result['rss_mb'] or 0:.1f} MB")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
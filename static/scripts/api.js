@@ -1,10 +1,10 @@
 const BASE_URL = ""
 
-async function request(method, route, data = null) {
+async function request(method, route, data = null, headers = {}) {
   let options = {
     method: method,
     credentials: 'include',
-    headers: { 'Content-Type': 'application/json' },
+    headers: { 'Content-Type': 'application/json', ...headers },
   };
 
   if (data) {
@@ -34,7 +34,14 @@ export async function register(type, amount, description) {
     "description": description
   }
 
-  let res = await request("POST", `/${type}`, body);
+  // Every attempt of this registration sends the same key, so a request that
+  // reached the server before the connection dropped isn't registered twice
+  let headers = { "Idempotency-Key": crypto.randomUUID() };
+  let res;
+  for (let attempt = 0; attempt < 3 && res === undefined; attempt++) {
+    // `request` returns undefined only when no response was received
+    res = await request("POST", `/${type}`, body, headers);
+  }
 
   return res
 }
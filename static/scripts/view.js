@@ -5,28 +5,35 @@ const BASE_URL = ""
 let $main = document.getElementById("main");
 
 export async function loadHomeView() {
-  let response = await fetch(`${BASE_URL}/get_content`);
-  let content = await response.text();
-  let isAuthenticated = response.headers.get("X-Is-Authenticated") === "True";
-
-  $main.innerHTML = content;
+  // The server usually renders the content, and the data of a logged in
+  // user, with the page
+  if ($main.dataset.rendered !== "true") {
+    let response = await fetch(`${BASE_URL}/get_content`);
+    $main.innerHTML = await response.text();
+  }
 
-  if (isAuthenticated) {
-    loadLoggedView();
+  let bootstrap = readBootstrap();
+  if (bootstrap) {
+    loadLoggedView(bootstrap);
   } else {
     loadNotLoggedView();
   }
 }
 
+function readBootstrap() {
+  let $bootstrap = document.getElementById("bootstrap");
+  return $bootstrap ? JSON.parse($bootstrap.textContent) : null;
+}
+
 export async function loadNotLoggedView() {
 }
 
-export async function loadLoggedView() {
-  let userData = await getUserData();
+export async function loadLoggedView(bootstrap = null) {
+  let userData = bootstrap ? bootstrap.user : await getUserData();
   document.getElementById("userName").textContent = userData["username"];
   document.getElementById("userImage").src = userData["profile_pic"];
 
-  let historyData = await getHistory();
+  let historyData = bootstrap ? bootstrap : await getHistory();
   loadHistory(historyData);
 
   let $gainAmount = document.getElementById("gainAmount");
@@ -0,0 +1,52 @@
+import os
+import sys
+
+# The app modules read their configuration when imported
+os.environ.setdefault("CACHE_BACKEND", "none")
+os.environ.setdefault("RECURRING_SCHEDULER", "0")
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import pytest
+
+import categories
+import db
+import fx
+import recurring
+import storage
+from sqlite_db import SqliteDatabase
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def backend(request, tmp_path, monkeypatch):
+    """
+    Run a test on each storage backend the models support without a server:
+    the embedded SQLite database, with the schema the app creates, and the
+    in-memory storage.
+    """
+    if request.param == "sqlite":
+        database = SqliteDatabase(str(tmp_path / "registraai.db"))
+        for module in (db, categories, recurring):
+            monkeypatch.setattr(module, "sqlite_database", database)
+        db.ensure_schema()
+        monkeypatch.setattr(storage, "_storage", storage.SqlStorage())
+        yield request.param
+        database.close()
+    else:
+        monkeypatch.setattr(storage, "_storage", storage.MemoryStorage())
+        yield request.param
+
+
+@pytest.fixture
+def rates(tmp_path, monkeypatch):
+    """
+    Exchange rates of USD, worth 5 BRL since 2020, and EUR, worth 6 BRL.
+    """
+    directory = tmp_path / "fx"
+    directory.mkdir()
+    (directory / "USD.csv").write_text("date,rate\n2020-01-01,5.0\n")
+    (directory / "EUR.csv").write_text("date,rate\n2020-01-01,6.0\n")
+    monkeypatch.setitem(fx.fx_config, "rates_dir", str(directory))
+    monkeypatch.setattr(fx, "_table", None)
+    return fx.get_rates()
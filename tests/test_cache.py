@@ -0,0 +1,191 @@
+import socketserver
+import threading
+import time
+
+import pytest
+
+import cache
+from cache import CacheError, RespCache, SharedMemoryCache
+
+
+class RespStandIn(socketserver.ThreadingTCPServer):
+    """
+    A local stand-in for a Redis server, with the few commands the cache
+    sends, kept in a dict.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password: str | None = None) -> None:
+        super().__init__(("127.0.0.1", 0), RespHandler)
+        self.password = password
+        self.data: dict[bytes, bytes] = {}
+        self.commands: list[list[bytes]] = []
+        self.connections = 0
+        self.fail_with: bytes | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address
+        credentials = f":{self.password}@" if self.password else ""
+        return f"redis://{credentials}{host}:{port}/2"
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def _read_command(self) -> list[bytes] | None:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self) -> None:
+        server: RespStandIn = self.server  # type: ignore
+        server.connections += 1
+        authenticated = server.password is None
+
+        while (command := self._read_command()) is not None:
+            server.commands.append(command)
+            name = command[0].upper()
+            if server.fail_with is not None:
+                reply = b"-" + server.fail_with + b"\r\n"
+            elif name == b"AUTH":
+                authenticated = command[-1].decode() == server.password
+                reply = b"+OK\r\n" if authenticated else b"-WRONGPASS invalid password\r\n"
+            elif not authenticated:
+                reply = b"-NOAUTH Authentication required\r\n"
+            elif name == b"SELECT":
+                reply = b"+OK\r\n"
+            elif name == b"SET":
+                server.data[command[1]] = command[2]
+                reply = b"+OK\r\n"
+            elif name == b"MGET":
+                values = [server.data.get(key) for key in command[1:]]
+                reply = b"*%d\r\n" % len(values) + b"".join(
+                    b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+                    for value in values)
+            elif name == b"DEL":
+                deleted = sum(server.data.pop(key, None) is not None for key in command[1:])
+                reply = b":%d\r\n" % deleted
+            else:
+                reply = b"-ERR unknown command\r\n"
+            self.wfile.write(reply)
+
+
+@pytest.fixture
+def server():
+    server = RespStandIn(password="secret")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_resp_cache_round_trip(server):
+    resp = RespCache(server.url, timeout=1, retry_interval=5)
+
+    resp.set("balance", "u1", {"BRL": 505000})
+    resp.set_many("u1", {"user": ["u1", "Ana"], "history": {"size": 2, "rows": []}})
+
+    assert resp.get("balance", "u1") == {"BRL": 505000}
+    assert resp.get_many("u1", ("user", "history", "analytics")) == [
+        ["u1", "Ana"], {"size": 2, "rows": []}, None]
+
+    resp.delete("u1", "balance", "user")
+    assert resp.get_many("u1", ("balance", "user")) == [None, None]
+
+
+def test_resp_cache_authenticates_selects_and_expires_entries(server, monkeypatch):
+    monkeypatch.setitem(cache.cache_config, "ttl", 30)
+    resp = RespCache(server.url, timeout=1, retry_interval=5)
+
+    resp.set("balance", "u1", 1)
+
+    assert server.commands[:2] == [[b"AUTH", b"secret"], [b"SELECT", b"2"]]
+    assert server.commands[2][-2:] == [b"EX", b"30"]
+    assert server.connections == 1
+
+
+def test_resp_cache_errors_are_misses(server):
+    resp = RespCache(server.url, timeout=1, retry_interval=5)
+    resp.delete("u1", "balance")
+    server.fail_with = b"ERR out of memory"
+
+    with pytest.raises(CacheError):
+        resp.execute(("MGET", "key"))
+    assert resp.get("balance", "u1") is None
+
+    # An error reply leaves the connection and the server usable
+    server.fail_with = None
+    resp.set("balance", "u1", 1)
+    assert resp.get("balance", "u1") == 1
+    assert server.connections == 1
+
+
+def test_resp_cache_skips_a_server_that_rejects_the_password(server):
+    resp = RespCache(server.url.replace("secret", "wrong"), timeout=1, retry_interval=60)
+
+    assert resp.get("balance", "u1") is None
+    assert resp.get("balance", "u1") is None
+
+    assert server.connections == 1
+    assert time.monotonic() < resp._unavailable_until
+
+
+def test_resp_cache_skips_an_unavailable_server():
+    stopped = RespStandIn()
+    url = stopped.url
+    stopped.server_close()
+    resp = RespCache(url, timeout=0.5, retry_interval=60)
+
+    started = time.perf_counter()
+    assert resp.get("balance", "u1") is None
+    resp.set("balance", "u1", 1)
+    resp.delete("u1", "balance")
+    assert resp.get("balance", "u1") is None
+
+    # Only the first call tried to connect
+    assert time.perf_counter() - started < 0.5
+    assert time.monotonic() < resp._unavailable_until
+
+
+def test_shared_memory_cache_is_shared_by_mappings(tmp_path):
+    path = str(tmp_path / "cache")
+    first = SharedMemoryCache(path, slots=64, slot_size=256)
+    second = SharedMemoryCache(path, slots=64, slot_size=256)
+
+    first.set_many("u1", {"balance": {"BRL": 100}, "user": ["u1", "Ana"]})
+
+    assert second.get_many("u1", ("balance", "user", "history")) == [
+        {"BRL": 100}, ["u1", "Ana"], None]
+    second.delete("u1", "balance")
+    assert first.get("balance", "u1") is None
+
+
+def test_shared_memory_cache_skips_large_values_and_expires_entries(tmp_path, monkeypatch):
+    memory = SharedMemoryCache(str(tmp_path / "cache"), slots=64, slot_size=256)
+
+    memory.set("history", "u1", "x" * 1000)
+    memory.set("balance", "u1", 100)
+
+    assert memory.get("history", "u1") is None
+    assert memory.get("balance", "u1") == 100
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + cache.cache_config["ttl"] + 1)
+    assert memory.get("balance", "u1") is None
+
+
+def test_shared_memory_cache_clears_a_file_with_other_settings(tmp_path):
+    path = str(tmp_path / "cache")
+    SharedMemoryCache(path, slots=64, slot_size=256).set("balance", "u1", 100)
+
+    resized = SharedMemoryCache(path, slots=32, slot_size=512)
+
+    assert resized.get("balance", "u1") is None
+    resized.set("balance", "u1", 200)
+    assert resized.get("balance", "u1") == 200
@@ -0,0 +1,38 @@
+import pytest
+
+import categories
+from categories import Classifier, InvalidRule, validate_rule
+
+
+@pytest.mark.parametrize("pattern", [r"uber.*eats", r"\d+", r"colou?r", r"^(?:uber|99)\b", r"[a-z]{3}"])
+def test_linear_regular_expressions_are_accepted(pattern):
+    validate_rule("transport", "regex", pattern)
+
+
+@pytest.mark.parametrize("pattern, message", [
+    (r"(?:a+)+$", "one quantifier"),
+    (r"(?:uber|99)+", "can be repeated"),
+    (r"(?:ab)*c", "can be repeated"),
+    (r"\w+\s*\d", "one quantifier"),
+    (r"(?=uber)u", "lookarounds"),
+    (r"(?<!no )uber", "lookarounds"),
+    (r"(?:(?P<x>a)|b)", "capturing groups"),
+])
+def test_backtracking_regular_expressions_are_rejected(pattern, message):
+    with pytest.raises(InvalidRule, match=message):
+        validate_rule("transport", "regex", pattern)
+
+
+def test_unsafe_stored_rules_are_skipped():
+    classifier = Classifier([("slow", "regex", r"(?:a+)+$"), ("transport", "regex", "uber")])
+
+    assert classifier.categories == ["transport"]
+    assert classifier.classify("a" * 50 + "b uber") == "transport"
+
+
+def test_only_the_start_of_long_descriptions_is_searched(monkeypatch):
+    monkeypatch.setitem(categories.categories_config, "max_description_length", 10)
+    classifier = Classifier([("transport", "keyword", "uber")])
+
+    assert classifier.classify("Uber to work") == "transport"
+    assert classifier.classify("To work by uber") is None
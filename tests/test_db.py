@@ -0,0 +1,104 @@
+import json
+
+import pytest
+
+import categories
+import db
+import recurring
+import storage
+from models import Money, User
+from sqlite_db import SqliteDatabase
+
+# The schema of the first version, with only users and float amounts
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+  id TEXT PRIMARY KEY,
+  name TEXT NOT NULL,
+  email TEXT UNIQUE NOT NULL,
+  profile_pic TEXT NOT NULL
+);
+
+CREATE TABLE records (
+  id INTEGER PRIMARY KEY,
+  user_id TEXT REFERENCES users(id),
+  amount float,
+  description varchar,
+  created_at timestamp NOT NULL
+);
+"""
+
+# The archives and carry-forward totals, as they were before amounts were
+# stored in cents
+ARCHIVES_SCHEMA = """
+CREATE TABLE record_archives (
+  user_id TEXT REFERENCES users(id),
+  month date,
+  record_count INTEGER NOT NULL,
+  total float NOT NULL,
+  payload TEXT NOT NULL,
+  PRIMARY KEY (user_id, month)
+);
+
+CREATE TABLE record_carry_forward (
+  user_id TEXT PRIMARY KEY REFERENCES users(id),
+  total float NOT NULL,
+  archived_until timestamp NOT NULL
+);
+"""
+
+
+@pytest.fixture
+def legacy_database(tmp_path, monkeypatch):
+    """
+    An SQLite database with a users and records table of the first version,
+    set as the database of the app once a test created its schema.
+    """
+    database = SqliteDatabase(str(tmp_path / "legacy.db"))
+    for module in (db, categories, recurring):
+        monkeypatch.setattr(module, "sqlite_database", database)
+    monkeypatch.setattr(storage, "_storage", storage.SqlStorage())
+    yield database
+    database.close()
+
+
+def _insert_baseline_data(database: SqliteDatabase) -> None:
+    database.execute("INSERT INTO users VALUES ('u1', 'Ana', 'ana@example.com', 'pic');")
+    database.execute("INSERT INTO records (user_id, amount, description, created_at) VALUES "
+                     "('u1', 100.5, 'Salary', '2024-05-02 10:00:00'), "
+                     "('u1', -20.0, 'Lunch', '2024-05-03 12:00:00');")
+
+
+def test_baseline_database_is_upgraded(legacy_database):
+    legacy_database.execute(BASELINE_SCHEMA)
+    _insert_baseline_data(legacy_database)
+
+    db.ensure_schema()
+
+    # The archives and carry-forward totals are created with the current schema
+    columns = db.get_table_columns(0, ("records", "record_archives", "record_carry_forward"))
+    assert {"amount_cents", "category", "currency"} <= columns["records"]
+    assert "total_cents" in columns["record_archives"]
+    assert {"total_cents", "currency"} <= columns["record_carry_forward"]
+    assert User.get_balance("u1") == Money(8050)
+    assert [record.currency for record in User.get("u1").get_records()] == ["BRL", "BRL"]
+
+    # Upgraded databases are left alone on the next start
+    db.ensure_schema()
+    assert User.get_balance("u1") == Money(8050)
+
+
+def test_archived_database_is_upgraded(legacy_database):
+    legacy_database.execute(BASELINE_SCHEMA + ARCHIVES_SCHEMA)
+    _insert_baseline_data(legacy_database)
+    payload = json.dumps([[1, 12.34, "Old salary", "2024-01-02T10:00:00"]])
+    legacy_database.execute("INSERT INTO record_archives VALUES (?, ?, ?, ?, ?);",
+                            ("u1", "2024-01-01", 1, 12.34, payload))
+    legacy_database.execute("INSERT INTO record_carry_forward VALUES (?, ?, ?);",
+                            ("u1", 12.34, "2024-02-01 00:00:00"))
+
+    db.ensure_schema()
+
+    [(total, payload)] = legacy_database.execute("SELECT total_cents, payload FROM record_archives;")
+    assert (total, json.loads(payload)) == (1234, [[1, 1234, "Old salary", "2024-01-02T10:00:00"]])
+    assert legacy_database.execute(
+        "SELECT user_id, total_cents, currency FROM record_carry_forward;") == [("u1", 1234, "BRL")]
@@ -0,0 +1,158 @@
+"""
+Model-level tests, run against every storage backend of the `backend`
+fixture, so that the SQLite database and the in-memory storage behave the
+same way as the Postgres one the models were written for.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import recurring
+from categories import InvalidRule
+from models import CategoryRule, Money, Record, RecurringRule, User
+
+
+@pytest.fixture
+def user(backend):
+    return User.create("u1", "Ana", "ana@example.com", "http://example.com/ana.jpg")
+
+
+def test_user_is_created_and_retrieved(user):
+    found = User.get("u1")
+
+    assert found is not None
+    assert found.to_dict() == user.to_dict()
+    assert User.get("missing") is None
+
+
+def test_upsert_updates_the_profile(user):
+    User.upsert("u1", "Ana Maria", "ana@example.com", "http://example.com/ana.jpg")
+
+    assert User.get("u1").name == "Ana Maria"
+
+
+def test_balance_sums_gains_and_expenses(user):
+    user.gain(Money.parse("100.50"), "Salary")
+    user.expense(Money.parse(20), "Lunch")
+
+    assert User.get_balance("u1") == Money(8050)
+    assert User.get_balance("missing") is None
+
+
+def test_records_keep_their_fields(user):
+    gain = user.gain(Money.parse("12.34"), "Salary; bonus? 'yes'")
+    expense = user.expense(Money.parse(5), "Coffee")
+
+    records = user.get_records()
+
+    assert [record.id for record in records] == [gain.id, expense.id]
+    assert [record.amount for record in records] == [Money(1234), Money(-500)]
+    assert records[0].description == "Salary; bonus? 'yes'"
+    assert records[0].currency == "BRL"
+    assert records[0].category is None
+
+
+def test_records_are_filtered_by_date(user):
+    record = user.gain(Money(100), "Salary")
+    now = datetime.now()
+
+    assert [r.id for r in user.get_records(since=now - timedelta(minutes=1))] == [record.id]
+    assert user.get_records(since=now + timedelta(minutes=1)) == []
+    assert user.get_records(until=now - timedelta(minutes=1)) == []
+
+
+def test_bootstrap_returns_the_latest_records(user):
+    for amount in (100, 200, 300):
+        user.gain(Money(amount), f"Gain {amount}")
+
+    found, balance, records = User.get_bootstrap("u1", 2)
+
+    assert found.id == "u1"
+    assert balance == Money(600)
+    assert [record.amount for record in records] == [Money(200), Money(300)]
+    assert User.get_bootstrap("missing", 2) is None
+
+
+def test_columns_are_ordered_by_creation_time(user):
+    user.gain(Money(100), "Salary")
+    user.expense(Money(30), "Lunch")
+
+    seconds, cents = Record.get_columns("u1", datetime.now() - timedelta(days=1))
+
+    assert list(cents) == [100, -30]
+    assert list(seconds) == sorted(seconds)
+
+
+def test_category_rules_label_new_records(user):
+    CategoryRule.create("u1", "transport", "keyword", "uber")
+
+    record = user.expense(Money(1500), "Uber to work")
+    other = user.expense(Money(800), "Lunch")
+
+    assert record.category == "transport"
+    assert other.category is None
+    totals = Record.get_category_totals("u1", datetime.now() - timedelta(days=1),
+                                        datetime.now() + timedelta(days=1))
+    assert totals == [("transport", Money(0), Money(1500), 1), (None, Money(0), Money(800), 1)]
+
+
+def test_category_rules_are_deleted(user):
+    rule = CategoryRule.create("u1", "food", "keyword", "lunch")
+
+    assert [r.id for r in CategoryRule.get_all("u1")] == [rule.id]
+    assert CategoryRule.delete("u1", rule.id)
+    assert CategoryRule.get_all("u1") == []
+    assert not CategoryRule.delete("u1", rule.id)
+
+
+def test_invalid_category_rules_are_rejected(user):
+    with pytest.raises(InvalidRule):
+        CategoryRule.create("u1", "food", "regex", "(unclosed")
+
+
+def test_recurring_rules_are_created_and_deleted(user):
+    rule = RecurringRule.create("u1", Money(500000), "Salary", "0 9 5 * *")
+
+    assert [r.id for r in RecurringRule.get_all("u1")] == [rule.id]
+    assert RecurringRule.get_all("u1")[0].next_run_at.day == 5
+    assert RecurringRule.delete("u1", rule.id)
+    assert RecurringRule.get_all("u1") == []
+
+
+def test_recurring_rules_keep_their_currency(user):
+    RecurringRule.create("u1", Money(500000), "Salary", "0 9 5 * *")
+    RecurringRule.create("u1", Money(-2000), "Hosting", "0 0 1 * *", "USD")
+
+    assert [rule.currency for rule in RecurringRule.get_all("u1")] == ["BRL", "USD"]
+
+
+# The in-memory storage doesn't materialize recurring rules
+@pytest.mark.parametrize("backend", ["sqlite"], indirect=True)
+def test_recurring_rules_register_records_in_their_currency(user):
+    rule = RecurringRule.create("u1", Money(-2000), "Hosting", "0 0 1 * *", "USD")
+
+    assert recurring.tick(rule.next_run_at) == 1
+    [record] = user.get_records(since=rule.next_run_at - timedelta(days=1))
+    assert (record.amount, record.description, record.currency) == (Money(-2000), "Hosting", "USD")
+
+
+def test_balance_converts_other_currencies(user, rates):
+    user.gain(Money(10000), "Salary")
+    user.gain(Money(1000), "Freelance", "USD")
+    user.expense(Money(500), "Dinner in Paris", "EUR")
+
+    assert User.get_balance("u1") == Money(10000 + 5000 - 3000)
+    assert User.get_balance("u1", "USD") == Money(2000 + 1000 - 600)
+    assert User.get_balance("u1", "EUR") == Money(round(12000 / 6))
+
+
+def test_columns_and_totals_are_converted(user, rates):
+    user.gain(Money(1000), "Freelance", "USD")
+    user.expense(Money(600), "Lunch")
+
+    _, cents = Record.get_columns("u1", datetime.now() - timedelta(days=1))
+    totals = Record.get_category_totals("u1", datetime.now() - timedelta(days=1),
+                                        datetime.now() + timedelta(days=1), "USD")
+
+    assert list(cents) == [5000, -600]
+    assert totals == [(None, Money(1000), Money(120), 2)]
@@ -0,0 +1,208 @@
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+import db
+import oidc
+import rest
+import storage
+from oidc import DocumentCache, InvalidIdToken, verify_id_token
+
+ISSUER = "https://accounts.google.com"
+CLIENT_ID = "client.apps.googleusercontent.com"
+JWKS_URI = "https://provider.test/certs"
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _jwk(kid: str, key: rsa.RSAPrivateKey) -> dict:
+    numbers = key.public_key().public_numbers()
+    return {
+        "kty": "RSA", "kid": kid, "alg": "RS256", "use": "sig",
+        "n": _b64encode(numbers.n.to_bytes((numbers.n.bit_length() + 7) // 8, "big")),
+        "e": _b64encode(numbers.e.to_bytes(3, "big")),
+    }
+
+
+def _sign(kid: str, key: rsa.RSAPrivateKey, claims: dict, alg: str = "RS256") -> str:
+    header = _b64encode(json.dumps({"alg": alg, "kid": kid}).encode())
+    payload = _b64encode(json.dumps(claims).encode())
+    signature = key.sign(f"{header}.{payload}".encode(), padding.PKCS1v15(), hashes.SHA256())
+    return f"{header}.{payload}.{_b64encode(signature)}"
+
+
+def _claims(**overrides) -> dict:
+    now = int(time.time())
+    return {
+        "iss": ISSUER, "aud": CLIENT_ID, "sub": "110169484474386276334",
+        "email": "ana@example.com", "email_verified": True, "given_name": "Ana",
+        "picture": "https://example.com/ana.jpg", "iat": now, "exp": now + 3600,
+        **overrides,
+    }
+
+
+class Provider:
+    """
+    A stand-in for the signing keys of an OpenID provider, with a generated
+    key pair, served through the fetch function of a `DocumentCache`.
+    """
+
+    def __init__(self) -> None:
+        self.keys = {"key-1": rsa.generate_private_key(public_exponent=65537, key_size=2048)}
+        self.fetches = 0
+
+    def fetch(self, url: str) -> dict:
+        self.fetches += 1
+        return {"keys": [_jwk(kid, key) for kid, key in self.keys.items()]}
+
+    def token(self, kid: str = "key-1", **overrides) -> str:
+        return _sign(kid, self.keys[kid], _claims(**overrides))
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    provider = Provider()
+    monkeypatch.setattr(oidc, "key_sets", DocumentCache(3600, fetch=provider.fetch))
+    return provider
+
+
+def verify(token: str) -> dict:
+    return verify_id_token(token, CLIENT_ID, (ISSUER, "accounts.google.com"), JWKS_URI)
+
+
+def test_valid_tokens_are_verified_with_cached_keys(provider):
+    assert verify(provider.token())["email"] == "ana@example.com"
+    assert verify(provider.token(iss="accounts.google.com", aud=["other", CLIENT_ID]))["sub"]
+
+    assert provider.fetches == 1
+
+
+def test_rotated_keys_are_fetched_again(provider, monkeypatch):
+    verify(provider.token())
+    provider.keys["key-2"] = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    # Within the minimum refresh interval the cached keys are kept
+    with pytest.raises(InvalidIdToken, match="Unknown signing key"):
+        verify(provider.token("key-2"))
+
+    monkeypatch.setitem(oidc.oidc_config, "min_refresh_interval", 0)
+    assert verify(provider.token("key-2"))["sub"]
+    assert provider.fetches == 2
+
+
+@pytest.mark.parametrize("overrides, message", [
+    ({"iss": "https://evil.example.com"}, "Unexpected issuer"),
+    ({"aud": "another-client"}, "another client"),
+    ({"exp": int(time.time()) - 3600}, "expired"),
+    ({"iat": int(time.time()) + 3600}, "in the future"),
+])
+def test_tokens_for_other_apps_or_times_are_rejected(provider, overrides, message):
+    with pytest.raises(InvalidIdToken, match=message):
+        verify(provider.token(**overrides))
+
+
+def test_forged_and_malformed_tokens_are_rejected(provider):
+    forger = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    header, payload, _ = provider.token().split(".")
+    tampered = _b64encode(json.dumps(_claims(email="mallory@example.com")).encode())
+
+    with pytest.raises(InvalidIdToken, match="Invalid signature"):
+        verify(_sign("key-1", forger, _claims()))
+    with pytest.raises(InvalidIdToken, match="Invalid signature"):
+        verify(f"{header}.{tampered}.{provider.token().split('.')[2]}")
+    with pytest.raises(InvalidIdToken, match="Unsupported algorithm"):
+        verify(_sign("key-1", provider.keys["key-1"], _claims(), alg="none"))
+    with pytest.raises(InvalidIdToken, match="Malformed"):
+        verify(f"{header}.{payload}")
+    with pytest.raises(InvalidIdToken, match="Malformed"):
+        verify("not.a.token")
+
+
+class ProviderHandler(BaseHTTPRequestHandler):
+    provider: Provider
+    claims: dict = {}
+    requests: list[str] = []
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _reply(self, document: dict) -> None:
+        self.requests.append(self.path)
+        body = json.dumps(document).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        base = f"http://{self.headers['Host']}"
+        if self.path == "/.well-known/openid-configuration":
+            self._reply({"issuer": ISSUER, "authorization_endpoint": f"{base}/auth",
+                         "token_endpoint": f"{base}/token", "jwks_uri": f"{base}/certs"})
+        else:
+            self._reply(self.provider.fetch(self.path))
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self._reply({"access_token": "access", "token_type": "Bearer", "expires_in": 3600,
+                     "id_token": self.provider.token(**self.claims)})
+
+
+@pytest.fixture
+def google(backend, monkeypatch):
+    """
+    The login callback against a local stand-in of Google's discovery
+    document, token endpoint and signing keys.
+    """
+    handler = type("Handler", (ProviderHandler,), {"provider": Provider(), "claims": {}, "requests": []})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setenv("OAUTHLIB_INSECURE_TRANSPORT", "1")
+    monkeypatch.setattr(rest, "GOOGLE_CLIENT_ID", CLIENT_ID)
+    monkeypatch.setattr(rest, "GOOGLE_CLIENT_SECRET", "secret")
+    monkeypatch.setattr(rest, "GOOGLE_DISCOVERY_URL", f"{base}/.well-known/openid-configuration")
+    monkeypatch.setattr(rest, "_oauth_client", None)
+    monkeypatch.setattr(oidc, "provider_configs", DocumentCache(3600))
+    monkeypatch.setattr(oidc, "key_sets", DocumentCache(3600))
+    monkeypatch.setattr(rest.app, "secret_key", "test")
+    ready = threading.Event()
+    ready.set()
+    monkeypatch.setattr(db, "_ready", ready)
+
+    yield handler
+    server.shutdown()
+    server.server_close()
+
+
+def _login():
+    client = rest.app.test_client()
+    return client.get("/login/callback?code=code&state=state", base_url="https://localhost")
+
+
+def test_login_verifies_the_id_token_without_calling_the_provider_again(google):
+    assert _login().status_code == 302
+    assert _login().status_code == 302
+
+    assert storage.get_storage().get_user(_claims()["sub"])[1:3] == ("Ana", "ana@example.com")
+    # One discovery and one key fetch, then only token exchanges
+    assert google.requests == ["/.well-known/openid-configuration", "/token", "/certs", "/token"]
+
+
+def test_login_rejects_invalid_tokens_and_unverified_emails(google):
+    google.claims = {"aud": "another-client"}
+    assert _login().status_code == 401
+
+    google.claims = {"email_verified": False}
+    assert _login().status_code == 400
+    assert storage.get_storage().get_user(_claims()["sub"]) is None
@@ -0,0 +1,39 @@
+import sqlite3
+
+import pytest
+
+from sqlite_db import SqliteDatabase, split_statements
+
+
+def test_separators_and_placeholders_in_literals_and_comments_are_ignored():
+    script = """
+        -- Inserts; then selects?
+        INSERT INTO t (a, b) VALUES (?, 'a;b?');
+        /* ; ? */
+        SELECT "c;?", [d;?] FROM t WHERE a = ? AND b = 'it''s; ?';
+    """
+
+    assert [placeholders for _, placeholders in split_statements(script)] == [1, 1]
+
+
+def test_statements_take_their_values_in_order(tmp_path):
+    database = SqliteDatabase(str(tmp_path / "test.db"))
+    database.execute("CREATE TABLE t (a INTEGER, b TEXT); CREATE INDEX t_a_idx ON t (a);")
+
+    result = database.execute("INSERT INTO t VALUES (?, ?); SELECT a, b FROM t WHERE a = ?;",
+                              (1, "x; y?", 1))
+
+    assert result == [(1, "x; y?")]
+    with pytest.raises(sqlite3.ProgrammingError):
+        database.execute("SELECT a FROM t WHERE a = ?;", (1, 2), read_only=True)
+
+
+def test_failed_scripts_are_rolled_back(tmp_path):
+    database = SqliteDatabase(str(tmp_path / "test.db"))
+    database.execute("CREATE TABLE t (a INTEGER);")
+
+    with pytest.raises(sqlite3.OperationalError):
+        database.execute("CREATE TABLE u (a INTEGER); INSERT INTO missing VALUES (1);")
+
+    tables = database.execute("SELECT name FROM sqlite_master WHERE type = 'table';", read_only=True)
+    assert tables == [("t",)]